@@ -0,0 +1,78 @@
+"""
+Compare the ORM and core execution modes of a recipe on SQLite.
+
+Usage::
+
+    python benchmarks/core_vs_orm.py [rows] [repeat]
+"""
+import random
+import sys
+import timeit
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from recipe import Dimension, Metric, Recipe, Shelf
+
+
+def build_table(engine, rows):
+    meta = MetaData()
+    table = Table(
+        "sales",
+        meta,
+        Column("region", String),
+        Column("product", String),
+        Column("day", Integer),
+        Column("amount", Integer),
+    )
+    meta.create_all(engine)
+    rng = random.Random(0)
+    engine.execute(
+        table.insert(),
+        [
+            {
+                "region": f"region{rng.randint(0, 20)}",
+                "product": f"product{rng.randint(0, 200)}",
+                "day": rng.randint(0, 365),
+                "amount": rng.randint(0, 1000),
+            }
+            for _ in range(rows)
+        ],
+    )
+    return table
+
+
+def main(rows=100000, repeat=20):
+    engine = create_engine("sqlite://")
+    table = build_table(engine, rows)
+    session = sessionmaker(bind=engine)()
+    shelf = Shelf(
+        {
+            "region": Dimension(table.c.region),
+            "product": Dimension(table.c.product),
+            "day": Dimension(table.c.day),
+            "amount": Metric(func.sum(table.c.amount)),
+            "count": Metric(func.count()),
+        }
+    )
+
+    def run(execution_mode):
+        recipe = (
+            Recipe(shelf=shelf, session=session)
+            .dimensions("region", "product", "day")
+            .metrics("amount", "count")
+            .execution_mode(execution_mode)
+        )
+        return recipe.all()
+
+    assert run("orm") == run("core")
+    print(f"{rows} rows, {len(run('orm'))} result rows, best of {repeat}")
+    for execution_mode in ("orm", "core"):
+        elapsed = min(
+            timeit.repeat(lambda: run(execution_mode), number=1, repeat=repeat)
+        )
+        print(f"  {execution_mode:>4}: {elapsed * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
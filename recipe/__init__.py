@@ -9,6 +9,7 @@ from recipe.core import Recipe
 from recipe.exceptions import BadIngredient, BadRecipe, InvalidColumnError
 from recipe.extensions import (
     Anonymize,
+    AutoPaginate,
     AutomaticFilters,
     BlendRecipe,
     CompareRecipe,
@@ -16,6 +17,7 @@ from recipe.extensions import (
     Paginate,
     PaginateInline,
     PaginateCountOver,
+    PaginateKeyset,
 )
 from recipe.ingredients import (
     Dimension,
@@ -79,5 +81,7 @@ __all__ = [
     "Paginate",
     "PaginateInline",
     "PaginateCountOver",
+    "PaginateKeyset",
+    "AutoPaginate",
     "FakerAnonymizer",
 ]
@@ -0,0 +1,503 @@
+"""
+Result caching for recipes.
+
+Results are stored in a cache backend under a key built from the compiled
+SQL of the recipe's query, its bound parameters and the database it runs
+on. Backends are attached
+to named cache regions with ``configure_cache_region``; a recipe uses the
+backend for its ``cache_region``. If no backend is configured for a
+region, results are not cached.
+
+.. code-block:: python
+
+    from recipe.caching import MemoryCache, SQLiteCache, TieredCache
+    from recipe.caching import configure_cache_region
+
+    configure_cache_region(
+        "default",
+        TieredCache(MemoryCache(max_bytes=64 * 1024 * 1024), SQLiteCache("cache.db")),
+    )
+
+Concurrent recipes that run identical queries on the same database are
+coalesced by ``single_flight`` so that the query is executed once.
+
+Total counts for paginated recipes can be cached with a ttl even if no
+backend is configured; they are stored in ``count_cache``.
+"""
+import hashlib
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import Label
+from sqlalchemy.sql.functions import FunctionElement
+
+logger = logging.getLogger(__name__)
+
+# Returned by backends when a key is missing or expired
+NO_VALUE = object()
+
+
+class CacheBackend(object):
+    """The interface for result cache backends.
+
+    Values may be any picklable object.
+
+    :param default_ttl: The number of seconds values are kept if no ttl
+        is given when setting a value. None keeps values until they are
+        evicted.
+    """
+
+    def __init__(self, default_ttl=None):
+        self.default_ttl = default_ttl
+
+    def _expires(self, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        return None if ttl is None else time.time() + ttl
+
+    def get(self, key):
+        """Return the value for key or NO_VALUE."""
+        raise NotImplementedError
+
+    def get_with_expiry(self, key):
+        """Return a tuple of the value for key (or NO_VALUE) and the time
+        it expires, or None if it never expires. Backends that don't track
+        expiry times assume values expire after ``default_ttl``."""
+        return self.get(key), self._expires(None)
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """A thread safe in-memory LRU cache limited by the size of the
+    pickled values it holds.
+
+    :param max_bytes: The maximum number of bytes of values to keep.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_ttl=None):
+        super().__init__(default_ttl=default_ttl)
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key):
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                return NO_VALUE, None
+            expires, data = item
+            if expires is not None and expires < time.time():
+                self._remove(key)
+                return NO_VALUE, None
+            self._values.move_to_end(key)
+        return pickle.loads(data), expires
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._remove(key)
+            if len(data) > self.max_bytes:
+                return
+            self._values[key] = (self._expires(ttl), data)
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self._values)))
+
+    def _remove(self, key):
+        item = self._values.pop(key, None)
+        if item is not None:
+            self.current_bytes -= len(item[1])
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._values)
+
+
+class SQLiteCache(CacheBackend):
+    """A cache stored in a local SQLite database file.
+
+    :param path: The path of the database file. Use ":memory:" for
+        a cache that is not saved.
+    """
+
+    def __init__(self, path, default_ttl=None):
+        super().__init__(default_ttl=default_ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS recipe_cache "
+                "(key TEXT PRIMARY KEY, expires REAL, value BLOB)"
+            )
+
+    def get(self, key):
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires, value FROM recipe_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return NO_VALUE, None
+        expires, data = row
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return NO_VALUE, None
+        return pickle.loads(data), expires
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO recipe_cache (key, expires, value) "
+                "VALUES (?, ?, ?)",
+                (key, self._expires(ttl), sqlite3.Binary(data)),
+            )
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM recipe_cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM recipe_cache")
+
+
+class TieredCache(CacheBackend):
+    """A two level cache. Values are read from the first level cache
+    (usually a fast MemoryCache) then from the second level cache.
+    Values found in the second level are copied to the first, and expire
+    from the first level when they expire from the second.
+    """
+
+    def __init__(self, l1, l2, default_ttl=None):
+        super().__init__(default_ttl=default_ttl)
+        self.l1 = l1
+        self.l2 = l2
+
+    def get(self, key):
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key):
+        value, expires = self.l1.get_with_expiry(key)
+        if value is NO_VALUE:
+            value, expires = self.l2.get_with_expiry(key)
+            if value is not NO_VALUE:
+                ttl = FOREVER if expires is None else expires - time.time()
+                self.l1.set(key, value, ttl=ttl)
+        return value, expires
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        self.l1.set(key, value, ttl=ttl)
+        self.l2.set(key, value, ttl=ttl)
+
+    def delete(self, key):
+        self.l1.delete(key)
+        self.l2.delete(key)
+
+    def clear(self):
+        self.l1.clear()
+        self.l2.clear()
+
+
+cache_regions = {}
+
+
+def configure_cache_region(name, backend):
+    """Use a cache backend for recipes with ``cache_region(name)``. If
+    backend is None, results for the region are not cached."""
+    if backend is None:
+        cache_regions.pop(name, None)
+    else:
+        cache_regions[name] = backend
+
+
+def get_cache_region(name):
+    """Return the cache backend for a region or None."""
+    return cache_regions.get(name)
+
+
+def database_identity(bind):
+    """Identify the database an engine or connection runs on in cache keys.
+
+    Databases are identified by their URL with the password hidden and by
+    the schema translate map, which changes the tables a statement reads.
+    In-memory SQLite databases share a URL but not their data, so they are
+    also identified by the engine object.
+    """
+    engine = getattr(bind, "engine", bind)
+    url = engine.url
+    identity = [url.render_as_string(hide_password=True)]
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        identity.append(id(engine))
+    translate_map = bind.get_execution_options().get("schema_translate_map")
+    identity.append(sorted((translate_map or {}).items(), key=repr))
+    return repr(identity)
+
+
+def result_cache_key(statement, dialect, prefix="default", identity=None):
+    """Build a cache key from the SQL and bound parameters of a statement
+    compiled for dialect, and the ``database_identity`` of the database
+    it runs on."""
+    compiled = statement.compile(dialect=dialect)
+    params = sorted(compiled.params.items())
+    digest = hashlib.sha256(
+        repr((dialect.name, identity, str(compiled), params)).encode("utf-8")
+    ).hexdigest()
+    return f"{prefix}:{digest}"
+
+
+def freeze_rows(rows):
+    """Convert result rows to a picklable (fields, tuples) pair."""
+    fields = tuple(rows[0]._fields) if rows else ()
+    return fields, [tuple(row) for row in rows]
+
+
+def thaw_rows(frozen):
+    """Convert a (fields, tuples) pair back into rows."""
+    fields, values = frozen
+    if not values:
+        return []
+    row = namedtuple("row", fields)
+    return list(map(row._make, values))
+
+
+# A ttl for values that never expire
+FOREVER = float("inf")
+
+
+def period_start(day, date_aggregation):
+    """Return the first day of the period containing a date."""
+    if date_aggregation == "year":
+        return day.replace(month=1, day=1)
+    elif date_aggregation == "month":
+        return day.replace(day=1)
+    return day
+
+
+def time_partitions(today, date_aggregation, datatype="date"):
+    """Split time into partitions for incremental caching.
+
+    Returns a list of (start, end, closed) tuples, ordered from oldest to
+    newest. ``start`` is inclusive and ``end`` is exclusive, and either
+    may be None for an unbounded partition. Closed partitions are complete
+    and won't change. They cover everything before this year, and this
+    year up to the start of the open period. The open partition starts at
+    the beginning of the period containing today.
+    """
+    year_start = period_start(today, "year")
+    open_start = period_start(today, date_aggregation)
+    if datatype == "datetime":
+        year_start = datetime.combine(year_start, datetime.min.time())
+        open_start = datetime.combine(open_start, datetime.min.time())
+
+    partitions = [(None, year_start, True)]
+    if open_start > year_start:
+        partitions.append((year_start, open_start, True))
+    partitions.append((open_start, None, False))
+    return partitions
+
+
+# How partial results of aggregate functions are combined
+COMBINED_AGGREGATIONS = {"sum": "sum", "count": "sum", "min": "min", "max": "max"}
+
+
+def metric_aggregation(expression):
+    """Return how partial results of an aggregate expression can be combined
+    ("sum", "min" or "max"), or None if they can't be combined.
+
+    Only plain sum, count, min and max functions can be combined. Counts
+    of distinct values can't.
+    """
+    while isinstance(expression, Label):
+        expression = expression.element
+    if not isinstance(expression, FunctionElement):
+        return None
+    name = getattr(expression, "name", "").lower()
+    if name not in COMBINED_AGGREGATIONS:
+        return None
+    for clause in expression.clauses:
+        if getattr(clause, "operator", None) is operators.distinct_op:
+            return None
+    return COMBINED_AGGREGATIONS[name]
+
+
+def _combine_sum(a, b):
+    if a is None:
+        return b
+    return a if b is None else a + b
+
+
+def _combine_min(a, b):
+    if a is None:
+        return b
+    return a if b is None else min(a, b)
+
+
+def _combine_max(a, b):
+    if a is None:
+        return b
+    return a if b is None else max(a, b)
+
+
+_COMBINERS = {"sum": _combine_sum, "min": _combine_min, "max": _combine_max}
+
+
+def reaggregate(frozen, fields, group_fields, aggregations):
+    """Group frozen rows by some of their fields, combining metrics.
+
+    :param frozen: A (fields, tuples) pair of finer grained rows
+    :param fields: The fields of the result rows
+    :param group_fields: The fields to group by
+    :param aggregations: A dictionary of metric field to "sum", "min"
+        or "max"
+    :return: A (fields, tuples) pair
+    """
+    source_fields, values = frozen
+    index = {field: i for i, field in enumerate(source_fields)}
+    group_index = [index[field] for field in group_fields]
+    metric_fields = list(aggregations)
+    metric_index = [index[field] for field in metric_fields]
+    combiners = [_COMBINERS[aggregations[field]] for field in metric_fields]
+
+    groups = {}
+    for row in values:
+        key = tuple(row[i] for i in group_index)
+        metrics = [row[i] for i in metric_index]
+        partial = groups.get(key)
+        if partial is not None:
+            metrics = [c(a, b) for c, a, b in zip(combiners, partial, metrics)]
+        groups[key] = metrics
+
+    rows = []
+    for key, metrics in groups.items():
+        row = dict(zip(group_fields, key))
+        row.update(zip(metric_fields, metrics))
+        rows.append(tuple(row[field] for field in fields))
+    return tuple(fields), rows
+
+
+class _Call(object):
+    """An in-flight execution shared by SingleFlight callers."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent executions that share a key.
+
+    The first caller for a key runs the function. Callers that arrive
+    while it is running wait for it to finish and receive the same
+    result, or the same exception. Once the execution finishes, the next
+    caller for the key runs the function again.
+
+    :ivar executions: The number of times a function was run
+    :ivar coalesced: The number of callers that shared another caller's
+        execution
+    """
+
+    def __init__(self):
+        self.executions = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return ``fn()``, sharing the execution with concurrent callers
+        that use the same key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def reset(self):
+        """Reset the counters."""
+        with self._lock:
+            self.executions = self.coalesced = 0
+
+
+single_flight = SingleFlight()
+
+
+# Total counts for recipes whose cache region has no backend
+count_cache = MemoryCache(max_bytes=4 * 1024 * 1024)
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def refresh_in_background(key, refresh):
+    """Run ``refresh()`` in a daemon thread unless a refresh for key is
+    already running.
+
+    :return: The thread running the refresh or None
+    """
+    with _refreshing_lock:
+        if key in _refreshing:
+            return None
+        _refreshing.add(key)
+
+    def run():
+        try:
+            refresh()
+        except Exception:
+            logger.exception("Background refresh of %s failed", key)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    thread = threading.Thread(target=run, name=f"recipe-refresh-{key}", daemon=True)
+    thread.start()
+    return thread
@@ -1,27 +1,98 @@
 from __future__ import annotations
 
 import contextlib
+import csv
+import hashlib
+import io
+import json
 import logging
+import sys
 import time
 import warnings
 from copy import copy
+from datetime import date
+from functools import partial
+from itertools import chain, islice
+from operator import itemgetter
 from uuid import uuid4
 
 import attr
 import tablib
-from sqlalchemy import alias, func, select
+from sqlalchemy import Date, DateTime, alias, func, literal, select
 from sureberus import normalize_dict, normalize_schema
 
+from recipe.caching import (
+    FOREVER,
+    NO_VALUE,
+    count_cache,
+    database_identity,
+    freeze_rows,
+    get_cache_region,
+    metric_aggregation,
+    reaggregate,
+    refresh_in_background,
+    result_cache_key,
+    single_flight,
+    thaw_rows,
+    time_partitions,
+)
 from recipe.dynamic_extensions import run_hooks
+from recipe.events import RecipeEvent, RecipeEvents, events
 from recipe.exceptions import BadRecipe
 from recipe.ingredients import Dimension, Filter, Having, Ingredient, Metric
 from recipe.schemas import recipe_schema
 from recipe.shelf import Shelf
-from recipe.utils import prettyprintable_sql, recipe_arg
-from recipe.utils.formatting import filter_to_string
+from recipe.templates import (
+    NotTemplatable,
+    QueryTemplate,
+    bind_template,
+    element_key,
+    statement_shape,
+    statement_shapes,
+    template_cache,
+)
+from recipe.utils import (
+    always_false,
+    pad_in_lists,
+    prettyprintable_sql,
+    recipe_arg,
+    simplify_filters,
+    load_value_tables,
+)
+from recipe.utils.datatype import determine_datatype, numpy_array
+from recipe.utils.formatting import filter_key
 
 ALLOW_QUERY_CACHING = True
 
+# Share a single execution between concurrent recipes that run the
+# same query on the same database.
+ALLOW_QUERY_COALESCING = True
+
+# Answer recipes from cached results that have more dimensions when all
+# metrics can be re-aggregated.
+ALLOW_REAGGREGATION = True
+
+# The number of cached results described for each combination of data
+# and filters.
+SEMANTIC_INDEX_SIZE = 50
+
+# Pad the values of in and notin filters so that statements with similar
+# numbers of values have the same SQL. Values are padded to a multiple of
+# the bin size for the database or to the next power of two, and never
+# past the maximum size of a list for the database.
+ALLOW_IN_LIST_PADDING = True
+IN_LIST_BIN_SIZES = {"redshift": 11}
+IN_LIST_MAX_SIZES = {"oracle": 1000, "sqlite": 999, "mssql": 2000}
+DEFAULT_IN_LIST_MAX_SIZE = 1000
+
+# The number of rows sampled to estimate the size of a result
+RESULT_BYTES_SAMPLE_SIZE = 100
+
+# Merge eq and in filters on the same expression before building the
+# query. Recipes whose filters contradict each other return no rows
+# without running a query.
+ALLOW_FILTER_SIMPLIFICATION = True
+
 warnings.simplefilter("always", DeprecationWarning)
 
 logger = logging.getLogger(__name__)
@@ -29,10 +100,55 @@ logger = logging.getLogger(__name__)
 
 @attr.s()
 class Stats(object):
+    """Statistics about the last time a recipe was built and run. Times
+    are in seconds.
+
+    rows: The number of rows returned
+    dbtime: Time spent fetching rows from the database or result cache
+    enchanttime: Time spent enchanting rows
+    from_cache: True if the rows came from a cache
+    buildtime: Time spent building the query, including the phases below
+    ingredienttime: Time spent in extension ``add_ingredients``
+    brewtime: Time spent brewing query parts from the cauldron
+    modifytime: Time spent in extension ``modify_recipe_parts``
+    postquerytime: Time spent in extension ``modify_postquery_parts``,
+        not including count queries
+    hooktime: Time spent in dynamic extension hooks
+    cachekeytime: Time spent compiling statements into result cache keys.
+        Compiling SQL to execute is part of dbtime and counttime.
+    counttime: Time spent counting rows (for instance, to paginate)
+    result_bytes: The approximate size of the fetched values in bytes,
+        estimated from a sample of the rows
+    statement_shapes: The number of distinct statement shapes (numbers of
+        values in in lists) built for recipes with this structure
+    """
+
     rows = attr.ib(default=0)
     dbtime = attr.ib(default=0.0)
     enchanttime = attr.ib(default=0.0)
     from_cache = attr.ib(default=False)
+    buildtime = attr.ib(default=0.0)
+    ingredienttime = attr.ib(default=0.0)
+    brewtime = attr.ib(default=0.0)
+    modifytime = attr.ib(default=0.0)
+    postquerytime = attr.ib(default=0.0)
+    hooktime = attr.ib(default=0.0)
+    cachekeytime = attr.ib(default=0.0)
+    counttime = attr.ib(default=0.0)
+    result_bytes = attr.ib(default=0)
+    statement_shapes = attr.ib(default=0)
+
+
+def _result_bytes(rows):
+    """The approximate size of the values in a list of rows in bytes,
+    estimated from at most RESULT_BYTES_SAMPLE_SIZE evenly spaced rows."""
+    sample_size = RESULT_BYTES_SAMPLE_SIZE
+    if len(rows) <= sample_size:
+        return sum(map(sys.getsizeof, chain.from_iterable(rows)))
+    step = len(rows) / sample_size
+    sample = [rows[int(idx * step)] for idx in range(sample_size)]
+    sample_bytes = sum(map(sys.getsizeof, chain.from_iterable(sample)))
+    return int(sample_bytes * len(rows) / sample_size)
 
 
 class Recipe(object):
@@ -80,6 +196,7 @@ class Recipe(object):
         self._select = None
         self._all = None
         self._total_count = None
+        self._empty = False
 
         self._select_from = None
         self._allow_multiple_tables = False
@@ -94,8 +211,13 @@ class Recipe(object):
         self._cache_region = "default"
         self._cache_prefix = "default"
         self._use_cache = True
+        self._cache_ttl = None
+        self._incremental_cache = False
+        self._fetched_from_cache = False
 
         self.stats = Stats()
+        self.events = RecipeEvents(parent=events)
+        self._fingerprint = None
 
         # Store the original dimensions and metrics put into the recipe.
         # These may contain duplicates, which will not exist after the
@@ -113,6 +235,8 @@ class Recipe(object):
             self.order_by(*order_by)
 
         self._session = session
+        self._connection = None
+        self._execution_mode = "orm"
 
         self._limit = 0
         self._offset = 0
@@ -122,7 +246,7 @@ class Recipe(object):
         ]
         self.dynamic_extensions = dynamic_extensions
 
-    def total_count(self, query=None):
+    def total_count(self, query=None, ttl=None, refresh=None, cap=None):
         """Return the number of rows that would be returned by this Recipe,
         ignoring any `limit` that has been applied.
 
@@ -130,37 +254,136 @@ class Recipe(object):
 
             query: An optional SQLAlchemy query to calculate total_count for.
               If None, the recipe query will be used.
-              If a query is passed, no caching will be done.
+              If a query is passed, the count is not saved on the recipe.
+            ttl: If given, share the count between recipes for this many
+              seconds. The count is keyed by the query without limit, offset
+              or ordering and the database the recipe runs on, and stored in
+              the recipe's cache region, or in ``count_cache`` if the region
+              has no backend.
+            refresh: If given with a ttl, a shared count older than this
+              many seconds is returned and recounted in the background.
+            cap: If given, count at most cap + 1 rows. A count greater than
+              cap means that there are more than cap rows.
 
         Returns:
             A count of the number of rows that are returned by this query.
         """
+        recipe_query = query is None and cap is None
         if query is None:
             query = self.query()
-
-        if self._total_count is None or query is not None:
-            count_query = self._session.query(func.count().label("count")).select_from(
-                query.limit(None).offset(None).order_by(None).subquery()
+            if self._empty:
+                return 0
+
+        if self._total_count is None or not recipe_query:
+            starttime = time.time()
+            count_query = query.limit(None).offset(None).order_by(None)
+            if cap is not None:
+                count_query = count_query.limit(cap + 1)
+            count_subquery = count_query.subquery()
+            count_statement = select(func.count().label("count")).select_from(
+                count_subquery
             )
-
-            # If recipe_caching is installed, apply caching to this query.
-            try:
-                from recipe_caching.mappers import FromCache
-
-                count_query = count_query.options(
-                    FromCache(self._cache_region, cache_prefix=self._cache_prefix)
+            if ttl is None:
+                count, _ = self._cached(
+                    count_statement,
+                    lambda: self._fetch_count(count_statement, count_subquery),
                 )
-            except ImportError:
-                pass
-
-            count = count_query.scalar()
-            if query is not None:
+            else:
+                count = self._shared_count(
+                    count_statement, count_subquery, ttl, refresh
+                )
+            self.stats.counttime += time.time() - starttime
+            if not recipe_query:
                 return count
             self._total_count = count
         return self._total_count
 
+    def estimated_count(self, query=None):
+        """Return the database's query planner estimate of the number of
+        rows that would be returned by this Recipe, ignoring any `limit`.
+
+        Estimates are available on PostgreSQL. Returns None if the database
+        can't estimate.
+        """
+        if query is None:
+            query = self.query()
+        connection = self._get_connection()
+        if connection.dialect.name != "postgresql":
+            return None
+
+        statement = query.limit(None).offset(None).order_by(None).statement
+        compiled = statement.compile(
+            dialect=connection.dialect, compile_kwargs={"render_postcompile": True}
+        )
+        plan = connection.exec_driver_sql(
+            f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params
+        ).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def _shared_count(self, count_statement, count_subquery, ttl, refresh):
+        """Return a count that is cached for ttl seconds, recounting counts
+        older than refresh seconds in the background."""
+        cache = get_cache_region(self._cache_region) or count_cache
+        # Result cache keys include the database identity, so counts are
+        # only shared between recipes on the same database and schemas
+        key = "count:" + self._result_cache_key(count_statement)
+        (count, counted_at), from_cache = self._cached(
+            count_statement,
+            lambda: (self._fetch_count(count_statement, count_subquery), time.time()),
+            ttl=ttl,
+            key=key,
+            cache=cache,
+        )
+        if from_cache and refresh is not None and time.time() - counted_at > refresh:
+            bind = self._bind()
+            engine = getattr(bind, "engine", bind)
+
+            def recount():
+                with engine.connect() as connection, load_value_tables(
+                    connection, count_statement
+                ):
+                    value = connection.execute(count_statement).scalar()
+                cache.set(key, (value, time.time()), ttl=ttl)
+
+            refresh_in_background(key, recount)
+        return count
+
+    def _fetch_count(self, count_statement, count_subquery):
+        """Count the rows in a subquery using the execution mode."""
+        self._emit("before_execute", statement=count_statement)
+        starttime = time.time()
+        with load_value_tables(self._get_connection(), count_statement):
+            count = self._fetch_count_rows(count_statement, count_subquery)
+        self._emit(
+            "after_execute", time.time() - starttime, statement=count_statement
+        )
+        return count
+
+    def _fetch_count_rows(self, count_statement, count_subquery):
+        if self._execution_mode == "core":
+            return self._execute(count_statement).scalar()
+
+        count_query = self._session.query(func.count().label("count")).select_from(
+            count_subquery
+        )
+
+        # If recipe_caching is installed, apply caching to this query.
+        try:
+            from recipe_caching.mappers import FromCache
+
+            count_query = count_query.options(
+                FromCache(self._cache_region, cache_prefix=self._cache_prefix)
+            )
+        except ImportError:
+            pass
+
+        return count_query.scalar()
+
     def reset(self):
         self._query = None
+        self._fingerprint = None
         self._all = None
         self._total_count = None
         return self
@@ -257,6 +480,33 @@ class Recipe(object):
         assert isinstance(value, bool)
         self._use_cache = value
 
+    @recipe_arg()
+    def cache_ttl(self, value) -> Recipe:
+        """The number of seconds to keep results in the result cache. If
+        None, the cache backend's default is used."""
+        assert value is None or isinstance(value, (int, float))
+        self._cache_ttl = value
+
+    @recipe_arg()
+    def incremental_cache(self, value=True) -> Recipe:
+        """Cache results for a date dimension in time partitions.
+
+        Results for periods before the current period of the dimension's
+        ``date_aggregation`` are complete, so they are cached forever in the
+        recipe's cache region. Only the current period is queried. The
+        partitions are merged before the results are enchanted.
+
+        Recipes that have limits or offsets, extensions that modify the
+        final query, or orderings that don't start with the date dimension
+        are queried normally.
+
+        :param value: True to use the first dimension that has a date or
+            datetime datatype and a ``date_aggregation``, the id of a
+            dimension to use, or False
+        """
+        assert isinstance(value, (bool, str))
+        self._incremental_cache = value
+
     @recipe_arg()
     def allow_multiple_tables(self, value: bool) -> Recipe:
         self._allow_multiple_tables = value
@@ -361,6 +611,27 @@ class Recipe(object):
     def session(self, session) -> Recipe:
         self._session = session
 
+    @recipe_arg()
+    def execution_mode(self, value: str) -> Recipe:
+        """Choose how the recipe's query is executed.
+
+        "orm" (the default) runs the recipe's ORM query in the session.
+        "core" runs the query's Core select statement directly on a
+        connection, skipping ORM result processing. All extensions are
+        supported in both modes.
+
+        :param value: One of "orm" or "core"
+        :type value: str
+        """
+        assert value in ("orm", "core")
+        self._execution_mode = value
+
+    @recipe_arg()
+    def connection(self, connection) -> Recipe:
+        """A SQLAlchemy Connection to use when the execution mode is "core".
+        If no connection is set, the session's connection will be used."""
+        self._connection = connection
+
     @recipe_arg()
     def limit(self, limit) -> Recipe:
         """Limit the number of rows returned from the database.
@@ -438,30 +709,97 @@ class Recipe(object):
         self._select = sel
         return self._select
 
-    def query(self):
-        """
-        Generates a query using the ingredients supplied by the recipe.
+    def _template_key(self):
+        """Describe the structure of this recipe's query ignoring the
+        values that are bound into the query.
 
-        :return: A SQLAlchemy query
+        :return: A tuple of a hashable key and a list of the bound parameters
+            used by the ingredients in the same order as the key.
         """
-        if self._query is not None:
-            return self._query
-
-        if hasattr(self, "optimize_redshift"):
-            self.optimize_redshift(self._is_redshift())
-
-        if len(self._cauldron.ingredients()) == 0:
-            raise BadRecipe("No ingredients have been added to this recipe")
-
-        # Step 1: Gather up global filters and user filters and
-        # apply them as if they had been added to recipe().filters(...)
+        from recipe.extensions import RecipeExtension
 
         for extension in self.recipe_extensions:
-            extension.add_ingredients()
-
-        # Step 2: Build the query (now that it has all the filters
-        # and apply any blend recipes
-
+            if (
+                type(extension).modify_recipe_parts
+                is not RecipeExtension.modify_recipe_parts
+            ):
+                # We can't describe what the extension does to the parts
+                raise NotTemplatable(type(extension).__name__)
+
+        bindparams = []
+        structure = [
+            tuple(type(extension) for extension in self.recipe_extensions),
+            tuple(self._order_bys),
+            self._allow_multiple_tables,
+            self._shelf.Meta.engine,
+        ]
+        if self._select_from is not None:
+            structure.append(element_key(self._select_from, bindparams))
+
+        filters = []
+        for ingr in self._cauldron.ingredients():
+            if ingr.error:
+                raise NotTemplatable(ingr.id)
+            ingr_bindparams = []
+            ingr_key = (
+                type(ingr),
+                ingr.make_column_suffixes(),
+                ingr.ordering,
+                ingr.group_by_strategy,
+                tuple(element_key(c, ingr_bindparams) for c in ingr.columns),
+                tuple(element_key(c, ingr_bindparams) for c in ingr.group_by),
+                tuple(element_key(f, ingr_bindparams) for f in ingr.filters),
+                tuple(element_key(h, ingr_bindparams) for h in ingr.havings),
+            )
+            if isinstance(ingr, (Filter, Having)):
+                filters.append((ingr_key, ingr_bindparams))
+            else:
+                structure.append((ingr.id, ingr_key))
+                bindparams.extend(ingr_bindparams)
+
+        # Filters are often constructed with random ids that don't appear in
+        # the query so order them by their structure instead.
+        filters.sort(key=lambda f: hash(f[0]))
+        for (key, _), (next_key, _) in zip(filters, filters[1:]):
+            if hash(key) == hash(next_key) and key != next_key:
+                raise NotTemplatable("Filter structures can not be ordered")
+        for key, filter_bindparams in filters:
+            structure.append(key)
+            bindparams.extend(filter_bindparams)
+
+        return tuple(structure), bindparams
+
+    def _simplify_filters(self):
+        """Simplify the filters of the ingredients in the cauldron together.
+
+        A filter that is merged into an earlier filter is removed from its
+        ingredient.
+        """
+        ingredients = [ingr for ingr in self._cauldron.ingredients() if ingr.filters]
+        conditions = [c for ingr in ingredients for c in ingr.filters]
+        simplified = iter(simplify_filters(conditions))
+        for ingr in ingredients:
+            filters = [next(simplified) for _ in ingr.filters]
+            if any(f is not c for f, c in zip(filters, ingr.filters)):
+                ingr.filters = [f for f in filters if f is not None]
+
+    def _pad_in_lists(self):
+        """Pad the values of in and notin conditions in the cauldron's
+        filters and havings for the recipe's database."""
+        dialect_name = self._bind().dialect.name
+        bin_size = IN_LIST_BIN_SIZES.get(dialect_name)
+        max_size = IN_LIST_MAX_SIZES.get(dialect_name, DEFAULT_IN_LIST_MAX_SIZE)
+        for ingr in self._cauldron.ingredients():
+            for attr_name in ("filters", "havings"):
+                conditions = getattr(ingr, attr_name)
+                padded = [pad_in_lists(c, bin_size, max_size) for c in conditions]
+                if any(p is not c for p, c in zip(padded, conditions)):
+                    setattr(ingr, attr_name, padded)
+
+    def _build_recipe_parts(self):
+        """Build a query from the ingredients in the cauldron. This
+        query has not had postquery extensions, limits or offsets applied.
+        """
         # Get the parts of the query from the cauldron
         # {
         #             "columns": columns,
@@ -470,13 +808,14 @@ class Recipe(object):
         #             "havings": havings,
         #             "order_bys": list(order_bys)
         #         }
-
-        # Ensure the cauldron and shelf have the same engine
-        self._cauldron.Meta.engine = self._shelf.Meta.engine
+        phasetime = time.time()
         recipe_parts = self._cauldron.brew_query_parts(self._order_bys)
+        self.stats.brewtime = time.time() - phasetime
 
+        phasetime = time.time()
         for extension in self.recipe_extensions:
             recipe_parts = extension.modify_recipe_parts(recipe_parts)
+        self.stats.modifytime = time.time() - phasetime
 
         # Start building the query
         query = self._session.query(*recipe_parts["columns"])
@@ -485,7 +824,7 @@ class Recipe(object):
 
         # To build a deterministic query, we must sort our filters
         filts = list(recipe_parts["filters"])
-        sorted_filts = sorted(filts, key=lambda f: filter_to_string(f))
+        sorted_filts = sorted(filts, key=filter_key)
 
         recipe_parts["query"] = (
             query.group_by(*recipe_parts["group_bys"])
@@ -514,14 +853,112 @@ class Recipe(object):
                 f"Recipes must use ingredients that all come from the same table. \n"
                 f"Details on this recipe:\n{str(self._cauldron)}"
             )
+        return recipe_parts
+
+    def _save_template(self, template_key, recipe_parts, bindparams):
+        """Save the built recipe parts as a template for recipes with the
+        same structure."""
+        cache_key = recipe_parts["query"].statement._generate_cache_key()
+        if cache_key is None:
+            return
+        # If a filter was dropped while building the query (for instance,
+        # because it duplicated another filter) the template can't be reused.
+        used_keys = {b.key for b in cache_key.bindparams}
+        if any(b.key not in used_keys for b in bindparams):
+            return
+        template_parts = dict(recipe_parts)
+        template_parts["query"] = recipe_parts["query"].with_session(None)
+        template_cache.set(template_key, QueryTemplate(template_parts, bindparams))
+
+    def _recipe_parts_from_template(self, template, bindparams):
+        """Bind the values used in this recipe into a query template."""
+        recipe_parts = {k: copy(v) for k, v in template.recipe_parts.items()}
+        recipe_parts["query"] = (
+            template.recipe_parts["query"]
+            .with_session(self._session)
+            .params(bind_template(template, bindparams))
+        )
+        ingredients = self._cauldron.ingredients()
+        recipe_parts["filters"] = {f for ingr in ingredients for f in ingr.filters}
+        recipe_parts["havings"] = {h for ingr in ingredients for h in ingr.havings}
+        return recipe_parts
+
+    def query(self):
+        """
+        Generates a query using the ingredients supplied by the recipe.
+
+        :return: A SQLAlchemy query
+        """
+        if self._query is not None:
+            return self._query
+
+        starttime = time.time()
+        self.stats.brewtime = self.stats.modifytime = 0.0
+        self.stats.cachekeytime = self.stats.counttime = 0.0
+        if hasattr(self, "optimize_redshift"):
+            self.optimize_redshift(self._is_redshift())
+
+        if len(self._cauldron.ingredients()) == 0:
+            raise BadRecipe("No ingredients have been added to this recipe")
+
+        # Step 1: Gather up global filters and user filters and
+        # apply them as if they had been added to recipe().filters(...)
+        phasetime = time.time()
+        for extension in self.recipe_extensions:
+            extension.add_ingredients()
+        self.stats.ingredienttime = time.time() - phasetime
+
+        if ALLOW_FILTER_SIMPLIFICATION:
+            self._simplify_filters()
+        if ALLOW_IN_LIST_PADDING:
+            self._pad_in_lists()
+
+        # Step 2: Build the query (now that it has all the filters
+        # and apply any blend recipes
+
+        # Ensure the cauldron and shelf have the same engine
+        self._cauldron.Meta.engine = self._shelf.Meta.engine
+
+        # Recipes with the same structure share a query template
+        template_key = bindparams = None
+        if ALLOW_QUERY_CACHING:
+            with contextlib.suppress(NotTemplatable):
+                template_key, bindparams = self._template_key()
+
+        template = None
+        if template_key is not None:
+            template = template_cache.get(template_key)
+            self.stats.statement_shapes = statement_shapes.record(
+                template_key, statement_shape(bindparams)
+            )
+
+        if template is not None:
+            recipe_parts = self._recipe_parts_from_template(template, bindparams)
+        else:
+            recipe_parts = self._build_recipe_parts()
+            if template_key is not None:
+                self._save_template(template_key, recipe_parts, bindparams)
+
+        # A grouped recipe with a filter that is always false returns no
+        # rows. An ungrouped aggregate still returns one row, so it is
+        # queried.
+        self._empty = bool(recipe_parts["group_bys"]) and any(
+            always_false(f) for f in recipe_parts["filters"]
+        )
 
+        phasetime, counttime = time.time(), self.stats.counttime
         for extension in self.recipe_extensions:
             recipe_parts = extension.modify_postquery_parts(recipe_parts)
+        self.stats.postquerytime = (
+            time.time() - phasetime - (self.stats.counttime - counttime)
+        )
 
+        phasetime = time.time()
         if "recipe" not in recipe_parts:
             recipe_parts["cache_region"] = self._cache_region
             recipe_parts["cache_prefix"] = self._cache_prefix
         recipe_parts = run_hooks(recipe_parts, "modify_query", self.dynamic_extensions)
+        self.stats.hooktime = time.time() - phasetime
 
         # Apply limit on the outermost query
         # This happens after building the comparison recipe
@@ -535,6 +972,9 @@ class Recipe(object):
         # cache results
 
         self._query = recipe_parts["query"]
+        self._fingerprint = None
+        self.stats.buildtime = time.time() - starttime
+        self._emit("query_built", self.stats.buildtime, stats=self.stats)
         return self._query
 
     def _table(self):
@@ -546,9 +986,18 @@ class Recipe(object):
         else:
             return None
 
-    def to_sql(self):
-        """A string representation of the SQL this recipe will generate."""
-        return prettyprintable_sql(self.query())
+    def to_sql(self, reindent=True):
+        """A string representation of the SQL this recipe will generate.
+
+        :param reindent: If False, don't reformat the SQL. This is much
+            faster for large queries.
+        :type reindent: bool
+        """
+        query = self.query()
+        starttime = time.time()
+        sql = prettyprintable_sql(query, reindent=reindent)
+        self._emit("sql_compiled", time.time() - starttime, sql=sql)
+        return sql
 
     def subquery(self, name=None):
         """The recipe's query as a subquery suitable for use in joins or other
@@ -561,31 +1010,574 @@ class Recipe(object):
         """Return an alias to a table"""
         return alias(self.subquery(), name=name or self._id)
 
+    def _emit(self, name, elapsed=None, **info):
+        """Send an event to anything listening for it."""
+        if not self.events.listening(name):
+            return
+        if self._fingerprint is None and self._query is not None:
+            bind = self._bind()
+            sql = str(self._query.statement.compile(dialect=bind.dialect))
+            self._fingerprint = hashlib.sha1(sql.encode("utf-8")).hexdigest()[:16]
+        event = RecipeEvent(name, self._id, self._fingerprint, elapsed, info)
+        self.events.emit(event)
+
+    def _get_connection(self):
+        """The connection the recipe's queries run on."""
+        if self._connection is not None:
+            return self._connection
+        return self._session.connection()
+
+    def _execute(self, statement):
+        """Execute a Core statement on the recipe's connection."""
+        return self._get_connection().execute(statement)
+
+    def _bind(self):
+        """The engine or connection the recipe runs on."""
+        if self._connection is not None:
+            return self._connection
+        return self._session.get_bind()
+
+    def _bind_identity(self, bind=None):
+        """Identify the database the recipe runs on within this process.
+
+        Engines are identified by the engine object rather than the URL,
+        because separate engines can share a URL (such as in-memory SQLite
+        databases) and the URL's repr hides the password. The schema
+        translate map is included because it changes the tables a
+        statement reads.
+        """
+        if bind is None:
+            bind = self._bind()
+        engine = getattr(bind, "engine", bind)
+        translate_map = bind.get_execution_options().get("schema_translate_map")
+        return id(engine), sorted((translate_map or {}).items(), key=repr)
+
+    def _result_cache_key(self, statement, bind=None):
+        """Compile a statement into a result cache key."""
+        starttime = time.time()
+        bind = self._bind() if bind is None else bind
+        key = result_cache_key(
+            statement,
+            bind.dialect,
+            prefix=self._cache_prefix,
+            identity=database_identity(bind),
+        )
+        elapsed = time.time() - starttime
+        self.stats.cachekeytime += elapsed
+        self._emit("sql_compiled", elapsed, statement=statement, key=key)
+        return key
+
+    def _cached(self, statement, fetch, ttl=None, store=True, key=None, cache=None):
+        """Return a tuple of the value fetched by ``fetch`` for a statement and
+        whether the value came from the result cache.
+
+        Values are stored for ``ttl`` seconds (or the recipe's ``cache_ttl``)
+        in the backend configured for the recipe's cache region. If
+        ``use_cache`` is False, the cache is not read but the fetched value
+        is stored. If ``store`` is False the cache is not used. A ``cache``
+        backend can be given to use instead of the region's. Concurrent
+        fetches of the same statement on the same database share one
+        execution.
+        """
+        if cache is None and store:
+            cache = get_cache_region(self._cache_region)
+        if cache is None and not ALLOW_QUERY_COALESCING:
+            return fetch(), False
+
+        bind = self._bind()
+        if key is None:
+            key = self._result_cache_key(statement, bind)
+        if ALLOW_QUERY_COALESCING:
+            fetch = partial(
+                single_flight.do, f"{self._bind_identity(bind)!r}:{key}", fetch
+            )
+        if cache is None:
+            return fetch(), False
+
+        if self._use_cache:
+            value = cache.get(key)
+            if value is not NO_VALUE:
+                self._emit("cache_hit", statement=statement, key=key)
+                return value, True
+            self._emit("cache_miss", statement=statement, key=key)
+        value = fetch()
+        cache.set(key, value, ttl=self._cache_ttl if ttl is None else ttl)
+        return value, False
+
+    def _fetch_rows(self, query):
+        """Fetch all rows for a query using the execution mode."""
+        self._emit("before_execute", statement=query.statement)
+        starttime = time.time()
+        with load_value_tables(self._get_connection(), query.statement):
+            if self._execution_mode == "core":
+                rows = self._execute(query.statement).fetchall()
+            else:
+                rows = query.all()
+        self._emit(
+            "after_execute", time.time() - starttime, statement=query.statement
+        )
+        return rows
+
+    def _fetch(self):
+        """Fetch all rows for the recipe's query using the execution mode and
+        the result cache."""
+        if self._empty:
+            self._fetched_from_cache = False
+            return []
+
+        incremental = self._incremental_dimension()
+        if incremental is not None:
+            return self._fetch_incremental(*incremental)
+
+        query = self._query
+        cache = get_cache_region(self._cache_region)
+        if cache is None:
+            rows, from_cache = self._cached(
+                query.statement, lambda: self._fetch_rows(query)
+            )
+            self._fetched_from_cache = from_cache or getattr(
+                self._query, "fetched_from_cache", False
+            )
+            return rows
+
+        signature = self._semantic_signature() if ALLOW_REAGGREGATION else None
+        reaggregated = False
+
+        def fetch():
+            nonlocal reaggregated
+            if signature is not None:
+                frozen = self._reaggregate_cached(cache, signature)
+                if frozen is not None:
+                    reaggregated = True
+                    return frozen
+            return freeze_rows(self._fetch_rows(query))
+
+        key = self._result_cache_key(query.statement)
+        frozen, from_cache = self._cached(query.statement, fetch, key=key)
+        if signature is not None and not from_cache:
+            self._register_semantic(cache, signature, key)
+        self._fetched_from_cache = from_cache or reaggregated
+        return thaw_rows(frozen)
+
+    def _semantic_signature(self):
+        """Describe the recipe's results for re-aggregation.
+
+        Returns a tuple of a key shared by recipes that select from the same
+        data with the same filters, a dictionary of dimension id to a key
+        for the dimension and its labels, and a dictionary of metric id to
+        a key for the metric, its labels and how it can be re-aggregated.
+        Returns None if the results can't be described.
+        """
+        from recipe.extensions import RecipeExtension
+
+        if not self._has_plain_results():
+            return None
+        for extension in self.recipe_extensions:
+            if (
+                type(extension).modify_recipe_parts
+                is not RecipeExtension.modify_recipe_parts
+            ):
+                return None
+
+        dimensions, metrics, filters = {}, {}, []
+        try:
+            for ingredient in self._cauldron.ingredients():
+                if isinstance(ingredient, Filter):
+                    filters.extend(filter_key(f) for f in ingredient.filters)
+                    continue
+                if ingredient.filters or ingredient.havings:
+                    return None
+                bindparams = []
+                keys = [element_key(c, bindparams) for c in ingredient.columns]
+                key = repr((keys, [bp.effective_value for bp in bindparams]))
+                labels = tuple(
+                    ingredient.id + suffix
+                    for suffix in ingredient.make_column_suffixes()
+                )
+                if isinstance(ingredient, Dimension):
+                    dimensions[ingredient.id] = (key, labels)
+                elif isinstance(ingredient, Metric) and len(ingredient.columns) == 1:
+                    aggregation = metric_aggregation(ingredient.columns[0])
+                    metrics[ingredient.id] = (key, labels, aggregation)
+                else:
+                    return None
+            select_from = None
+            if self._select_from is not None:
+                bindparams = []
+                select_from = (
+                    repr(element_key(self._select_from, bindparams)),
+                    [bp.effective_value for bp in bindparams],
+                )
+        except NotTemplatable:
+            return None
+
+        bind = self._bind()
+        family = repr(
+            (
+                database_identity(bind),
+                bind.dialect.name,
+                self._cache_prefix,
+                select_from,
+                sorted(map(repr, filters)),
+            )
+        )
+        family = hashlib.sha256(family.encode("utf-8")).hexdigest()
+        return f"{self._cache_prefix}:semantic:{family}", dimensions, metrics
+
+    def _register_semantic(self, cache, signature, key):
+        """Record the dimensions and metrics of a cached result."""
+        index_key, dimensions, metrics = signature
+        index = cache.get(index_key)
+        if index is NO_VALUE:
+            index = []
+        if any(entry[0] == key for entry in index):
+            return
+        index.append((key, dimensions, metrics))
+        cache.set(index_key, index[-SEMANTIC_INDEX_SIZE:], ttl=self._cache_ttl)
+
+    def _reaggregate_cached(self, cache, signature):
+        """Build the recipe's results by grouping a cached result that
+        has more dimensions. Returns frozen rows or None."""
+        index_key, dimensions, metrics = signature
+        if not self._use_cache:
+            return None
+        aggregations = {}
+        for key, labels, aggregation in metrics.values():
+            if aggregation is None:
+                return None
+            for label in labels:
+                aggregations[label] = aggregation
+
+        index = cache.get(index_key)
+        if index is NO_VALUE:
+            return None
+        for result_key, cached_dimensions, cached_metrics in reversed(index):
+            if len(cached_dimensions) <= len(dimensions):
+                continue
+            if any(cached_dimensions.get(k) != v for k, v in dimensions.items()):
+                continue
+            if any(cached_metrics.get(k) != v for k, v in metrics.items()):
+                continue
+            cached = cache.get(result_key)
+            if cached is NO_VALUE:
+                continue
+            if not dimensions and not cached[1]:
+                # An ungrouped query always returns a row
+                return None
+            fields = [c.key for c in self._query.statement.selected_columns]
+            group_fields = [
+                label for _, labels in dimensions.values() for label in labels
+            ]
+            frozen = reaggregate(cached, fields, group_fields, aggregations)
+            return self._sort_frozen(frozen)
+        return None
+
+    def _sort_frozen(self, frozen):
+        """Sort frozen rows using the recipe's ordering. Returns None if
+        the rows can't be ordered the same way the database would, because
+        an ordering column contains nulls or strings."""
+        fields, values = frozen
+        index = {field: i for i, field in enumerate(fields)}
+
+        order_bys = list(self._order_bys)
+        for ingredient in self._cauldron.ingredients():
+            if "order_by" in ingredient.roles and ingredient.id not in [
+                key.lstrip("-") for key in order_bys
+            ]:
+                order_bys.append(ingredient.id)
+
+        sort_keys = []
+        for key in order_bys:
+            try:
+                ingredient = self._cauldron.find(key, (Dimension, Metric))
+            except BadRecipe:
+                continue
+            descending = ingredient.ordering == "desc"
+            labels = [ingredient.id + s for s in ingredient.make_column_suffixes()]
+            for label in reversed(labels):
+                sort_keys.append((index[label], descending))
+
+        for i, _ in sort_keys:
+            # Databases disagree about how nulls are ordered, and strings are
+            # ordered by the database's collation
+            if any(row[i] is None or isinstance(row[i], str) for row in values):
+                return None
+        try:
+            for i, descending in reversed(sort_keys):
+                values.sort(key=itemgetter(i), reverse=descending)
+        except TypeError:
+            return None
+        return fields, values
+
+    def _has_plain_results(self):
+        """True if the recipe's results are all the groups of its ingredients,
+        without limits or extensions that modify the final query."""
+        from recipe.extensions import RecipeExtension
+
+        if (
+            self._query._limit_clause is not None
+            or self._query._offset_clause is not None
+        ):
+            return False
+        if self.dynamic_extensions:
+            return False
+        for extension in self.recipe_extensions:
+            if (
+                type(extension).modify_postquery_parts
+                is not RecipeExtension.modify_postquery_parts
+            ):
+                return False
+        return True
+
+    def _incremental_dimension(self):
+        """Return a tuple of the date dimension to use for incremental caching,
+        its date_aggregation and datatype and whether results are ordered
+        by the dimension descending. Returns None if the recipe's results
+        can't be cached incrementally.
+        """
+        if not self._incremental_cache:
+            return None
+        if get_cache_region(self._cache_region) is None:
+            return None
+        # Partitions can only be concatenated if nothing limits or
+        # post-processes the full query
+        if not self._has_plain_results():
+            return None
+
+        for dimension in self._cauldron.ingredients():
+            if not isinstance(dimension, Dimension):
+                continue
+            if self._incremental_cache not in (True, dimension.id):
+                continue
+            date_aggregation = dimension.meta.get("date_aggregation")
+            datatype = determine_datatype(dimension)
+            if date_aggregation in ("year", "month", "day") and datatype in (
+                "date",
+                "datetime",
+            ):
+                break
+        else:
+            return None
+
+        # Concatenating partitions keeps rows in order if results are ordered
+        # by the date dimension first.
+        order_bys = list(self._order_bys)
+        if not order_bys:
+            if any("order_by" in i.roles for i in self._cauldron.ingredients()):
+                return None
+            return dimension, date_aggregation, datatype, False
+        if "order_by" in dimension.roles or order_bys[0].lstrip("-") != dimension.id:
+            return None
+        return dimension, date_aggregation, datatype, order_bys[0].startswith("-")
+
+    def _fetch_incremental(self, dimension, date_aggregation, datatype, descending):
+        """Fetch rows for the recipe's query in time partitions.
+
+        Closed partitions are complete, so they are fetched from the result
+        cache and kept forever. The open partition is always queried.
+        """
+        expression = dimension.roles["value"]
+        type_ = DateTime() if datatype == "datetime" else Date()
+
+        partitions = time_partitions(date.today(), date_aggregation, datatype)
+        if descending:
+            partitions.reverse()
+
+        rows, from_cache = [], True
+        for start, end, closed in partitions:
+            query = self._query
+            if start is not None:
+                query = query.filter(expression >= literal(start, type_))
+            if end is not None:
+                query = query.filter(expression < literal(end, type_))
+
+            fetch = partial(self._fetch_rows, query)
+            if closed:
+                frozen, hit = self._cached(
+                    query.statement, lambda: freeze_rows(fetch()), ttl=FOREVER
+                )
+                rows.extend(thaw_rows(frozen))
+                from_cache = from_cache and hit
+            else:
+                partition_rows, _ = self._cached(query.statement, fetch, store=False)
+                rows.extend(partition_rows)
+                from_cache = False
+        self._fetched_from_cache = from_cache
+        return rows
+
+    def _fetch_enchanted(self, columnar=False):
+        """Fetch and enchant the recipe's rows, recording stats and emitting
+        events. Returns rows, or a dictionary of columns if ``columnar``."""
+        starttime = time.time()
+        if not self._use_cache and hasattr(self._query, "invalidate"):
+            self._query.invalidate()
+
+        rows = self._fetch()
+        fetchtime = time.time()
+        self.stats.dbtime = fetchtime - starttime
+        self.stats.from_cache = self._fetched_from_cache
+        self._emit("rows_fetched", self.stats.dbtime, rows=len(rows))
+        enchanted = self._cauldron.enchant(
+            rows, cache_context=self.cache_context, columnar=columnar
+        )
+        self.stats.enchanttime = time.time() - fetchtime
+        self.stats.result_bytes = _result_bytes(rows)
+        self._emit("enchanted", self.stats.enchanttime, rows=len(rows))
+        return enchanted
+
+    def _reuse_fetched(self):
+        """Record stats for results that were already fetched."""
+        self.stats.dbtime = self.stats.enchanttime = 0.0
+        self.stats.from_cache = True
+
     def all(self):
         """Return a (potentially cached) list of result objects."""
-        starttime = fetchtime = enchanttime = time.time()
         self.query()
 
         if self._all is None:
-            fetchtime = time.time()
-            if not self._use_cache and hasattr(self._query, "invalidate"):
-                self._query.invalidate()
-
-            self._all = self._cauldron.enchant(
-                self._query.all(), cache_context=self.cache_context
-            )
-            enchanttime = time.time()
-            fetched_from_cache = getattr(self._query, "fetched_from_cache", False)
+            self._all = self._fetch_enchanted()
         else:
-            fetched_from_cache = True
+            self._reuse_fetched()
 
         self.stats.rows = len(self._all)
-        self.stats.dbtime = fetchtime - starttime
-        self.stats.enchanttime = enchanttime - fetchtime
-        self.stats.from_cache = fetched_from_cache
 
         return self._all
 
+    def columns(self, numpy=False):
+        """Return the results as a dictionary of field name to a list of
+        values.
+
+        Formatters are applied column-wise and no row objects are built.
+        If the recipe has no results an empty dictionary is returned.
+
+        :param numpy: If True, return NumPy arrays with dtypes determined
+            by each ingredient's datatype. Requires NumPy.
+        :type numpy: bool
+        """
+        self.query()
+
+        if self._all is None:
+            columns = self._fetch_enchanted(columnar=True)
+        else:
+            columns = {}
+            if self._all:
+                columns = dict(
+                    zip(self._all[0]._fields, map(list, zip(*self._all)))
+                )
+            self._reuse_fetched()
+
+        self.stats.rows = len(next(iter(columns.values()), ()))
+
+        if numpy:
+            datatypes = self._cauldron.field_datatypes()
+            columns = {
+                field: numpy_array(values, datatypes.get(field))
+                for field, values in columns.items()
+            }
+        return columns
+
+    def _fetch_batches(self, batch_size):
+        """Yield lists of rows for the recipe's query, streaming results from
+        the database where the database supports it."""
+        if self._empty:
+            return
+        if self._execution_mode == "core":
+            statement = self._query.statement.execution_options(
+                stream_results=True, max_row_buffer=batch_size
+            )
+            yield from self._execute(statement).partitions(batch_size)
+        else:
+            rows = iter(self._query.yield_per(batch_size))
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                yield batch
+
+    def iter(self, batch_size=1000):
+        """Iterate over result objects without holding the full result in
+        memory.
+
+        Rows are fetched and enchanted in batches of ``batch_size``. If the
+        recipe has already been run with ``all()`` those results are
+        used. Stats are updated when iteration finishes.
+        """
+        if self._all is not None:
+            yield from self.all()
+            return
+
+        self.query()
+        self.stats.rows = self.stats.result_bytes = 0
+        self.stats.dbtime = self.stats.enchanttime = 0.0
+        self.stats.from_cache = False
+        self._emit("before_execute", statement=self._query.statement)
+        try:
+            batches = self._fetch_batches(batch_size)
+            while True:
+                starttime = time.time()
+                batch = next(batches, None)
+                fetchtime = time.time()
+                self.stats.dbtime += fetchtime - starttime
+                if batch is None:
+                    self._emit(
+                        "after_execute",
+                        self.stats.dbtime,
+                        statement=self._query.statement,
+                    )
+                    break
+                self.stats.result_bytes += _result_bytes(batch)
+                self._emit("rows_fetched", fetchtime - starttime, rows=len(batch))
+                fetchtime = time.time()
+                enchanted = self._cauldron.enchant(
+                    batch, cache_context=self.cache_context
+                )
+                enchanttime = time.time() - fetchtime
+                self.stats.enchanttime += enchanttime
+                self.stats.rows += len(enchanted)
+                self._emit("enchanted", enchanttime, rows=len(enchanted))
+                yield from enchanted
+        finally:
+            self.stats.from_cache = getattr(self._query, "fetched_from_cache", False)
+
+    def export(self, fp, format="csv", batch_size=1000):
+        """Write the results to a text file object without holding the full
+        result in memory.
+
+        Rows are streamed from the database with ``iter`` and written to
+        ``fp`` each time ``batch_size`` rows have been buffered.
+
+        :param fp: A writable text file object
+        :param format: One of "csv" or "jsonl"
+        :type format: str
+        :param batch_size: The number of rows to fetch and buffer before
+            writing to ``fp``
+        :type batch_size: int
+        :return: The number of rows written
+        """
+        if format not in ("csv", "jsonl"):
+            raise BadRecipe(f"Unknown export format {format}")
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        count = 0
+        for row in self.iter(batch_size=batch_size):
+            if format == "csv":
+                if count == 0:
+                    writer.writerow(row._fields)
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(row._asdict(), default=str))
+                buffer.write("\n")
+            count += 1
+            if count % batch_size == 0:
+                fp.write(buffer.getvalue())
+                buffer.seek(0)
+                buffer.truncate()
+        fp.write(buffer.getvalue())
+        if hasattr(fp, "flush"):
+            fp.flush()
+        return count
+
     def one(self):
         """Return the first element on the result"""
         all = self.all()
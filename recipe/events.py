@@ -0,0 +1,93 @@
+"""
+Listeners for events in the lifecycle of a recipe.
+
+Listeners can be attached to a single recipe with ``recipe.events.on`` or to
+every recipe with ``events.on`` from this module. Events are only built when
+something is listening for them, so recipes with no listeners don't pay
+for them.
+"""
+from collections import namedtuple
+
+from recipe.exceptions import BadRecipe
+
+# The events a recipe emits
+#
+# query_built: The recipe's query has been built
+# sql_compiled: The recipe compiled its query into SQL
+# before_execute: A statement is about to run on the database
+# after_execute: A statement finished running on the database
+# rows_fetched: The recipe's rows have been fetched
+# enchanted: The recipe's rows have been enchanted
+# cache_hit: A statement's results were found in the result cache
+# cache_miss: A statement's results were not found in the result cache
+EVENT_NAMES = (
+    "query_built",
+    "sql_compiled",
+    "before_execute",
+    "after_execute",
+    "rows_fetched",
+    "enchanted",
+    "cache_hit",
+    "cache_miss",
+)
+
+# An event passed to listeners.
+#
+# name: The name of the event
+# recipe_id: The ``_id`` of the recipe that emitted the event
+# fingerprint: A hash of the recipe's SQL that does not depend on the values
+#   bound into the query
+# elapsed: The time in seconds the step that emitted the event took or None
+# info: A dictionary of details about the event
+RecipeEvent = namedtuple(
+    "RecipeEvent", ["name", "recipe_id", "fingerprint", "elapsed", "info"]
+)
+
+
+class RecipeEvents(object):
+    """A registry of event listeners.
+
+    :param parent: A registry whose listeners also receive this registry's
+        events.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._listeners = {}
+
+    def on(self, name, fn=None):
+        """Call ``fn`` with a RecipeEvent each time the event ``name`` is
+        emitted. If ``fn`` is not given, return a decorator."""
+        if name not in EVENT_NAMES:
+            raise BadRecipe(f"Unknown recipe event {name}")
+        if fn is None:
+            return lambda fn: self.on(name, fn)
+        self._listeners.setdefault(name, []).append(fn)
+        return fn
+
+    def off(self, name, fn):
+        """Stop calling ``fn`` for the event ``name``."""
+        listeners = self._listeners.get(name, [])
+        if fn in listeners:
+            listeners.remove(fn)
+        if not listeners:
+            self._listeners.pop(name, None)
+
+    def clear(self):
+        self._listeners.clear()
+
+    def listening(self, name):
+        """Is anything listening for the event ``name``?"""
+        if name in self._listeners:
+            return True
+        return self.parent is not None and self.parent.listening(name)
+
+    def emit(self, event):
+        for fn in list(self._listeners.get(event.name, ())):
+            fn(event)
+        if self.parent is not None:
+            self.parent.emit(event)
+
+
+# Listeners for events on every recipe
+events = RecipeEvents()
@@ -1,13 +1,30 @@
 import inspect
-from json import loads, JSONDecodeError
-from typing import Union
-from sqlalchemy import and_, func, text, or_, String
+import sqlite3
+import threading
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import date, datetime
+from decimal import Decimal
+from json import dumps, loads, JSONDecodeError
+from typing import Optional, Union
+from sqlalchemy import and_, case, false, func, literal, select, text, or_, tuple_, String
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.util import ClauseAdapter
 
+from recipe.caching import result_cache_key
 from recipe.core import Recipe
 from recipe.exceptions import BadRecipe
 from recipe.ingredients import ALLOWED_OPERATORS, Dimension, Ingredient, Metric, Filter
-from recipe.utils import FakerAnonymizer, recipe_arg, pad_values
+from recipe.search import value_indexes
+from recipe.utils import (
+    FakerAnonymizer,
+    large_in_list,
+    recipe_arg,
+    pad_values,
+    row_values_in,
+)
 
 Base = declarative_base()
 
@@ -183,6 +200,11 @@ class AutomaticFilters(RecipeExtension):
         "exclude_automatic_filter_keys": {"type": "list", "schema": {"type": "string"}},
         "apply_automatic_filters": {"type": "boolean"},
         "strict_automatic_filters": {"type": "boolean"},
+        "automatic_filter_list_threshold": {
+            "type": "integer",
+            "min": 0,
+            "nullable": True,
+        },
     }
 
     def __init__(self, *args, **kwargs):
@@ -193,6 +215,7 @@ class AutomaticFilters(RecipeExtension):
         self.include_keys = None
         self.strict = True
         self._optimize_redshift = False
+        self._list_threshold = None
 
     @recipe_arg()
     def from_config(self, obj):
@@ -208,6 +231,7 @@ class AutomaticFilters(RecipeExtension):
                 "exclude_automatic_filter_keys": lambda v: self.exclude_automatic_filter_keys(
                     *v
                 ),
+                "automatic_filter_list_threshold": self.automatic_filter_list_threshold,
             },
         )
 
@@ -223,8 +247,7 @@ class AutomaticFilters(RecipeExtension):
 
         will generate a filter equal to the following::
 
-            WHERE (state='California' AND age=22) OR
-                  (state='Iowa' AND age=24)
+            WHERE (state, age) IN (('California', 22), ('Iowa', 24))
 
         Optionally, the values can be a json encoded list. This value generates the same
         filtering as the example above:
@@ -232,6 +255,13 @@ class AutomaticFilters(RecipeExtension):
             key="state,age"
             values=['["California", 22]', '["Iowa", 24]']
 
+        Compound filters that use operators other than ``eq``, have missing
+        or null values, or run on a database that can't compare row values
+        generate an ``OR`` of ``AND``s::
+
+            WHERE (state='California' AND age=22) OR
+                  (state='Iowa' AND age=24)
+
         Args:
             key (str): A string containing a comma separated list of ids.
             values (list): A list of lists containing that will be matched to the ids
@@ -240,7 +270,7 @@ class AutomaticFilters(RecipeExtension):
             A SQLAlchemy boolean expression
         """
         keys = key.split(",")
-        or_items = []
+        rows = []
         for val in values:
             if isinstance(val, str):
                 try:
@@ -251,15 +281,56 @@ class AutomaticFilters(RecipeExtension):
                     raise ValueError(
                         "Compound filter values must be json encoded lists"
                     )
-            and_items = []
-            for d, v in zip(keys, val):
-                filt = self._build_automatic_filter(d, v)
-                if filt is not None:
-                    and_items.append(filt)
+            rows.append(val)
+
+        row_filters = [
+            [self._build_automatic_filter(d, v) for d, v in zip(keys, val)]
+            for val in rows
+        ]
+        condition = self._build_row_values_filter(keys, row_filters)
+        if condition is not None:
+            return condition
+
+        or_items = []
+        for filters in row_filters:
+            and_items = [filt for filt in filters if filt is not None]
             if and_items:
                 or_items.append(and_(*and_items))
         return or_(*or_items) if or_items else None
 
+    def _build_row_values_filter(self, keys, row_filters):
+        """Combine the filters built for each row of a compound filter into
+        a single row value comparison.
+
+        Returns None unless there are several rows and every filter compares
+        the same expression to a value with ``eq``.
+        """
+        if len(row_filters) < 2:
+            return None
+        columns, rows = None, []
+        for filters in row_filters:
+            if len(filters) != len(keys):
+                return None
+            for filt in filters:
+                if not (
+                    isinstance(filt, BinaryExpression)
+                    and filt.operator is operators.eq
+                    and isinstance(filt.right, BindParameter)
+                    and not filt.right.expanding
+                ):
+                    return None
+            if columns is None:
+                columns = [filt.left for filt in filters]
+            elif not all(
+                filt.left is col or filt.left.compare(col)
+                for filt, col in zip(filters, columns)
+            ):
+                return None
+            rows.append(tuple(filt.right.value for filt in filters))
+        return row_values_in(
+            columns, rows, self.recipe._bind().dialect, self._list_threshold
+        )
+
     def _build_automatic_filter(self, dim, values):
         """Build an automatic filter given a dim and a value.
 
@@ -295,7 +366,16 @@ class AutomaticFilters(RecipeExtension):
         values = clean_filtering_values(
             values, dimension, operator, self._optimize_redshift
         )
-        return dimension.build_filter(values, operator)
+        condition = dimension.build_filter(values, operator)
+        if (
+            self._list_threshold
+            and isinstance(values, (list, tuple))
+            and len(values) > self._list_threshold
+        ):
+            condition = large_in_list(
+                condition, self.recipe._bind().dialect, self._list_threshold
+            )
+        return condition
 
     def add_ingredients(self):
         if self.apply:
@@ -319,6 +399,20 @@ class AutomaticFilters(RecipeExtension):
         # can not by adjusted by user code.
         self._optimize_redshift = value
 
+    @recipe_arg()
+    def automatic_filter_list_threshold(self, value: Optional[int]):
+        """Automatic filters on lists of more than this many values
+        are not rendered into the SQL as ``IN (...)``. On PostgreSQL the
+        values are passed as a single array parameter. On other databases
+        they are loaded into a temporary table on the recipe's connection
+        when the query runs, and the table is dropped afterwards. This is
+        off by default. A threshold of None or zero disables it::
+
+            recipe.automatic_filter_list_threshold(5000)
+        """
+        assert value is None or (isinstance(value, int) and value >= 0)
+        self._list_threshold = value
+
     @recipe_arg()
     def apply_automatic_filters(self, value: bool):
         """Toggles whether automatic filters are applied to a recipe. The
@@ -581,6 +675,11 @@ class Paginate(RecipeExtension):
     Search may be disabled by setting `.apply_pagination_filters(False)`
     The value role will be targetted when searching dimensions.
 
+    Searches can be matched in memory against the distinct values of each
+    search key by setting `.pagination_search_index(ttl)`. The search is
+    then applied as an `in` filter on the matching values, and if nothing
+    matches the recipe returns no rows without querying the database.
+
     **Sorting**
 
     Pagination can override ordering applied to a recipe by setting
@@ -607,18 +706,22 @@ class Paginate(RecipeExtension):
             .pagination_search_keys("state", "sex")
 
 
-    This will generate SQL like::
+    The total number of items is counted in a separate query, which is used
+    to validate the page. The page is then fetched with SQL like::
 
         SELECT census.age AS age,
                census.sex AS sex,
                census.state AS state,
-               sum(census.population) AS population
+               sum(census.pop2000) AS pop2000
         FROM census
         WHERE lower(census.state) LIKE lower('t%')
           OR lower(census.sex) LIKE lower('t%')
-        GROUP BY census.age,
-                 census.sex,
-                 census.state
+        GROUP BY age,
+                 sex,
+                 state
+        ORDER BY state,
+                 sex,
+                 age
         LIMIT 10
         OFFSET 40
 
@@ -631,8 +734,16 @@ class Paginate(RecipeExtension):
         "pagination_default_order_by": {"type": "list", "elements": {"type": "string"}},
         "pagination_q": {"type": "string"},
         "pagination_search_keys": {"type": "list", "elements": {"type": "string"}},
+        "pagination_search_index": {"type": "integer", "min": 0},
         "pagination_page_size": {"type": "integer", "min": 0},
         "pagination_page": {"type": "integer"},
+        "pagination_count_ttl": {"type": "integer", "min": 0},
+        "pagination_count_refresh": {"type": "integer", "min": 0},
+        "pagination_count_mode": {
+            "type": "string",
+            "allowed": ["exact", "estimate", "capped"],
+        },
+        "pagination_count_cap": {"type": "integer", "min": 1},
     }
 
     def __init__(self, *args, **kwargs):
@@ -641,11 +752,17 @@ class Paginate(RecipeExtension):
         self._apply_pagination_filters = True
         self._pagination_q = ""
         self._paginate_search_keys = []
+        self._pagination_search_index = 0
         self._pagination_order_by = []
         self._pagination_default_order_by = None
         self._pagination_page_size = 0
         self._pagination_page = 1
+        self._pagination_count_ttl = 0
+        self._pagination_count_refresh = None
+        self._pagination_count_mode = "exact"
+        self._pagination_count_cap = 1000
         self._validated_pagination = None
+        self._page_clamped = False
 
     @recipe_arg()
     def from_config(self, obj):
@@ -660,8 +777,15 @@ class Paginate(RecipeExtension):
                 ),
                 "pagination_q": lambda v: self.pagination_q(v),
                 "pagination_search_keys": lambda v: self.pagination_search_keys(*v),
+                "pagination_search_index": lambda v: self.pagination_search_index(v),
                 "pagination_page_size": lambda v: self.pagination_page_size(v),
                 "pagination_page": lambda v: self.pagination_page(v),
+                "pagination_count_ttl": lambda v: self.pagination_count_ttl(v),
+                "pagination_count_refresh": lambda v: self.pagination_count_refresh(
+                    v
+                ),
+                "pagination_count_mode": lambda v: self.pagination_count_mode(v),
+                "pagination_count_cap": lambda v: self.pagination_count_cap(v),
             },
         )
 
@@ -742,6 +866,24 @@ class Paginate(RecipeExtension):
         assert isinstance(value, (list, tuple))
         self._paginate_search_keys = value
 
+    @recipe_arg()
+    def pagination_search_index(self, value: int):
+        """Match `pagination_q` against an in-process index of the distinct
+        values of each search key, reloading the values when the index is
+        older than this many seconds. A ttl of zero disables the index.
+
+        Indexes are shared by all recipes that search the same column on the
+        same database. Matching is case insensitive. Search keys with values
+        that are not strings or with more than ``value_indexes.max_values``
+        distinct values are searched in the database.
+
+        :param value: A number of seconds (zero or a positive integer)
+        :type value: integer
+        """
+        assert isinstance(value, int)
+        assert value >= 0
+        self._pagination_search_index = value
+
     @recipe_arg()
     def pagination_page_size(self, value: int):
         """Paginate recipe responses into pages of this size.
@@ -767,6 +909,111 @@ class Paginate(RecipeExtension):
         # Pagination page must be a positive integer
         self._pagination_page = max(1, value)
 
+    @recipe_arg()
+    def pagination_count_ttl(self, value: int):
+        """Share the total count of items between recipes for this many
+        seconds, so that fetching another page of the same results does not
+        count the items again. A ttl of zero disables sharing counts.
+
+        Counts are stored in the recipe's cache region or a process-wide
+        count cache if the region has no cache backend. PaginateInline and
+        PaginateCountOver count items in the page query and don't use this.
+
+        :param value: A number of seconds (zero or a positive integer)
+        :type value: integer
+        """
+        assert isinstance(value, int)
+        assert value >= 0
+        self._pagination_count_ttl = value
+
+    @recipe_arg()
+    def pagination_count_refresh(self, value: int):
+        """When counts are shared with ``pagination_count_ttl``, use counts
+        that are older than this many seconds but count the items again in
+        the background.
+
+        :param value: A number of seconds (zero or a positive integer)
+        :type value: integer
+        """
+        assert isinstance(value, int)
+        assert value >= 0
+        self._pagination_count_refresh = value
+
+    @recipe_arg()
+    def pagination_count_mode(self, value: str):
+        """How to count the total number of items.
+
+        "exact" (the default) counts every item. "estimate" uses the
+        database's query planner estimate where the database provides one
+        (PostgreSQL) and counts like "capped" otherwise. "capped" counts at
+        most ``pagination_count_cap`` items; if there are more, the total is
+        reported as the cap.
+
+        When the count is not exact, ``validated_pagination()`` includes
+        ``totalItemsApproximate`` and pages past the counted items are not
+        moved back to the last page. PaginateInline and PaginateCountOver
+        always count exactly.
+
+        :param value: One of "exact", "estimate" or "capped"
+        :type value: str
+        """
+        assert value in ("exact", "estimate", "capped")
+        self._pagination_count_mode = value
+
+    @recipe_arg()
+    def pagination_count_cap(self, value: int):
+        """The most items to count in the "capped" count mode.
+
+        :param value: A positive integer, default 1000
+        :type value: integer
+        """
+        assert isinstance(value, int)
+        assert value >= 1
+        self._pagination_count_cap = value
+
+    def _count_items(self, query):
+        """Count the items in a query using the count mode, sharing counts
+        if configured.
+
+        :return: A tuple of the count and whether the count is approximate
+        """
+        if self.recipe._empty:
+            return 0, False
+
+        mode = self._pagination_count_mode
+        if mode == "estimate":
+            estimate = self.recipe.estimated_count(query)
+            if estimate is not None:
+                return estimate, True
+            mode = "capped"
+
+        cap = self._pagination_count_cap if mode == "capped" else None
+        if self._pagination_count_ttl:
+            total_count = self.recipe.total_count(
+                query,
+                ttl=self._pagination_count_ttl,
+                refresh=self._pagination_count_refresh,
+                cap=cap,
+            )
+        else:
+            total_count = self.recipe.total_count(query, cap=cap)
+        if cap is not None and total_count > cap:
+            return cap, True
+        return total_count, False
+
+    def _make_validated_pagination(
+        self, page, validated_page, total_count, approximate
+    ):
+        validated_pagination = {
+            "requestedPage": page,
+            "page": validated_page,
+            "pageSize": self._pagination_page_size,
+            "totalItems": total_count,
+        }
+        if self._pagination_count_mode != "exact":
+            validated_pagination["totalItemsApproximate"] = approximate
+        return validated_pagination
+
     def do_pagination(self):
         """Should pagination be added to this recipe."""
         return self._apply_pagination and self._pagination_page_size > 0
@@ -809,6 +1056,28 @@ class Paginate(RecipeExtension):
             else:
                 self.recipe.order_by(*new_order_by)
 
+    def _search_index_matches(self, ingredient, q):
+        """Return the values of a dimension that match a search using the
+        value index, or None if the search can't be matched in memory."""
+        if not self._pagination_search_index or not isinstance(ingredient, Dimension):
+            return None
+
+        column = ingredient.roles.get("value", ingredient.columns[0])
+        statement = select(column).distinct()
+        if self.recipe._select_from is not None:
+            statement = statement.select_from(self.recipe._select_from)
+        bind = self.recipe._bind()
+        key = (
+            repr(self.recipe._bind_identity(bind)),
+            result_cache_key(statement, bind.dialect, prefix="values"),
+        )
+
+        def load(limit):
+            return self.recipe._execute(statement.limit(limit)).scalars().all()
+
+        index = value_indexes.get(key, load, ttl=self._pagination_search_index)
+        return index.match(q)
+
     def _apply_pagination_q(self):
         """Apply pagination querying to all paginate search keys"""
         q = self._pagination_q
@@ -816,15 +1085,25 @@ class Paginate(RecipeExtension):
             search_keys = self._paginate_search_keys or self.recipe.dimension_ids
 
             filters = []
+            searched = False
             for key in search_keys:
                 # build a filter for each search key and use in the recipe
                 ingredient = self.recipe._shelf.get(key, None)
                 if ingredient:
-                    filters.append(
-                        ingredient.build_filter(
-                            q, operator="ilike", target_role="value"
+                    searched = True
+                    matches = self._search_index_matches(ingredient, q)
+                    if matches is None:
+                        filters.append(
+                            ingredient.build_filter(
+                                q, operator="ilike", target_role="value"
+                            )
+                        )
+                    elif matches:
+                        filters.append(
+                            ingredient.build_filter(
+                                matches, operator="in", target_role="value"
+                            )
                         )
-                    )
 
             # Build a big or filter for the search
             if filters:
@@ -833,6 +1112,9 @@ class Paginate(RecipeExtension):
                 )
                 search_filter = Filter(or_expression)
                 self.recipe._cauldron.use(search_filter)
+            elif searched:
+                # The value indexes show that nothing matches the search
+                self.recipe._cauldron.use(Filter(false()))
 
     def add_ingredients(self):
         """Apply pagination ordering and search to this query if necessary."""
@@ -848,19 +1130,20 @@ class Paginate(RecipeExtension):
 
         # Validate what page we are on by looking at the total
         # number of items.
-        total_count = self.recipe.total_count(postquery_parts["query"])
+        total_count, approximate = self._count_items(postquery_parts["query"])
 
         d, m = divmod(total_count, limit)
         total_pages = max(1, d + (1 if m > 0 else 0))
         page = self._pagination_page
-        validated_page = min(max(1, page), total_pages)
-
-        self._validated_pagination = {
-            "requestedPage": page,
-            "page": validated_page,
-            "pageSize": limit,
-            "totalItems": total_count,
-        }
+        if approximate:
+            # We don't know the last page
+            validated_page = max(1, page)
+        else:
+            validated_page = min(max(1, page), total_pages)
+
+        self._validated_pagination = self._make_validated_pagination(
+            page, validated_page, total_count, approximate
+        )
 
         # page=1 is the first page
         offset = limit * (validated_page - 1)
@@ -877,6 +1160,78 @@ class Paginate(RecipeExtension):
         """
         return self._validated_pagination
 
+    def _apply_clamped_page(self, postquery_parts):
+        """Limit a query to the requested page, or to the last page if the
+        requested page is past the end, in a single statement.
+
+        The query's rows are numbered with ``row_number()`` and counted with
+        ``count(*) over ()`` in an outer query, which returns the rows on
+        the clamped page along with the total in ``recipe_total_count``.
+        """
+        self._page_clamped = True
+        limit = self._pagination_page_size
+        offset = limit * (self._pagination_page - 1)
+        query = postquery_parts["query"]
+
+        page = query.limit(None).offset(None).order_by(None).subquery()
+        adapter = ClauseAdapter(page)
+        row_number = func.row_number().over(
+            order_by=[adapter.traverse(o) for o in postquery_parts["order_bys"]]
+        )
+        columns = list(page.c)
+        if "recipe_total_count" not in page.c:
+            columns.append(func.count().over().label("recipe_total_count"))
+        numbered = query.session.query(
+            *columns, row_number.label("recipe_row_number")
+        ).subquery()
+
+        total = numbered.c.recipe_total_count
+        # The offset of the last page if the offset is past the end
+        last_offset = (total - 1) - (total - 1) % limit
+        clamped_offset = case((total > offset, offset), else_=last_offset)
+        row_number = numbered.c.recipe_row_number
+        postquery_parts["query"] = (
+            query.session.query(
+                *[c for c in numbered.c if c.name != "recipe_row_number"]
+            )
+            .filter(row_number > clamped_offset)
+            .order_by(row_number)
+            .limit(limit)
+        )
+        return postquery_parts
+
+    def _validated_inline_pagination(self):
+        """Validate pagination using the total count returned with the rows.
+
+        If the page was not clamped in the query and is past the end, go to
+        the first page and run the query again.
+        """
+        if not self.do_pagination():
+            return
+
+        validated_pagination = {
+            "requestedPage": self._pagination_page,
+            "page": self._pagination_page,
+            "pageSize": self._pagination_page_size,
+            "totalItems": 0,
+        }
+        rows = self.recipe.all()
+        if rows:
+            total_count = rows[0].recipe_total_count
+            validated_pagination["totalItems"] = total_count
+            if self._page_clamped:
+                total_pages = -(-total_count // self._pagination_page_size)
+                validated_pagination["page"] = min(self._pagination_page, total_pages)
+        elif self._page_clamped:
+            validated_pagination["page"] = 1
+        elif self._pagination_page != 1:
+            # Go to the first page and rerun the query
+            self.pagination_page(1)
+            self.recipe.reset()
+            return self.validated_pagination()
+
+        return validated_pagination
+
 
 class PaginateInline(Paginate):
     """
@@ -884,10 +1239,11 @@ class PaginateInline(Paginate):
     field in the recipe itself. PaginateInline differs from Paginate is how
     the recipe behaves when hitting the last page. Because PaginateInline
     only knows the total number of items after a recipe has run, it is possible
-    to set a page that goes beyond the total number of results. In this case
-    PaginateInline will result in a query that returns 0 results. The pagination
-    page in this case will be reset back to the first page and the query will
-    run again.
+    to set a page that goes beyond the total number of results. On databases
+    that support window functions, the rows are numbered in the query and a
+    page past the end returns the last page without running another query.
+    Otherwise the query returns 0 results, and the pagination page will be
+    reset back to the first page and the query will run again.
 
     **Using and controlling pagination**
 
@@ -944,36 +1300,42 @@ class PaginateInline(Paginate):
 
     This will generate SQL like::
 
-        SELECT census.age AS age,
-            census.sex AS sex,
-            census.state AS state,
-            sum(census.pop2000) AS pop2000,
-            min(anon_1._total_count) AS _total_count
-        FROM census,
-
-        (SELECT count(*) AS _total_count
-         FROM
-            (SELECT census.age AS age,
-                    census.sex AS sex,
-                    census.state AS state,
-                    sum(census.pop2000) AS pop2000
-            FROM census
-            WHERE lower(census.state) LIKE lower('T%')
-                OR lower(census.sex) LIKE lower('T%')
-            GROUP BY age,
-                    sex,
-                    state) AS anon_2) AS anon_1
-
-        WHERE lower(census.state) LIKE lower('T%')
-        OR lower(census.sex) LIKE lower('T%')
-        GROUP BY age,
-                sex,
-                state
-        ORDER BY state,
-                sex,
-                age
+        SELECT anon_1.age,
+               anon_1.sex,
+               anon_1.state,
+               anon_1.pop2000,
+               anon_1.recipe_total_count
+        FROM
+          (SELECT anon_2.age AS age,
+                  anon_2.sex AS sex,
+                  anon_2.state AS state,
+                  anon_2.pop2000 AS pop2000,
+                  count(*) OVER () AS recipe_total_count,
+                  row_number() OVER (ORDER BY state, sex, age) AS recipe_row_number
+           FROM
+             (SELECT census.age AS age,
+                     census.sex AS sex,
+                     census.state AS state,
+                     sum(census.pop2000) AS pop2000
+              FROM census
+              WHERE lower(census.state) LIKE lower('t%')
+                OR lower(census.sex) LIKE lower('t%')
+              GROUP BY age,
+                       sex,
+                       state) AS anon_2) AS anon_1
+        WHERE anon_1.recipe_row_number >
+            CASE
+                WHEN (anon_1.recipe_total_count > 40) THEN 40
+                ELSE (anon_1.recipe_total_count - 1)
+                     - (anon_1.recipe_total_count - 1) % 10
+            END
+        ORDER BY anon_1.recipe_row_number
         LIMIT 10
-        OFFSET 40
+
+    Rows past the requested offset are returned, or the rows of the last
+    page if the offset is past the end. On databases without window
+    functions the total is counted in a cross-joined subquery, and the
+    page is selected with ``LIMIT 10 OFFSET 40``.
 
     """
 
@@ -994,6 +1356,10 @@ class PaginateInline(Paginate):
             "totalItems": 0,
         }
 
+        self._page_clamped = False
+        if _supports_count_over(self.recipe._bind().dialect):
+            return self._apply_clamped_page(postquery_parts)
+
         # page=1 is the first page
         offset = limit * (validated_page - 1)
 
@@ -1023,38 +1389,16 @@ class PaginateInline(Paginate):
         """Return pagination validated against the actual number of items in the
         response.
         """
-        if not self.do_pagination():
-            return
-
-        validated_pagination = {
-            "requestedPage": self._pagination_page,
-            "page": self._pagination_page,
-            "pageSize": self._pagination_page_size,
-            "totalItems": 0,
-        }
-        rows = self.recipe.all()
-        if rows:
-            row = rows[0]
-            validated_pagination["totalItems"] = row.recipe_total_count
-        elif self._pagination_page != 1:
-            # Go to the first page and rerun the query
-            self.pagination_page(1)
-            self.recipe.reset()
-            return self.validated_pagination()
-
-        return validated_pagination
+        return self._validated_inline_pagination()
 
 
 class PaginateCountOver(Paginate):
     """
     Allows recipes to paginate results while returning total record count as a
-    field in the recipe itself. PaginateInline differs from Paginate is how
-    the recipe behaves when hitting the last page. Because PaginateInline
-    only knows the total number of items after a recipe has run, it is possible
-    to set a page that goes beyond the total number of results. In this case
-    PaginateInline will result in a query that returns 0 results. The pagination
-    page in this case will be reset back to the first page and the query will
-    run again.
+    field in the recipe itself using ``count(*) over ()``. PaginateCountOver
+    differs from Paginate is how the recipe behaves when hitting the last page.
+    The rows are numbered in the query, so a page that goes beyond the total
+    number of results returns the last page without running another query.
 
     **Using and controlling pagination**
 
@@ -1111,22 +1455,41 @@ class PaginateCountOver(Paginate):
 
     This will generate SQL like::
 
-        SELECT census.age AS age,
-            census.sex AS sex,
-            census.state AS state,
-            sum(census.pop2000) AS pop2000,
-            count(*) over() AS _total_count
-        FROM census
-        WHERE lower(census.state) LIKE lower('T%')
-        OR lower(census.sex) LIKE lower('T%')
-        GROUP BY age,
-                sex,
-                state
-        ORDER BY state,
-                sex,
-                age
+        SELECT anon_1.age,
+               anon_1.sex,
+               anon_1.state,
+               anon_1.pop2000,
+               anon_1.recipe_total_count
+        FROM
+          (SELECT anon_2.age AS age,
+                  anon_2.sex AS sex,
+                  anon_2.state AS state,
+                  anon_2.pop2000 AS pop2000,
+                  anon_2.recipe_total_count AS recipe_total_count,
+                  row_number() OVER (ORDER BY state, sex, age) AS recipe_row_number
+           FROM
+             (SELECT census.age AS age,
+                     census.sex AS sex,
+                     census.state AS state,
+                     sum(census.pop2000) AS pop2000,
+                     count(*) OVER () AS recipe_total_count
+              FROM census
+              WHERE lower(census.state) LIKE lower('t%')
+                OR lower(census.sex) LIKE lower('t%')
+              GROUP BY age,
+                       sex,
+                       state) AS anon_2) AS anon_1
+        WHERE anon_1.recipe_row_number >
+            CASE
+                WHEN (anon_1.recipe_total_count > 40) THEN 40
+                ELSE (anon_1.recipe_total_count - 1)
+                     - (anon_1.recipe_total_count - 1) % 10
+            END
+        ORDER BY anon_1.recipe_row_number
         LIMIT 10
-        OFFSET 40
+
+    Rows past the requested offset are returned, or the rows of the last
+    page if the offset is past the end.
 
     """
 
@@ -1141,50 +1504,414 @@ class PaginateCountOver(Paginate):
         if not self.do_pagination():
             return postquery_parts
 
-        limit = self._pagination_page_size
-        # Get the unvalidated page. When we validate pagination
-        # we may need to reset to page 1 if no items are returned.
-        validated_page = page = self._pagination_page
-
+        # The page is clamped to the last page in the query and validated
+        # once the rows are fetched.
+        page = self._pagination_page
         self._validated_pagination = {
             "requestedPage": page,
             "page": page,
-            "pageSize": limit,
+            "pageSize": self._pagination_page_size,
             "totalItems": 0,
         }
+        return self._apply_clamped_page(postquery_parts)
 
-        # page=1 is the first page
-        offset = limit * (validated_page - 1)
+    def validated_pagination(self):
+        """Return pagination validated against the actual number of items in the
+        response.
+        """
+        return self._validated_inline_pagination()
+
+
+def _encode_cursor_value(value):
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, date):
+        return {"date": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"decimal": str(value)}
+    return value
+
+
+def _decode_cursor_value(value):
+    if isinstance(value, dict):
+        if "datetime" in value:
+            return datetime.fromisoformat(value["datetime"])
+        if "date" in value:
+            return date.fromisoformat(value["date"])
+        if "decimal" in value:
+            return Decimal(value["decimal"])
+    return value
+
+
+def encode_pagination_cursor(page: int, keys: list, values: list) -> str:
+    """Encode a page number and the ordering values of the last row of the
+    previous page into an opaque cursor."""
+    data = {
+        "page": page,
+        "keys": keys,
+        "values": [_encode_cursor_value(v) for v in values],
+    }
+    return urlsafe_b64encode(dumps(data).encode("utf-8")).decode("ascii")
+
+
+def decode_pagination_cursor(cursor: str) -> dict:
+    """Decode a cursor made by encode_pagination_cursor."""
+    try:
+        data = loads(urlsafe_b64decode(cursor.encode("ascii")))
+        data["values"] = [_decode_cursor_value(v) for v in data["values"]]
+        assert isinstance(data["page"], int)
+        assert len(data["keys"]) == len(data["values"])
+    except (
+        AssertionError,
+        BinasciiError,
+        JSONDecodeError,
+        KeyError,
+        TypeError,
+        UnicodeError,
+        ValueError,
+    ):
+        raise BadRecipe(f"Invalid pagination cursor {cursor}")
+    return data
 
-        postquery_parts["query"] = postquery_parts["query"].limit(limit)
-        if offset:
-            postquery_parts["query"] = postquery_parts["query"].offset(offset)
+
+class PaginateKeyset(Paginate):
+    """
+    Allows recipes to paginate results using keyset (seek) pagination.
+    Instead of skipping rows with an offset, each page is fetched by
+    filtering to the rows that sort after the last row of the previous page,
+    so deep pages cost the same as the first page.
+
+    **Using and controlling pagination**
+
+    PaginateKeyset supports all the options of Paginate. After a page
+    has been fetched, ``pagination_next_cursor()`` returns an opaque cursor
+    for the next page (or None on the last page). Pass the cursor to
+    ``pagination_cursor`` to fetch the next page::
+
+        recipe = Recipe(shelf=shelf, extension_classes=[PaginateKeyset])\
+            .dimensions('state')\
+            .metrics('population')\
+            .pagination_page_size(10)
+        rows = recipe.all()
+        cursor = recipe.pagination_next_cursor()
+
+        recipe = Recipe(shelf=shelf, extension_classes=[PaginateKeyset])\
+            .dimensions('state')\
+            .metrics('population')\
+            .pagination_page_size(10)\
+            .pagination_cursor(cursor)
+
+    If no cursor is given, ``pagination_page`` is fetched using an offset.
+    When a cursor is given, ``pagination_page`` is ignored.
+
+    **Sorting**
+
+    Keyset pagination needs a unique ordering, so any dimensions in the
+    recipe that aren't in the ordering are added to the end of the
+    ordering. Cursors are only valid for the ordering they were created
+    with. Ordering values should not be NULL.
+
+    **An example**
+
+    The page after a page that ended with Tennessee will generate SQL like::
+
+        SELECT census.state AS state,
+               sum(census.pop2000) AS pop2000
+        FROM census
+        WHERE census.state > 'Tennessee'
+        GROUP BY census.state
+        ORDER BY census.state
+        LIMIT 10
+
+    """
+
+    recipe_schema = dict(Paginate.recipe_schema, pagination_cursor={"type": "string"})
+
+    def __init__(self, *args, **kwargs):
+        super(PaginateKeyset, self).__init__(*args, **kwargs)
+        self._pagination_cursor = None
+
+    @recipe_arg()
+    def from_config(self, obj):
+        obj = dict(obj)
+        cursor = obj.pop("pagination_cursor", None)
+        super(PaginateKeyset, self).from_config(obj)
+        if cursor is not None:
+            self.pagination_cursor(cursor)
+
+    @recipe_arg()
+    def pagination_cursor(self, value: str):
+        """Fetch the page following the row encoded in this cursor.
+
+        :param value: A cursor returned by ``pagination_next_cursor``
+        :type value: str
+        """
+        assert isinstance(value, str)
+        self._pagination_cursor = value or None
+
+    def _apply_pagination_order_by(self):
+        """Inject pagination ordering and make the ordering unique by
+        ordering by all dimensions."""
+        super(PaginateKeyset, self)._apply_pagination_order_by()
+        if self.do_pagination():
+            ordered = {key.lstrip("-") for key in self.recipe._order_bys}
+            tiebreakers = [
+                dim for dim in self.recipe._cauldron.dimension_ids if dim not in ordered
+            ]
+            if tiebreakers:
+                self.recipe.order_by(*self.recipe._order_bys, *tiebreakers)
+
+    def _seek_columns(self):
+        """Return a list of (label, column, ordering, is_metric) for each
+        column in the recipe's ordering."""
+        seek_columns, labels = [], set()
+        for key in self.recipe._order_bys:
+            try:
+                ingr = self.recipe._cauldron.find(key, (Dimension, Metric))
+            except BadRecipe:
+                # Orderings on ingredients that aren't used are ignored
+                continue
+            suffixes = ingr.make_column_suffixes()
+            for column, suffix in reversed(list(zip(ingr.columns, suffixes))):
+                label = ingr.id + suffix
+                if label not in labels:
+                    labels.add(label)
+                    seek_columns.append(
+                        (label, column, ingr.ordering, isinstance(ingr, Metric))
+                    )
+        return seek_columns
+
+    def _seek_condition(self, seek_columns, values):
+        """Build a condition matching rows that sort after values."""
+        columns = [column for _, column, _, _ in seek_columns]
+        orderings = {ordering for _, _, ordering, _ in seek_columns}
+        if len(columns) > 1 and len(orderings) == 1:
+            # Compare row values
+            lhs = tuple_(*columns)
+            rhs = tuple_(*[literal(v, c.type) for c, v in zip(columns, values)])
+            return lhs < rhs if orderings == {"desc"} else lhs > rhs
+
+        conditions = []
+        for idx, (_, column, ordering, _) in enumerate(seek_columns):
+            equals = [c == v for c, v in zip(columns[:idx], values[:idx])]
+            after = column < values[idx] if ordering == "desc" else column > values[idx]
+            conditions.append(and_(*equals, after))
+        return or_(*conditions)
+
+    def modify_postquery_parts(self, postquery_parts):
+        """Apply a seek filter and limit to a completed query."""
+        if not self.do_pagination() or self._pagination_cursor is None:
+            return super(PaginateKeyset, self).modify_postquery_parts(postquery_parts)
+
+        cursor = decode_pagination_cursor(self._pagination_cursor)
+        seek_columns = self._seek_columns()
+        if cursor["keys"] != [label for label, _, _, _ in seek_columns]:
+            raise BadRecipe("The pagination cursor does not match the ordering")
+
+        limit = self._pagination_page_size
+        query = postquery_parts["query"]
+        total_count, approximate = self._count_items(query)
+        page = cursor["page"]
+        self._validated_pagination = self._make_validated_pagination(
+            page, page, total_count, approximate
+        )
+
+        if seek_columns:
+            condition = self._seek_condition(seek_columns, cursor["values"])
+            if any(is_metric for _, _, _, is_metric in seek_columns):
+                query = query.having(condition)
+            else:
+                query = query.filter(condition)
+        postquery_parts["query"] = query.limit(limit)
         return postquery_parts
 
+    def pagination_next_cursor(self):
+        """Return a cursor for the page after the current page or None if
+        this is the last page. Runs the recipe if it has not run."""
+        if not self.do_pagination():
+            return None
+        rows = self.recipe.all()
+        pagination = self.validated_pagination()
+        page, total = pagination["page"], pagination["totalItems"]
+        if pagination.get("totalItemsApproximate"):
+            if len(rows) < self._pagination_page_size:
+                return None
+        elif not rows or page * self._pagination_page_size >= total:
+            return None
+
+        seek_columns = self._seek_columns()
+        last_row = rows[-1]
+        return encode_pagination_cursor(
+            page + 1,
+            [label for label, _, _, _ in seek_columns],
+            [getattr(last_row, label) for label, _, _, _ in seek_columns],
+        )
+
+
+class PaginationCosts(object):
+    """Thread safe records of the observed cost of each pagination strategy
+    for recipes with the same structure.
+
+    Each strategy is tried once for a structure, then the strategy with the
+    lowest moving average cost is used. Every ``explore_every`` runs, the
+    strategy that was observed least recently is tried again so that costs
+    stay current.
+    """
+
+    def __init__(self, explore_every=100, smoothing=0.3):
+        self.explore_every = explore_every
+        self.smoothing = smoothing
+        self._costs = {}
+        self._lock = threading.Lock()
+
+    def choose(self, key, strategies):
+        """Return the strategy to use for a recipe structure."""
+        with self._lock:
+            record = self._costs.setdefault(key, {"runs": 0, "costs": {}})
+            record["runs"] += 1
+            costs = record["costs"]
+            untried = [s for s in strategies if s not in costs]
+            if untried:
+                return untried[0]
+            if record["runs"] % self.explore_every == 0:
+                return min(strategies, key=lambda s: costs[s][1])
+            return min(strategies, key=lambda s: costs[s][0])
+
+    def record(self, key, strategy, cost):
+        """Record the cost in seconds of running a strategy."""
+        with self._lock:
+            record = self._costs.setdefault(key, {"runs": 0, "costs": {}})
+            costs = record["costs"]
+            if strategy in costs:
+                average = costs[strategy][0]
+                cost = average + self.smoothing * (cost - average)
+            costs[strategy] = (cost, record["runs"])
+
+    def costs(self, key):
+        """Return a dictionary of strategy to average cost."""
+        with self._lock:
+            record = self._costs.get(key, {"costs": {}})
+            return {s: cost for s, (cost, _) in record["costs"].items()}
+
+    def clear(self):
+        with self._lock:
+            self._costs.clear()
+
+
+pagination_costs = PaginationCosts()
+
+
+def _supports_count_over(dialect):
+    """Does the database support ``count(*) over ()``"""
+    if dialect.name == "sqlite":
+        return sqlite3.sqlite_version_info >= (3, 25)
+    if dialect.name == "mysql":
+        return (dialect.server_version_info or (0,)) >= (8,)
+    return True
+
+
+class AutoPaginate(Paginate):
+    """
+    Allows recipes to paginate results, choosing how to count the total
+    number of items for each recipe.
+
+    AutoPaginate supports all the options of Paginate. The total can be
+    counted with a separate count query (like Paginate), a cross joined
+    count subquery (like PaginateInline) or ``count(*) over ()`` (like
+    PaginateCountOver). AutoPaginate records how long each strategy takes
+    for recipes with the same database, dimensions and metrics in
+    ``pagination_costs`` and uses the cheapest one. Rows may include a
+    ``recipe_total_count`` column depending on the strategy.
+
+    If a page past the last page is requested, the last page is returned
+    whatever strategy is used. Approximate count modes always use a
+    separate count query.
+    """
+
+    strategies = {
+        "count": Paginate,
+        "inline": PaginateInline,
+        "count_over": PaginateCountOver,
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(AutoPaginate, self).__init__(*args, **kwargs)
+        self._strategy = "count"
+        self._costs_key = None
+        self.recipe.events.on("rows_fetched", self._record_cost)
+
+    def _available_strategies(self, dialect):
+        if self._pagination_count_mode != "exact":
+            return ["count"]
+        strategies = ["count", "inline"]
+        if _supports_count_over(dialect):
+            strategies.append("count_over")
+        return strategies
+
+    def add_ingredients(self):
+        """Choose a pagination strategy and apply it."""
+        self._strategy, self._costs_key = "count", None
+        if self.do_pagination():
+            dialect = self.recipe._bind().dialect
+            self._costs_key = (
+                dialect.name,
+                tuple(sorted(self.recipe.dimension_ids)),
+                tuple(sorted(self.recipe.metric_ids)),
+                bool(self._pagination_q),
+            )
+            self._strategy = pagination_costs.choose(
+                self._costs_key, self._available_strategies(dialect)
+            )
+        self.strategies[self._strategy].add_ingredients(self)
+
+    def modify_postquery_parts(self, postquery_parts):
+        return self.strategies[self._strategy].modify_postquery_parts(
+            self, postquery_parts
+        )
+
+    def _record_cost(self, event):
+        """Record the time spent fetching and counting a page."""
+        if self._costs_key is None or self.recipe.stats.from_cache:
+            return
+        if self.recipe._empty:
+            # Nothing was fetched from the database
+            return
+        cost = event.elapsed + self.recipe.stats.counttime
+        pagination_costs.record(self._costs_key, self._strategy, cost)
+        self._costs_key = None
+
     def validated_pagination(self):
         """Return pagination validated against the actual number of items in the
         response.
         """
         if not self.do_pagination():
             return
+        # Build the query to choose a strategy
+        self.recipe.query()
+        if self._strategy == "count":
+            return super(AutoPaginate, self).validated_pagination()
 
-        validated_pagination = {
-            "requestedPage": self._pagination_page,
-            "page": self._pagination_page,
-            "pageSize": self._pagination_page_size,
-            "totalItems": 0,
-        }
+        validated_page = page = self._pagination_page
         rows = self.recipe.all()
         if rows:
-            row = rows[0]
-            validated_pagination["totalItems"] = row.recipe_total_count
-        elif self._pagination_page != 1:
-            # Go to the first page and rerun the query
-            self.pagination_page(1)
-            self.recipe.reset()
-            return self.validated_pagination()
-
-        return validated_pagination
+            total_count = rows[0].recipe_total_count
+            if self._page_clamped:
+                d, m = divmod(total_count, self._pagination_page_size)
+                validated_page = min(page, d + (1 if m > 0 else 0))
+        elif page > 1 and not self._page_clamped:
+            # The page is past the last page. Count the items and
+            # fetch the last page.
+            total_count = self.recipe.total_count(self.recipe.query())
+            d, m = divmod(total_count, self._pagination_page_size)
+            validated_page = max(1, d + (1 if m > 0 else 0))
+            self.pagination_page(validated_page)
+            self.recipe.all()
+        else:
+            validated_page, total_count = 1, 0
+
+        return self._make_validated_pagination(
+            page, validated_page, total_count, False
+        )
 
 
 class BlendRecipe(RecipeExtension):
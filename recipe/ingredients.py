@@ -1,6 +1,19 @@
-from functools import total_ordering
+from collections import namedtuple
+from functools import partial, total_ordering
 from uuid import uuid4
-from sqlalchemy import Float, String, and_, between, case, cast, func, or_, text, not_
+from sqlalchemy import (
+    Float,
+    String,
+    and_,
+    between,
+    case,
+    cast,
+    func,
+    literal,
+    not_,
+    or_,
+    text,
+)
 from recipe.exceptions import BadIngredient
 from recipe.utils import AttrDict, filter_to_string
 from recipe.utils.datatype import (
@@ -38,6 +51,13 @@ def contains_complex_values(v: List) -> bool:
     return None in v or any(map(is_nested_condition, v))
 
 
+def _apply_to_rows(extra_callable, columns):
+    """Call a cauldron_extras callable on each row of a dictionary of result
+    columns and return the list of values."""
+    row = namedtuple("result", columns.keys())
+    return [extra_callable(r) for r in map(row._make, zip(*columns.values()))]
+
+
 @total_ordering
 class Ingredient(object):
     """Ingredients combine to make a SQLAlchemy query.
@@ -169,6 +189,20 @@ class Ingredient(object):
             value = f(value)
         return value
 
+    def _format_column(self, values):
+        """Formats a column of values using any stored formatters.
+
+        Each formatter runs once over the whole column. Formatters marked
+        with :func:`recipe.utils.vectorized` receive the entire column,
+        all other formatters are applied to each value.
+        """
+        for f in self.formatters:
+            if getattr(f, "vectorized", False):
+                values = list(f(values))
+            else:
+                values = list(map(f, values))
+        return values
+
     def make_column_suffixes(self):
         """Make sure we have the right column suffixes. These will be appended
         to `id` when generating the query.
@@ -246,6 +280,35 @@ class Ingredient(object):
                 getattr(row, f"{self.id}_raw")
             )
 
+    @property
+    def cauldron_extra_columns(self):
+        """Yield extra tuples containing a field name and a callable that takes
+        a dictionary of result columns and returns a list of values.
+
+        This is the column-wise equivalent of ``cauldron_extras`` and is
+        used by ``Shelf.enchant``.
+        """
+        if self.formatters:
+            yield self.id, lambda columns: self._format_column(
+                columns[f"{self.id}_raw"]
+            )
+
+    def _extra_columns(self):
+        """The extra columns ``Shelf.enchant`` adds for this ingredient.
+
+        Subclasses that override ``cauldron_extras`` without overriding
+        ``cauldron_extra_columns`` have their extras applied to each row.
+        """
+        mro = type(self).__mro__
+        extras_cls = next(c for c in mro if "cauldron_extras" in vars(c))
+        columns_cls = next(c for c in mro if "cauldron_extra_columns" in vars(c))
+        if extras_cls is columns_cls or not issubclass(extras_cls, columns_cls):
+            return self.cauldron_extra_columns
+        return (
+            (field, partial(_apply_to_rows, extra_callable))
+            for field, extra_callable in self.cauldron_extras
+        )
+
     def _order(self):
         """Ingredients are sorted by subclass then by id."""
         if isinstance(self, Dimension):
@@ -572,6 +635,12 @@ class Dimension(Ingredient):
         lookup_default (:obj:`object`)
             A default to show if the value can't be found in the
             lookup dictionary.
+        lookup_strategy (:obj:`str`)
+            How the lookup is applied. "formatter" is the default
+            and translates values in Python after the query runs.
+            "sql" compiles the lookup into a SQL ``CASE`` expression so
+            the translated value is grouped, ordered and filtered in the
+            database. No formatter is added when using the "sql" strategy.
 
     Returns:
 
@@ -582,7 +651,22 @@ class Dimension(Ingredient):
     """
 
     def __init__(self, expression, **kwargs):
+        lookup_strategy = kwargs.pop("lookup_strategy", "formatter")
+        if lookup_strategy not in ("formatter", "sql"):
+            raise BadIngredient("lookup_strategy must be one of formatter or sql")
         super(Dimension, self).__init__(**kwargs)
+        if "lookup" in kwargs and lookup_strategy == "sql":
+            lookup_expression = self._build_lookup_expression(expression, kwargs)
+            if lookup_expression is None:
+                # The lookup values don't share a type, so they can't be
+                # the results of one CASE
+                lookup_strategy = "formatter"
+            else:
+                expression = lookup_expression
+                # The translated value has the datatype of the lookup values
+                self.datatype = datatype_from_column_expression(expression)
+                if self.datatype_by_role:
+                    self.datatype_by_role["value"] = self.datatype
         if self.datatype is None:
             self.datatype = datatype_from_column_expression(expression)
 
@@ -634,7 +718,7 @@ class Dimension(Ingredient):
             self._group_by.append(self.roles[k])
             self.role_keys.append(k)
 
-        if "lookup" in kwargs:
+        if "lookup" in kwargs and lookup_strategy == "formatter":
             self.lookup = kwargs.get("lookup")
             if not isinstance(self.lookup, dict):
                 raise BadIngredient("lookup must be a dictionary")
@@ -647,6 +731,45 @@ class Dimension(Ingredient):
             else:
                 self.formatters.insert(0, lambda value: self.lookup.get(value, value))
 
+    def _build_lookup_expression(self, expression, kwargs):
+        """Translate expression with the lookup dictionary using a SQL CASE.
+
+        Values that aren't found in the lookup are cast to the type of the
+        lookup values. Returns None if the lookup values have different
+        types.
+        """
+        self.lookup = kwargs.get("lookup")
+        if not isinstance(self.lookup, dict):
+            raise BadIngredient("lookup must be a dictionary")
+        values = list(self.lookup.values())
+        if "lookup_default" in kwargs:
+            values.append(kwargs.get("lookup_default"))
+        value_types = [literal(v).type for v in values if v is not None]
+        if len({t._type_affinity for t in value_types}) > 1:
+            return None
+
+        if "lookup_default" in kwargs:
+            self.lookup_default = kwargs.get("lookup_default")
+            else_ = literal(self.lookup_default)
+        elif (
+            value_types
+            and expression.type._type_affinity is not value_types[0]._type_affinity
+        ):
+            else_ = cast(expression, value_types[0])
+        else:
+            else_ = expression
+        if not self.lookup:
+            return else_
+
+        if None in self.lookup:
+            # A simple CASE can't match NULL, so compare each value
+            whens = [
+                (expression.is_(None) if k is None else expression == k, v)
+                for k, v in self.lookup.items()
+            ]
+            return case(whens, else_=else_)
+        return case(self.lookup, value=expression, else_=else_)
+
     @property
     def group_by(self):
         # Ensure the labels are generated
@@ -672,6 +795,15 @@ class Dimension(Ingredient):
         if "id" not in self.role_keys:
             yield (f"{self.id}_id", lambda row: getattr(row, self.id_prop))
 
+    @property
+    def cauldron_extra_columns(self):
+        """Yield extra tuples containing a field name and a callable that takes
+        a dictionary of result columns
+        """
+        yield from super(Dimension, self).cauldron_extra_columns
+        if "id" not in self.role_keys:
+            yield (f"{self.id}_id", lambda columns: list(columns[self.id_prop]))
+
     def make_column_suffixes(self):
         """Make sure we have the right column suffixes. These will be appended
         to `id` when generating the query.
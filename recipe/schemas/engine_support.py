@@ -6,6 +6,7 @@ from sqlalchemy.types import Numeric, String, Integer
 
 
 class postgres_age(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "postgres_age"
 
@@ -27,46 +28,55 @@ def pgage(element, compiler, **kw):
 
 
 class bq_median(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_median"
 
 
 class bq_percentile1(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_percentile1"
 
 
 class bq_percentile5(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_percentile5"
 
 
 class bq_percentile10(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_percentile10"
 
 
 class bq_percentile25(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_percentile25"
 
 
 class bq_percentile75(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_percentile75"
 
 
 class bq_percentile90(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_percentile90"
 
 
 class bq_percentile95(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_percentile95"
 
 
 class bq_percentile99(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_percentile99"
 
@@ -120,6 +130,7 @@ def bqpercentile99(element, compiler, **kw):
 
 
 class bq_age(expression.FunctionElement):
+    inherit_cache = True
     type = Numeric()
     name = "bq_age"
 
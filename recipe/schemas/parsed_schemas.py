@@ -157,6 +157,7 @@ dimension_schema = S.Dict(
         "buckets_default_label": {"anyof": SCALAR_TYPES, "required": False},
         "format": format_schema,
         "lookup": S.Dict(required=False),
+        "lookup_strategy": S.String(required=False, allowed=["formatter", "sql"]),
         "quickselects": S.List(required=False, schema=named_condition_schema),
     },
     coerce=move_extra_fields,
@@ -225,6 +226,7 @@ strict_dimension_schema = S.Dict(
         "buckets_default_label": {"anyof": SCALAR_TYPES, "required": False},
         "format": format_schema,
         "lookup": S.Dict(required=False),
+        "lookup_strategy": S.String(required=False, allowed=["formatter", "sql"]),
         "quickselects": S.List(required=False, schema=named_condition_schema),
     },
     coerce=move_extra_fields,
@@ -0,0 +1,140 @@
+"""
+In-process indexes of the distinct values of dimensions.
+
+Searching a paginated recipe filters each search key with an ILIKE, which
+scans the table for every search. A value index loads the distinct values of
+a dimension once and matches searches against them in memory, so a search
+can be run as an IN filter on the matching values, or skipped entirely when
+nothing matches.
+"""
+import re
+import threading
+from collections import OrderedDict
+import time
+from bisect import bisect_left, bisect_right
+
+
+def like_regex(pattern):
+    """Convert a LIKE pattern to a compiled regular expression."""
+    parts = [
+        ".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern
+    ]
+    return re.compile("".join(parts), re.DOTALL)
+
+
+class ValueIndex(object):
+    """The distinct string values of a column, matched case insensitively
+    against LIKE patterns.
+
+    :param values: A list of values or None if the column can't be indexed.
+    """
+
+    def __init__(self, values):
+        self.loaded_at = time.time()
+        if values is None:
+            self._lowered = self._values = None
+            return
+        pairs = sorted((value.lower(), value) for value in set(values))
+        self._lowered = [lowered for lowered, _ in pairs]
+        self._values = [value for _, value in pairs]
+
+    @property
+    def indexed(self):
+        return self._values is not None
+
+    def match(self, pattern):
+        """Return a list of the values that match a case insensitive LIKE
+        pattern, or None if the pattern can't be matched in memory.
+
+        Exact and prefix patterns are found by bisection, substring patterns
+        by scanning. Patterns with escapes are not matched.
+        """
+        if not self.indexed or "\\" in pattern:
+            return None
+        pattern = pattern.lower()
+        lowered, values = self._lowered, self._values
+
+        parts = pattern.split("%")
+        if "_" not in pattern and len(parts) == 1:
+            lo = bisect_left(lowered, pattern)
+            hi = bisect_right(lowered, pattern)
+            return values[lo:hi]
+        if "_" not in pattern and len(parts) == 2 and parts[1] == "":
+            prefix = parts[0]
+            lo = hi = bisect_left(lowered, prefix)
+            while hi < len(lowered) and lowered[hi].startswith(prefix):
+                hi += 1
+            return values[lo:hi]
+        if "_" not in pattern and len(parts) == 3 and parts[0] == parts[2] == "":
+            substring = parts[1]
+            return [v for low, v in zip(lowered, values) if substring in low]
+
+        regex = like_regex(pattern)
+        return [v for low, v in zip(lowered, values) if regex.fullmatch(low)]
+
+    def __len__(self):
+        return len(self._values or ())
+
+
+class ValueIndexCache(object):
+    """A thread safe cache of value indexes.
+
+    :param max_values: Columns with more distinct values than this are not
+        indexed.
+    :param max_entries: The maximum number of indexes to keep. The least
+        recently used indexes are evicted first.
+    """
+
+    def __init__(self, max_values=10000, max_entries=100):
+        self.max_values = max_values
+        self.max_entries = max_entries
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load, ttl):
+        """Return the ValueIndex for key.
+
+        If there is no index for key or the index is older than ``ttl``
+        seconds, the index is built from the values returned by
+        ``load(limit)``, which should return at most ``limit`` distinct
+        values. Columns that have too many values or values that are not
+        strings can't be indexed.
+        """
+        with self._lock:
+            entry = self._indexes.get(key)
+            if entry is not None:
+                self._indexes.move_to_end(key)
+        if entry is not None and time.time() - entry[0].loaded_at <= ttl:
+            return entry[0]
+
+        values = [value for value in load(self.max_values + 1) if value is not None]
+        if len(values) > self.max_values or not all(
+            isinstance(value, str) for value in values
+        ):
+            values = None
+        index = ValueIndex(values)
+        with self._lock:
+            self._indexes[key] = (index, ttl)
+            self._indexes.move_to_end(key)
+            self._evict()
+        return index
+
+    def _evict(self):
+        """Remove expired indexes and the least recently used indexes over
+        max_entries."""
+        now = time.time()
+        for key, (index, ttl) in list(self._indexes.items()):
+            if now - index.loaded_at > ttl:
+                del self._indexes[key]
+        while len(self._indexes) > self.max_entries:
+            self._indexes.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+    def __len__(self):
+        return len(self._indexes)
+
+
+value_indexes = ValueIndexCache()
@@ -16,6 +16,8 @@ from recipe.ingredients import Dimension, Filter, Ingredient, InvalidIngredient,
 from recipe.schemas import shelf_schema
 from recipe.schemas.builders import SQLAlchemyBuilder
 from recipe.schemas.parsed_constructors import create_ingredient_from_parsed
+from recipe.utils.datatype import determine_datatype
+from recipe.utils.formatting import filter_key
 
 _POP_DEFAULT = object()
 
@@ -67,12 +69,10 @@ class SelectParts:
         if ingredient.filters:
             # Ensure we don't add duplicate filters
             for new_f in ingredient.filters:
-                from recipe.utils import filter_to_string
-
-                new_f_str = filter_to_string(new_f)
-                if new_f_str not in self.all_filters:
+                new_f_key = filter_key(new_f)
+                if new_f_key not in self.all_filters:
                     self.filters.add(new_f)
-                    self.all_filters.add(new_f_str)
+                    self.all_filters.add(new_f_key)
 
         # Hoist any order by into the ordering
         if (
@@ -454,12 +454,10 @@ class Shelf(object):
             group_bys.extend(ingredient.group_by)
             # Ensure we don't add duplicate filters
             for new_f in ingredient.filters:
-                from recipe.utils import filter_to_string
-
-                new_f_str = filter_to_string(new_f)
-                if new_f_str not in all_filters:
+                new_f_key = filter_key(new_f)
+                if new_f_key not in all_filters:
                     filters.add(new_f)
-                    all_filters.add(new_f_str)
+                    all_filters.add(new_f_key)
             havings.update(ingredient.havings)
 
             # If there is an order_by key on one of the ingredients, make sure
@@ -495,45 +493,66 @@ class Shelf(object):
             "order_bys": list(order_bys.keys()),
         }
 
-    def enchant(self, data, cache_context=None):
-        """Add any calculated values to each row of a resultset generating a
-        new namedtuple
+    def enchant(self, data, cache_context=None, columnar=False):
+        """Add any calculated values to a resultset generating a new
+        namedtuple for each row.
+
+        The resultset is transposed into columns so that each ingredient's
+        formatters run once per column rather than once per cell. Rows are
+        assembled at the end unless ``columnar`` is requested.
 
         :param data: a list of row results
         :param cache_context: optional extra context for caching
+        :param columnar: If True, return a dictionary of field name to a list
+                 of values instead of a list of rows
         :return: a list with ingredient.cauldron_extras added for all
                  ingredients
         """
-        enchantedlist = []
-        if data:
-            sample_item = data[0]
-
-            # Extra fields to add to each row
-            # With extra callables
-            extra_fields, extra_callables = [], []
-            original_fields = set(sample_item._fields)
-
-            for ingredient in self.ingredients():
-                if not isinstance(ingredient, (Dimension, Metric)):
-                    continue
-                if cache_context:
-                    ingredient.cache_context += str(cache_context)
-                for extra_field, extra_callable in ingredient.cauldron_extras:
-                    if extra_field not in original_fields:
-                        extra_fields.append(extra_field)
-                        extra_callables.append(extra_callable)
-
-            # Mixin the extra fields
-            keyed_tuple = namedtuple(
-                "result", sample_item._fields + tuple(extra_fields)
-            )
+        if not data:
+            return {} if columnar else []
 
-            # Iterate over the results and build a new namedtuple for each row
-            for row in data:
-                values = tuple(row) + tuple(fn(row) for fn in extra_callables)
-                enchantedlist.append(keyed_tuple(*values))
+        original_fields = tuple(data[0]._fields)
+        columns = dict(zip(original_fields, map(list, zip(*data))))
 
-        return enchantedlist
+        # Extra fields to add to each row
+        extra_fields = []
+        for ingredient in self.ingredients():
+            if not isinstance(ingredient, (Dimension, Metric)):
+                continue
+            if cache_context:
+                ingredient.cache_context += str(cache_context)
+            for extra_field, extra_callable in ingredient._extra_columns():
+                if extra_field not in original_fields:
+                    extra_fields.append(extra_field)
+                    columns[extra_field] = extra_callable(columns)
+
+        if columnar:
+            return columns
+
+        # Mixin the extra fields
+        keyed_tuple = namedtuple("result", original_fields + tuple(extra_fields))
+        return list(map(keyed_tuple._make, zip(*columns.values())))
+
+    def field_datatypes(self):
+        """Return a dictionary of result field name to datatype for the
+        fields returned by ``enchant``. Formatted fields are not included
+        because formatters may change the type of a value.
+        """
+        datatypes = {}
+        for ingredient in self.ingredients():
+            if isinstance(ingredient, Dimension):
+                for role, suffix in zip(
+                    ingredient.role_keys, ingredient.make_column_suffixes()
+                ):
+                    datatypes[ingredient.id + suffix] = determine_datatype(
+                        ingredient, role
+                    )
+                if "id" not in ingredient.role_keys:
+                    datatypes[f"{ingredient.id}_id"] = determine_datatype(ingredient)
+            elif isinstance(ingredient, Metric):
+                for suffix in ingredient.make_column_suffixes():
+                    datatypes[ingredient.id + suffix] = determine_datatype(ingredient)
+        return datatypes
 
 
 def AutomaticShelf(table):
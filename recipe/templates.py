@@ -0,0 +1,136 @@
+"""
+Process-wide caching of built recipe queries.
+
+Many recipes share the same structure and differ only in the values used
+in their filters. Building a recipe's query (brewing the cauldron, building
+labels and orderings, sorting filters, running extension hooks) costs the
+same every time, so a built query is saved as a template keyed by the
+structure of the recipe. Later recipes with the same structure bind their own
+values into the template instead of building the query again.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+# A built query and the bound parameters (in structural order) that
+# were used to build it.
+QueryTemplate = namedtuple("QueryTemplate", ["recipe_parts", "bindparams"])
+
+
+class NotTemplatable(Exception):
+    """This recipe can't be described by a structural key"""
+
+
+def element_key(element, bindparams):
+    """Return the structural key for a SQLAlchemy element, gathering
+    the element's bound parameters into ``bindparams``.
+
+    Raises NotTemplatable if the element does not support SQLAlchemy
+    cache keys.
+    """
+    if isinstance(element, str):
+        return element
+    generate = getattr(element, "_generate_cache_key", None)
+    cache_key = generate() if generate is not None else None
+    if cache_key is None:
+        raise NotTemplatable(repr(element))
+    bindparams.extend(cache_key.bindparams)
+    return cache_key.key
+
+
+def bind_template(template, bindparams):
+    """Return a dictionary that replaces the values bound in a template
+    with the values in bindparams."""
+    return {
+        orig.key: new.effective_value
+        for orig, new in zip(template.bindparams, bindparams)
+    }
+
+
+class QueryTemplateCache(object):
+    """A thread safe LRU cache of query templates.
+
+    :param maxsize: The maximum number of templates to keep.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a QueryTemplate for key or None."""
+        with self._lock:
+            template = self._templates.get(key)
+            if template is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._templates.move_to_end(key)
+            return template
+
+    def set(self, key, template):
+        with self._lock:
+            self._templates[key] = template
+            self._templates.move_to_end(key)
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._templates)
+
+
+template_cache = QueryTemplateCache()
+
+
+def statement_shape(bindparams):
+    """The number of values in each ``in`` list bound into a statement."""
+    return tuple(len(b.value) for b in bindparams if b.expanding)
+
+
+class StatementShapes(object):
+    """A thread safe count of the distinct statement shapes built for each
+    recipe structure.
+
+    Databases that cache statements by their SQL compile a statement for
+    each shape, so structures with many shapes compile often.
+
+    :param maxsize: The maximum number of structures to keep.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._shapes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, key, shape):
+        """Record a shape built for a structure and return the number of
+        distinct shapes seen for the structure."""
+        with self._lock:
+            shapes = self._shapes.setdefault(key, set())
+            shapes.add(shape)
+            self._shapes.move_to_end(key)
+            while len(self._shapes) > self.maxsize:
+                self._shapes.popitem(last=False)
+            return len(shapes)
+
+    def shapes(self, key):
+        """The shapes seen for a structure."""
+        with self._lock:
+            return set(self._shapes.get(key, ()))
+
+    def clear(self):
+        with self._lock:
+            self._shapes.clear()
+
+    def __len__(self):
+        return len(self._shapes)
+
+
+statement_shapes = StatementShapes()
@@ -5,12 +5,22 @@ from .anonymize import (
     FakerAnonymizer,
 )
 from .extensions import recipe_arg
-from .formatting import filter_to_string, prettyprintable_sql
+from .formatting import filter_key, filter_to_string, prettyprintable_sql
 from .utils import (
     replace_whitespace_with_space,
     clean_unicode,
     AttrDict,
     disaggregate,
     pad_values,
+    bucket_size,
+    pad_in_lists,
+    large_in_list,
+    value_table,
+    value_tables,
+    load_value_tables,
+    row_values_in,
+    always_false,
+    simplify_filters,
     make_schema,
+    vectorized,
 )
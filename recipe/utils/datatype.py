@@ -92,3 +92,36 @@ def determine_datatype(ingr, role="value"):
         return "bool"
     elif isinstance(ingr, (Metric)):
         return ingr.datatype
+
+
+# NumPy dtypes for recipe datatypes. Datatypes that are not listed are
+# stored in object arrays.
+NUMPY_DTYPES = {
+    "num": "float64",
+    "bool": "bool",
+    "date": "datetime64[D]",
+    "datetime": "datetime64[us]",
+}
+
+
+def numpy_array(values, datatype):
+    """Convert a list of values to a NumPy array with a dtype matching
+    the recipe datatype. Integer columns without nulls stay integers.
+    Values that can't be converted are stored in an object array.
+    """
+    import numpy as np
+
+    dtype = NUMPY_DTYPES.get(datatype)
+    if datatype == "num" and all(type(v) is int for v in values):
+        dtype = "int64"
+    elif datatype == "bool" and None in values:
+        dtype = None
+
+    if dtype is not None:
+        try:
+            return np.array(values, dtype=dtype)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values
+    return arr
@@ -1,3 +1,4 @@
+import hashlib
 from uuid import uuid4
 
 import sqlparse
@@ -27,6 +28,49 @@ def filter_to_string(filt):
         return uuid4()
 
 
+# Compiled SQL for filter structures, keyed by SQLAlchemy cache key
+_filter_shapes = {}
+FILTER_SHAPES_MAXSIZE = 10000
+
+
+def filter_key(filt):
+    """A cheap structural key used to dedupe and sort filters.
+
+    The key is a tuple of the filter's SQL with placeholders for bound values
+    and a representation of the bound values. The SQL is compiled once per
+    filter structure, so the cost of building a key does not grow with the
+    number of values in the filter. Long lists of values are digested.
+    """
+    if hasattr(filt, "filters") and filt.filters:
+        expr = filt.filters[0]
+    elif hasattr(filt, "havings") and filt.havings:
+        expr = filt.havings[0]
+    else:
+        expr = filt
+    if isinstance(expr, bool):
+        return (str(expr), "")
+
+    generate = getattr(expr, "_generate_cache_key", None)
+    cache_key = generate() if generate is not None else None
+    if cache_key is None:
+        return (str(filter_to_string(filt)), "")
+
+    shape = _filter_shapes.get(cache_key.key)
+    if shape is None:
+        try:
+            shape = str(expr)
+        except UnsupportedCompilationError:
+            return (str(filter_to_string(filt)), "")
+        if len(_filter_shapes) >= FILTER_SHAPES_MAXSIZE:
+            _filter_shapes.clear()
+        _filter_shapes[cache_key.key] = shape
+
+    values = repr(tuple(b.effective_value for b in cache_key.bindparams))
+    if len(values) > 100:
+        values = hashlib.md5(values.encode("utf-8")).hexdigest()
+    return (shape, values)
+
+
 class StringLiteral(String):
     """Teach SA how to literalize various things."""
 
@@ -46,12 +90,46 @@ class StringLiteral(String):
         return process
 
 
+# Dialects that render bound values inline, keyed by base dialect class
+_literal_dialects = {}
+
+# Rendered SQL keyed by statement structure, bound values and dialect
+_rendered_sql = {}
+RENDERED_SQL_MAXSIZE = 1000
+
+
+def literal_dialect(dialect=None):
+    """Return a dialect instance that can render bound values inline for
+    a base dialect. Literal dialects are built once per dialect class."""
+    DialectKlass = dialect.__class__ if dialect else DefaultDialect
+    literal = _literal_dialects.get(DialectKlass)
+    if literal is None:
+
+        class LiteralDialect(DialectKlass):
+            colspecs = {
+                # prevent various encoding explosions
+                String: StringLiteral,
+                # teach SA about how to literalize a datetime
+                DateTime: StringLiteral,
+                Date: StringLiteral,
+                # don't format py2 long integers to NULL
+                NullType: StringLiteral,
+            }
+
+        literal = _literal_dialects[DialectKlass] = LiteralDialect()
+    return literal
+
+
 def prettyprintable_sql(statement, dialect=None, reindent=True):
     """
     Generate an SQL expression string with bound parameters rendered inline
     for the given SQLAlchemy statement. The function can also receive a
     `sqlalchemy.orm.Query` object instead of statement.
 
+    Rendered SQL is memoized by the statement's structure and bound values.
+    If ``reindent`` is False the SQL is returned as compiled, which is much
+    faster than reformatting it.
+
     WARNING: Should only be used for debugging. Inlining parameters is not
              safe when handling user created data.
     """
@@ -60,24 +138,26 @@ def prettyprintable_sql(statement, dialect=None, reindent=True):
             dialect = statement.session.get_bind().dialect
         statement = statement.statement
 
-    # Generate a class that can handle encoding
-    if dialect:
-        DialectKlass = dialect.__class__
-    else:
-        DialectKlass = DefaultDialect
-
-    class LiteralDialect(DialectKlass):
-        colspecs = {
-            # prevent various encoding explosions
-            String: StringLiteral,
-            # teach SA about how to literalize a datetime
-            DateTime: StringLiteral,
-            Date: StringLiteral,
-            # don't format py2 long integers to NULL
-            NullType: StringLiteral,
-        }
+    literal = literal_dialect(dialect)
+    generate = getattr(statement, "_generate_cache_key", None)
+    cache_key = generate() if generate is not None else None
+    key = None
+    if cache_key is not None:
+        values = repr(tuple(b.effective_value for b in cache_key.bindparams))
+        key = (type(literal), reindent, cache_key.key, values)
+        sql = _rendered_sql.get(key)
+        if sql is not None:
+            return sql
 
     compiled = statement.compile(
-        dialect=LiteralDialect(), compile_kwargs={"literal_binds": True}
+        dialect=literal, compile_kwargs={"literal_binds": True}
     )
-    return sqlparse.format(str(compiled), reindent=reindent)
+    sql = str(compiled)
+    if reindent:
+        sql = sqlparse.format(sql, reindent=True)
+
+    if key is not None:
+        if len(_rendered_sql) >= RENDERED_SQL_MAXSIZE:
+            _rendered_sql.clear()
+        _rendered_sql[key] = sql
+    return sql
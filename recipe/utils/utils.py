@@ -1,9 +1,44 @@
+import hashlib
 import math
 import re
 import unicodedata
+from contextlib import contextmanager
+from functools import wraps
 from recipe.schemas import recipe_schema
 from sureberus import schema as S
 
+from sqlalchemy import (
+    ARRAY,
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Integer,
+    MetaData,
+    Numeric,
+    Table,
+    and_,
+    all_,
+    any_,
+    exists,
+    false,
+    inspect,
+    literal,
+    not_,
+    or_,
+    select,
+    tuple_,
+)
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import (
+    BinaryExpression,
+    BindParameter,
+    BooleanClauseList,
+    ClauseElement,
+    False_,
+    Grouping,
+    UnaryExpression,
+)
 from sqlalchemy.sql.functions import FunctionElement
 
 WHITESPACE_RE = re.compile(r"\s+", flags=re.DOTALL | re.MULTILINE)
@@ -31,6 +66,26 @@ class AttrDict(dict):
         self.__dict__ = self
 
 
+def vectorized(fn):
+    """Mark a formatter as accepting a whole column of values.
+
+    Vectorized formatters are called once with a list of values and must
+    return a sequence of the same length::
+
+        Metric(func.sum(Census.pop2000), formatters=[vectorized(scale)])
+
+    The formatter is wrapped rather than changed, so builtins can be
+    vectorized too.
+    """
+
+    @wraps(fn)
+    def formatter(values):
+        return fn(values)
+
+    formatter.vectorized = True
+    return formatter
+
+
 def disaggregate(expr):
     if isinstance(expr, FunctionElement):
         return expr.clause_expr
@@ -62,6 +117,298 @@ def pad_values(values, prefix="RECIPE-DUMMY-VAL-", bin_size=11):
         return values
 
 
+def bucket_size(count, bin_size=None, max_size=None):
+    """The number of values to pad a list of count values to.
+
+    Lists are padded to a multiple of bin_size or, if no bin_size is given,
+    to the next power of two. Lists of more than 64 values are padded to
+    the next eighth of a power of two, so padding adds at most a quarter of
+    the values. Lists are never padded past max_size, and lists of max_size
+    or more values are not padded.
+    """
+    if count <= 1 or (max_size and count >= max_size):
+        return count
+    if bin_size:
+        size = int(math.ceil(float(count) / bin_size) * bin_size)
+    elif count <= 64:
+        size = 1 << (count - 1).bit_length()
+    else:
+        step = 1 << ((count - 1).bit_length() - 3)
+        size = -(-count // step) * step
+    return min(size, max_size) if max_size else size
+
+
+def pad_in_lists(expression, bin_size=None, max_size=None):
+    """Pad the values of every ``in`` and ``notin`` condition in an
+    expression to a bucket size by repeating the last value.
+
+    Databases that cache statements by their SQL compile a new statement
+    for each number of values in an in list. Padding means that lists with
+    similar numbers of values share a statement. Repeating a value doesn't
+    change the result, so any datatype can be padded. Lists are padded to
+    the sizes given by ``bucket_size``. The expression is returned unchanged
+    if nothing needs to be padded.
+    """
+
+    def padded_values(element):
+        if (
+            isinstance(element, BindParameter)
+            and element.expanding
+            and isinstance(element.value, (list, tuple))
+        ):
+            values = list(element.value)
+            size = bucket_size(len(values), bin_size, max_size)
+            if size != len(values):
+                return values + [values[-1]] * (size - len(values))
+        return None
+
+    if not isinstance(expression, ClauseElement) or not any(
+        padded_values(e) is not None for e in visitors.iterate(expression)
+    ):
+        return expression
+
+    def replace(element):
+        values = padded_values(element)
+        if values is not None:
+            return element._with_value(values, maintain_key=True)
+        return None
+
+    return visitors.replacement_traverse(expression, {}, replace)
+
+
+# Databases that can't create temporary tables in a session
+NO_TEMPORARY_TABLES = {"bigquery"}
+
+# The prefix of the names of temporary tables made by value_table
+VALUE_TABLE_PREFIX = "recipe_values_"
+
+# Databases that can't compare row values, ``(a, b) IN ((1, 2))``
+NO_ROW_VALUES = {"mssql"}
+
+
+def value_table(dialect, columns, rows):
+    """Return a temporary table for rows of values.
+
+    The table is not created. Its rows are kept in the table's ``info``
+    and it is created and filled on a connection by ``load_value_tables``
+    while a statement that uses it runs. The table is named by a digest of
+    the rows, so statements that use different rows have different SQL.
+
+    :param columns: A list of (name, type) tuples
+    :param rows: A list of tuples of values
+    """
+    digest = hashlib.sha1(repr((columns, rows)).encode("utf-8")).hexdigest()[:16]
+    name = VALUE_TABLE_PREFIX + digest
+    table_columns = [Column(col_name, col_type) for col_name, col_type in columns]
+    info = {"value_rows": rows}
+    if dialect.name == "mssql":
+        # SQL Server temporary tables are named with a leading #
+        return Table("#" + name, MetaData(), *table_columns, info=info)
+    return Table(name, MetaData(), *table_columns, prefixes=["TEMPORARY"], info=info)
+
+
+def value_tables(statement):
+    """Return the tables made by value_table that a statement selects from."""
+    tables = {}
+    for element in visitors.iterate(statement):
+        if isinstance(element, Table) and "value_rows" in element.info:
+            tables.setdefault(element.name, element)
+    return list(tables.values())
+
+
+@contextmanager
+def load_value_tables(connection, statement):
+    """Create and fill the tables made by value_table that a statement uses
+    on a connection, and drop them when the block exits. Tables that
+    already exist on the connection are left alone."""
+    created = []
+    try:
+        for table in value_tables(statement):
+            if inspect(connection).has_table(table.name):
+                continue
+            table.create(connection)
+            created.append(table)
+            connection.execute(
+                table.insert(),
+                [dict(zip(table.c.keys(), row)) for row in table.info["value_rows"]],
+            )
+        yield
+    finally:
+        for table in reversed(created):
+            table.drop(connection)
+
+
+def large_in_list(condition, dialect, threshold):
+    """Rewrite an ``in`` or ``notin`` condition on more than threshold values
+    so the values are not rendered into the SQL.
+
+    On PostgreSQL the values are passed as a single array parameter
+    (``column = ANY(:values)`` or ``column != ALL(:values)``). On other
+    databases they are semi-joined from a temporary table made by
+    value_table (``column IN (SELECT value FROM recipe_values_...)``).
+    Other conditions, and conditions on columns with no type, are returned
+    unchanged.
+    """
+    # Lists that contain None are filtered with an OR, which is negated
+    # for notin
+    if isinstance(condition, UnaryExpression) and condition.operator is operators.inv:
+        element = condition.element
+        if isinstance(element, Grouping):
+            element = element.element
+        rewritten = large_in_list(element, dialect, threshold)
+        return condition if rewritten is element else not_(rewritten)
+    if isinstance(condition, BooleanClauseList) and condition.operator is operators.or_:
+        clauses = [large_in_list(c, dialect, threshold) for c in condition.clauses]
+        return or_(*clauses)
+    if not (
+        threshold
+        and isinstance(condition, BinaryExpression)
+        and condition.operator in (operators.in_op, operators.not_in_op)
+        and isinstance(condition.right, BindParameter)
+        and condition.right.expanding
+        and len(condition.right.value) > threshold
+    ):
+        return condition
+
+    column, values = condition.left, condition.right.value
+    if dialect.name in NO_TEMPORARY_TABLES or column.type._isnull:
+        return condition
+    negate = condition.operator is operators.not_in_op
+    if dialect.name == "postgresql":
+        array = literal(list(values), ARRAY(column.type))
+        return column != all_(array) if negate else column == any_(array)
+
+    table = value_table(dialect, [("value", column.type)], [(v,) for v in values])
+    cond = column.in_(select(table.c.value))
+    return not_(cond) if negate else cond
+
+
+def row_values_in(columns, rows, dialect, threshold=0):
+    """Build a condition that is true when a tuple of columns matches one
+    of a list of rows of values.
+
+    Rows are compared as row values (``(a, b) IN ((1, 2), (3, 4))``), so the
+    SQL grows linearly with the number of rows and databases can use
+    composite indexes. More than threshold rows are loaded into a temporary
+    table and matched with ``EXISTS``. Returns None if the database can't
+    compare row values.
+    """
+    if (
+        threshold
+        and len(rows) > threshold
+        and dialect.name not in NO_TEMPORARY_TABLES
+        and not any(col.type._isnull for col in columns)
+    ):
+        table = value_table(
+            dialect,
+            [(f"value_{idx}", col.type) for idx, col in enumerate(columns)],
+            [tuple(row) for row in rows],
+        )
+        return exists().where(
+            and_(*(value == col for value, col in zip(table.c, columns)))
+        )
+    if dialect.name in NO_ROW_VALUES:
+        return None
+    return tuple_(*columns).in_([tuple(row) for row in rows])
+
+
+def always_false(condition):
+    """Is a condition false for every row? Conditions that are ``false``,
+    ``in`` an empty list or an ``and`` of either are always false."""
+    if isinstance(condition, False_):
+        return True
+    if isinstance(condition, BooleanClauseList) and condition.operator is operators.and_:
+        return any(always_false(c) for c in condition.clauses)
+    return (
+        isinstance(condition, BinaryExpression)
+        and condition.operator is operators.in_op
+        and isinstance(condition.right, BindParameter)
+        and condition.right.expanding
+        and isinstance(condition.right.value, (list, tuple))
+        and not condition.right.value
+    )
+
+
+def _eq_or_in_values(condition):
+    """Return the expression and the list of values an ``eq`` or ``in``
+    condition compares, or None for other conditions."""
+    if not (
+        isinstance(condition, BinaryExpression)
+        and isinstance(condition.right, BindParameter)
+    ):
+        return None
+    right = condition.right
+    if condition.operator is operators.eq and not right.expanding:
+        values = [right.value]
+    elif (
+        condition.operator is operators.in_op
+        and right.expanding
+        and isinstance(right.value, (list, tuple))
+    ):
+        values = list(right.value)
+    else:
+        return None
+    if any(v is None for v in values):
+        return None
+    return condition.left, values
+
+
+# The types of expressions whose values compare in the database the same
+# way they compare in Python
+MERGEABLE_TYPES = (Boolean, Date, DateTime, Integer, Numeric)
+
+
+def simplify_filters(conditions):
+    """Simplify a list of conditions that are combined with ``and``.
+
+    ``eq`` and ``in`` conditions on the same expression are merged into a
+    single condition on the values they have in common, which drops repeated
+    conditions. If they have no values in common, the first of them is
+    replaced with ``false``. Conditions are only merged on numeric, date and
+    boolean expressions when all the values have the same Python type.
+    Other conditions are left for the database to evaluate, because the
+    database may compare them differently (for instance, strings under a
+    case insensitive collation).
+
+    :return: A list with an entry for each condition: the condition, the
+        condition that replaces it, or None if it is redundant.
+    """
+    groups = []
+    for idx, condition in enumerate(conditions):
+        found = _eq_or_in_values(condition)
+        if found is None:
+            continue
+        expression, values = found
+        for group in groups:
+            if group[0] is expression or group[0].compare(expression):
+                group[1].append(idx)
+                group[2].append(values)
+                break
+        else:
+            groups.append((expression, [idx], [values]))
+
+    simplified = list(conditions)
+    for expression, indexes, value_lists in groups:
+        if len(indexes) < 2 or not isinstance(expression.type, MERGEABLE_TYPES):
+            continue
+        if len({type(v) for values in value_lists for v in values}) != 1:
+            continue
+        common = list(dict.fromkeys(value_lists[0]))
+        for values in value_lists[1:]:
+            values = set(values)
+            common = [v for v in common if v in values]
+        if not common:
+            merged = false()
+        elif len(common) == 1:
+            merged = expression == common[0]
+        else:
+            merged = expression.in_(common)
+        simplified[indexes[0]] = merged
+        for idx in indexes[1:]:
+            simplified[idx] = None
+    return simplified
+
+
 def make_schema(recipe_extensions: list) -> dict:
     """Make a sureberus schema to validate a recipe.from_config."""
     schema = recipe_schema["schema"].copy()
@@ -0,0 +1,754 @@
+import os
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+from unittest import TestCase
+
+from freezegun import freeze_time
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine
+from sqlalchemy import distinct, event, func
+from sqlalchemy.orm import Session
+
+from recipe.caching import (
+    NO_VALUE,
+    MemoryCache,
+    SingleFlight,
+    SQLiteCache,
+    TieredCache,
+    configure_cache_region,
+    count_cache,
+    database_identity,
+    metric_aggregation,
+    reaggregate,
+    refresh_in_background,
+    single_flight,
+    time_partitions,
+)
+from recipe import AutomaticFilters, Dimension, Filter, Metric, Recipe, Shelf
+
+from .test_base import RecipeTestCase
+
+
+class MemoryCacheTestCase(TestCase):
+    def test_get_set(self):
+        cache = MemoryCache()
+        self.assertIs(cache.get("a"), NO_VALUE)
+        cache.set("a", [1, 2])
+        self.assertEqual(cache.get("a"), [1, 2])
+        cache.delete("a")
+        self.assertIs(cache.get("a"), NO_VALUE)
+
+    def test_values_are_copies(self):
+        cache = MemoryCache()
+        value = [1, 2]
+        cache.set("a", value)
+        value.append(3)
+        self.assertEqual(cache.get("a"), [1, 2])
+
+    def test_byte_budget(self):
+        """The least recently used values are evicted to stay in budget"""
+        cache = MemoryCache(max_bytes=2500)
+        cache.set("a", "a" * 1000)
+        cache.set("b", "b" * 1000)
+        cache.get("a")
+        cache.set("c", "c" * 1000)
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get("b"), NO_VALUE)
+        self.assertEqual(cache.get("a"), "a" * 1000)
+        self.assertLessEqual(cache.current_bytes, 2500)
+
+        # Values larger than the budget are not stored
+        cache.set("d", "d" * 3000)
+        self.assertIs(cache.get("d"), NO_VALUE)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.current_bytes), (0, 0))
+
+    def test_ttl(self):
+        cache = MemoryCache(default_ttl=60)
+        with freeze_time("2020-01-01 00:00:00") as frozen:
+            cache.set("a", 1)
+            cache.set("b", 2, ttl=600)
+            frozen.tick(120)
+            self.assertIs(cache.get("a"), NO_VALUE)
+            self.assertEqual(cache.get("b"), 2)
+
+
+class SQLiteCacheTestCase(TestCase):
+    def test_get_set(self):
+        cache = SQLiteCache(":memory:")
+        self.assertIs(cache.get("a"), NO_VALUE)
+        cache.set("a", {"x": 1})
+        self.assertEqual(cache.get("a"), {"x": 1})
+        cache.set("a", {"x": 2})
+        self.assertEqual(cache.get("a"), {"x": 2})
+        cache.clear()
+        self.assertIs(cache.get("a"), NO_VALUE)
+
+    def test_persistent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cache.db")
+            SQLiteCache(path).set("a", 1)
+            self.assertEqual(SQLiteCache(path).get("a"), 1)
+
+    def test_ttl(self):
+        cache = SQLiteCache(":memory:", default_ttl=60)
+        with freeze_time("2020-01-01 00:00:00") as frozen:
+            cache.set("a", 1)
+            frozen.tick(120)
+            self.assertIs(cache.get("a"), NO_VALUE)
+
+
+class TieredCacheTestCase(TestCase):
+    def test_tiers(self):
+        l1, l2 = MemoryCache(), SQLiteCache(":memory:")
+        cache = TieredCache(l1, l2)
+        cache.set("a", 1)
+        self.assertEqual((l1.get("a"), l2.get("a")), (1, 1))
+
+        # Values found in the second level are copied to the first
+        l1.clear()
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(l1.get("a"), 1)
+
+        cache.delete("a")
+        self.assertIs(cache.get("a"), NO_VALUE)
+
+    def test_ttl(self):
+        """Values copied to the first level keep their expiry time"""
+        l1, l2 = MemoryCache(), SQLiteCache(":memory:")
+        cache = TieredCache(l1, l2, default_ttl=600)
+        with freeze_time("2020-01-01 00:00:00") as frozen:
+            cache.set("a", 1, ttl=60)
+            cache.set("b", 2)
+            l1.clear()
+            frozen.tick(30)
+            self.assertEqual(cache.get("a"), 1)
+            self.assertEqual(cache.get("b"), 2)
+            frozen.tick(60)
+            self.assertIs(cache.get("a"), NO_VALUE)
+            self.assertIs(l1.get("a"), NO_VALUE)
+            self.assertEqual(cache.get("b"), 2)
+
+        # Values that never expire stay in the first level
+        cache = TieredCache(l1, l2)
+        cache.set("c", 3)
+        l1.clear()
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(l1.get_with_expiry("c"), (3, float("inf")))
+
+
+class SingleFlightTestCase(TestCase):
+    def run_threads(self, flight, fn, count=5):
+        """Call fn from count threads at once, returning the results"""
+        results = [None] * count
+        started = threading.Barrier(count + 1)
+
+        def worker(i):
+            started.wait()
+            try:
+                results[i] = flight.do("key", fn)
+            except ValueError as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        return threads, results
+
+    def test_threads(self):
+        """Concurrent callers share one execution"""
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            release.wait()
+            return [1, 2]
+
+        threads, results = self.run_threads(flight, fn)
+        while flight.executions + flight.coalesced < 5:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[1, 2]] * 5)
+        self.assertEqual((flight.executions, flight.coalesced), (1, 4))
+
+        # Later calls execute again
+        self.assertEqual(flight.do("key", lambda: 3), 3)
+        self.assertEqual((flight.executions, flight.coalesced), (2, 4))
+
+    def test_threads_exception(self):
+        """Waiting callers receive the exception"""
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def fn():
+            release.wait()
+            raise ValueError("bad")
+
+        threads, results = self.run_threads(flight, fn, count=3)
+        while flight.executions + flight.coalesced < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+
+class RefreshInBackgroundTestCase(TestCase):
+    def test_refresh(self):
+        """Only one refresh runs for a key at a time"""
+        started, release, calls = threading.Event(), threading.Event(), []
+
+        def refresh():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+
+        thread = refresh_in_background("a", refresh)
+        started.wait(5)
+        self.assertIsNone(refresh_in_background("a", refresh))
+        release.set()
+        thread.join(5)
+        self.assertEqual(len(calls), 1)
+
+        refresh_in_background("a", refresh).join(5)
+        self.assertEqual(len(calls), 2)
+
+    def test_refresh_error(self):
+        """Errors are logged and don't block later refreshes"""
+
+        def refresh():
+            raise ValueError("boom")
+
+        with self.assertLogs("recipe.caching", level="ERROR"):
+            refresh_in_background("b", refresh).join(5)
+        self.assertIsNotNone(refresh_in_background("b", lambda: None))
+
+
+class RecipeSingleFlightTestCase(RecipeTestCase):
+    def test_recipe_executions(self):
+        """Recipe queries run through single flight"""
+        single_flight.reset()
+        recipe = self.recipe().metrics("age").dimensions("last")
+        self.assertEqual(len(recipe.all()), 2)
+        self.assertEqual(recipe.total_count(), 2)
+        self.assertEqual(single_flight.executions, 2)
+
+    def test_bind_identity(self):
+        """Executions are only shared on the same engine and schemas"""
+        recipe = self.recipe()
+        engines = [create_engine("sqlite://") for _ in range(2)]
+        identities = [recipe._bind_identity(engine) for engine in engines]
+        self.assertEqual(repr(engines[0].url), repr(engines[1].url))
+        self.assertNotEqual(identities[0], identities[1])
+
+        translated = engines[0].execution_options(
+            schema_translate_map={None: "other"}
+        )
+        self.assertNotEqual(recipe._bind_identity(translated), identities[0])
+        self.assertEqual(recipe._bind_identity(engines[0]), identities[0])
+
+
+class RecipeResultCacheTestCase(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = MemoryCache()
+        configure_cache_region("test", self.cache)
+
+    def tearDown(self):
+        configure_cache_region("test", None)
+        super().tearDown()
+
+    def cached_results(self):
+        """The number of cached results, ignoring re-aggregation indexes"""
+        return len([key for key in self.cache._values if ":semantic:" not in key])
+
+    def make_recipe(self, age=0):
+        return (
+            self.recipe()
+            .metrics("age")
+            .dimensions("last")
+            .filters(self.basic_table.c.age > age)
+            .order_by("last")
+            .cache_region("test")
+        )
+
+    def test_result_cache(self):
+        recipe = self.make_recipe()
+        self.assertRecipeCSV(
+            recipe,
+            """
+            last,age,last_id
+            fred,10,fred
+            there,5,there
+            """,
+        )
+        self.assertFalse(recipe.stats.from_cache)
+        self.assertEqual(self.cached_results(), 1)
+
+        # A new recipe reads results from the cache
+        recipe = self.make_recipe()
+        self.assertRecipeCSV(
+            recipe,
+            """
+            last,age,last_id
+            fred,10,fred
+            there,5,there
+            """,
+        )
+        self.assertTrue(recipe.stats.from_cache)
+
+        # Different parameters use a different key
+        recipe = self.make_recipe(age=7)
+        self.assertEqual(len(recipe.all()), 1)
+        self.assertFalse(recipe.stats.from_cache)
+        self.assertEqual(self.cached_results(), 2)
+
+    def test_core_execution(self):
+        """Results are shared between execution modes"""
+        self.make_recipe().all()
+        recipe = self.make_recipe().execution_mode("core")
+        self.assertEqual([row.last for row in recipe.all()], ["fred", "there"])
+        self.assertTrue(recipe.stats.from_cache)
+
+    def test_use_cache(self):
+        """If use_cache is False, results are refreshed"""
+        self.make_recipe().all()
+        recipe = self.make_recipe().use_cache(False)
+        recipe.all()
+        self.assertFalse(recipe.stats.from_cache)
+        self.assertEqual(self.cached_results(), 1)
+
+    def test_cache_prefix(self):
+        self.make_recipe().all()
+        recipe = self.make_recipe().cache_prefix("other")
+        recipe.all()
+        self.assertFalse(recipe.stats.from_cache)
+        self.assertEqual(self.cached_results(), 2)
+
+    def test_cache_ttl(self):
+        with freeze_time("2020-01-01 00:00:00") as frozen:
+            self.make_recipe().cache_ttl(60).all()
+            frozen.tick(120)
+            recipe = self.make_recipe()
+            recipe.all()
+            self.assertFalse(recipe.stats.from_cache)
+
+    def test_total_count(self):
+        self.assertEqual(self.make_recipe().total_count(), 2)
+        self.assertEqual(self.cached_results(), 1)
+        recipe = self.make_recipe()
+        recipe._fetch_count = None
+        self.assertEqual(recipe.total_count(), 2)
+
+    def test_no_region(self):
+        """Results are not cached if the region is not configured"""
+        recipe = self.make_recipe().cache_region("unconfigured")
+        recipe.all()
+        self.assertFalse(recipe.stats.from_cache)
+        self.assertEqual(self.cached_results(), 0)
+
+    def test_separate_databases(self):
+        """Recipes on different databases or schemas don't share results"""
+        table = Table("nums", MetaData(), Column("num", Integer))
+        shelf = Shelf({"num": Dimension(table.c.num)})
+        engine, other_engine = create_engine("sqlite://"), create_engine("sqlite://")
+        engine.execute("ATTACH DATABASE ':memory:' AS other")
+        translated = engine.execution_options(schema_translate_map={None: "other"})
+        binds = [engine, other_engine, translated]
+        for num, bind in enumerate(binds):
+            table.create(bind)
+            bind.execute(table.insert(), [{"num": num}])
+
+        for num, bind in enumerate(binds):
+            recipe = (
+                Recipe(shelf=shelf, session=Session(bind=bind))
+                .dimensions("num")
+                .cache_region("test")
+            )
+            self.assertEqual([row.num for row in recipe.all()], [num])
+            self.assertFalse(recipe.stats.from_cache)
+        self.assertEqual(self.cached_results(), 3)
+
+
+class DatabaseIdentityTestCase(TestCase):
+    def test_database_identity(self):
+        """Databases are identified by their url and schema translate map"""
+        identity = database_identity(create_engine("sqlite:///a.sqlite"))
+        self.assertEqual(
+            database_identity(create_engine("sqlite:///a.sqlite")), identity
+        )
+        self.assertNotEqual(
+            database_identity(create_engine("sqlite:///b.sqlite")), identity
+        )
+        translated = create_engine("sqlite:///a.sqlite").execution_options(
+            schema_translate_map={None: "tenant"}
+        )
+        self.assertNotEqual(database_identity(translated), identity)
+
+        # In-memory SQLite databases don't share data
+        self.assertNotEqual(
+            database_identity(create_engine("sqlite://")),
+            database_identity(create_engine("sqlite://")),
+        )
+
+
+class SharedCountTestCase(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        count_cache.clear()
+
+    def make_recipe(self):
+        return self.recipe().metrics("age").dimensions("last")
+
+    def test_shared_count(self):
+        """Counts with a ttl are shared without a cache region"""
+        with freeze_time("2020-01-01 00:00:00") as frozen:
+            self.assertEqual(self.make_recipe().total_count(ttl=60), 2)
+            self.assertEqual(len(count_cache), 1)
+
+            recipe = self.make_recipe()
+            recipe._fetch_count = None
+            self.assertEqual(recipe.total_count(ttl=60), 2)
+
+            # Counts expire
+            frozen.tick(120)
+            self.assertEqual(self.make_recipe().total_count(ttl=60), 2)
+            recipe = self.make_recipe().use_cache(False)
+            self.assertEqual(recipe.total_count(ttl=60), 2)
+
+    def test_separate_databases(self):
+        """Counts are not shared between databases"""
+        table = Table("nums", MetaData(), Column("num", Integer))
+        shelf = Shelf({"num": Dimension(table.c.num)})
+        for count in (1, 2):
+            engine = create_engine("sqlite://")
+            table.create(engine)
+            engine.execute(table.insert(), [{"num": num} for num in range(count)])
+            recipe = Recipe(shelf=shelf, session=Session(bind=engine))
+            self.assertEqual(recipe.dimensions("num").total_count(ttl=60), count)
+        self.assertEqual(len(count_cache), 2)
+
+    def test_refresh(self):
+        """Stale counts are returned and recounted in the background"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = create_engine(f"sqlite:///{os.path.join(tmpdir, 'db.sqlite')}")
+            table = Table("nums", MetaData(), Column("num", Integer))
+            table.create(engine)
+            engine.execute(table.insert(), [{"num": 1}, {"num": 2}])
+            shelf = Shelf({"num": Dimension(table.c.num)})
+
+            def total_count(refresh=None):
+                recipe = Recipe(shelf=shelf, session=Session(bind=engine))
+                return recipe.dimensions("num").total_count(ttl=600, refresh=refresh)
+
+            self.assertEqual(total_count(), 2)
+            engine.execute(table.insert(), [{"num": 3}])
+
+            # The stale count is returned while the count is refreshed
+            self.assertEqual(total_count(refresh=0), 2)
+            for _ in range(100):
+                if total_count() == 3:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(total_count(), 3)
+            engine.dispose()
+
+    def test_refresh_value_tables(self):
+        """Counts of recipes that filter on temporary tables of values are
+        refreshed in the background on a connection that loads the values"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine = create_engine(f"sqlite:///{os.path.join(tmpdir, 'db.sqlite')}")
+            table = Table("nums", MetaData(), Column("num", Integer))
+            table.create(engine)
+            engine.execute(table.insert(), [{"num": 1}, {"num": 2}])
+            shelf = Shelf({"num": Dimension(table.c.num)})
+
+            def total_count(refresh=None):
+                with Session(bind=engine) as session:
+                    recipe = (
+                        Recipe(
+                            shelf=shelf,
+                            session=session,
+                            extension_classes=[AutomaticFilters],
+                        )
+                        .dimensions("num")
+                        .automatic_filters({"num": list(range(20))})
+                        .automatic_filter_list_threshold(10)
+                    )
+                    self.assertIn("recipe_values_", recipe.to_sql())
+                    return recipe.total_count(ttl=600, refresh=refresh)
+
+            self.assertEqual(total_count(), 2)
+            engine.execute(table.insert(), [{"num": 3}])
+            self.assertEqual(total_count(refresh=0), 2)
+            for _ in range(100):
+                if total_count() == 3:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(total_count(), 3)
+            engine.dispose()
+
+
+class TimePartitionsTestCase(TestCase):
+    def test_time_partitions(self):
+        today = date(2020, 5, 17)
+        self.assertEqual(
+            time_partitions(today, "month"),
+            [
+                (None, date(2020, 1, 1), True),
+                (date(2020, 1, 1), date(2020, 5, 1), True),
+                (date(2020, 5, 1), None, False),
+            ],
+        )
+        self.assertEqual(
+            time_partitions(today, "year"),
+            [(None, date(2020, 1, 1), True), (date(2020, 1, 1), None, False)],
+        )
+        self.assertEqual(
+            time_partitions(today, "day", "datetime"),
+            [
+                (None, datetime(2020, 1, 1), True),
+                (datetime(2020, 1, 1), datetime(2020, 5, 17), True),
+                (datetime(2020, 5, 17), None, False),
+            ],
+        )
+
+
+class IncrementalCacheTestCase(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = MemoryCache()
+        configure_cache_region("test", self.cache)
+        single_flight.reset()
+        table = self.datatypes_table
+        self.shelf = Shelf(
+            {
+                "month": Dimension(
+                    func.date(table.c.test_date, "start of month"),
+                    datatype_by_role={"value": "date"},
+                    date_aggregation="month",
+                ),
+                "department": Dimension(table.c.department),
+                "score": Metric(func.sum(table.c.score)),
+            }
+        )
+
+    def tearDown(self):
+        configure_cache_region("test", None)
+        super().tearDown()
+
+    def make_recipe(self, *order_by):
+        return (
+            self.recipe()
+            .dimensions("month")
+            .metrics("score")
+            .order_by(*order_by)
+            .cache_region("test")
+            .incremental_cache()
+        )
+
+    @freeze_time("2005-02-15")
+    def test_incremental_cache(self):
+        for _ in range(2):
+            self.assertRecipeCSV(
+                self.make_recipe("month"),
+                """
+                month,score,month_id
+                2005-01-01,250.0,2005-01-01
+                2005-02-01,270.0,2005-02-01
+                """,
+            )
+        # The closed partitions are only queried once
+        self.assertEqual(single_flight.executions, 4)
+        self.assertEqual(len(self.cache), 2)
+
+        # Partitions are merged in the requested order
+        self.assertRecipeCSV(
+            self.make_recipe("-month"),
+            """
+            month,score,month_id
+            2005-02-01,270.0,2005-02-01
+            2005-01-01,250.0,2005-01-01
+            """,
+        )
+
+    @freeze_time("2005-02-15")
+    def test_incremental_cache_multiple_dimensions(self):
+        recipe = self.make_recipe("month", "department").dimensions(
+            "month", "department"
+        )
+        self.assertRecipeCSV(
+            recipe,
+            """
+            department,month,score,department_id,month_id
+            ops,2005-01-01,170.0,ops,2005-01-01
+            sales,2005-01-01,80.0,sales,2005-01-01
+            ops,2005-02-01,270.0,ops,2005-02-01
+            """,
+        )
+        self.assertEqual(single_flight.executions, 3)
+
+    def test_not_incremental(self):
+        """Recipes that can't be split into partitions are queried normally"""
+        for recipe in (
+            self.make_recipe("score"),
+            self.make_recipe("month").limit(5),
+            self.make_recipe().incremental_cache("department"),
+            self.make_recipe().cache_region("unconfigured"),
+        ):
+            single_flight.reset()
+            self.assertEqual(len(recipe.all()), 2)
+            self.assertEqual(single_flight.executions, 1)
+
+
+class ReaggregateTestCase(TestCase):
+    def test_metric_aggregation(self):
+        from sqlalchemy import column
+
+        self.assertEqual(metric_aggregation(func.sum(column("x"))), "sum")
+        self.assertEqual(metric_aggregation(func.count(column("x"))), "sum")
+        self.assertEqual(metric_aggregation(func.max(column("x")).label("y")), "max")
+        self.assertEqual(metric_aggregation(func.count(distinct(column("x")))), None)
+        self.assertEqual(metric_aggregation(func.avg(column("x"))), None)
+        self.assertEqual(metric_aggregation(func.sum(column("x")) + 1), None)
+
+    def test_reaggregate(self):
+        frozen = (
+            ("a", "b", "total", "high"),
+            [("x", 1, 5, 3), ("x", 2, None, 7), ("y", 1, 2, None)],
+        )
+        self.assertEqual(
+            reaggregate(
+                frozen, ["a", "total", "high"], ["a"], {"total": "sum", "high": "max"}
+            ),
+            (("a", "total", "high"), [("x", 5, 7), ("y", 2, None)]),
+        )
+        self.assertEqual(
+            reaggregate(frozen, ["total"], [], {"total": "sum"}),
+            (("total",), [(7,)]),
+        )
+
+
+class RecipeReaggregateTestCase(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = MemoryCache()
+        configure_cache_region("test", self.cache)
+        table = self.census_table
+        self.shelf = Shelf(
+            {
+                "state": Dimension(table.c.state),
+                "sex": Dimension(table.c.sex),
+                "pop2000": Metric(func.sum(table.c.pop2000)),
+                "count": Metric(func.count(table.c.age)),
+                "max_pop2000": Metric(func.max(table.c.pop2000)),
+                "ages": Metric(func.count(distinct(table.c.age))),
+                "vermont": Filter(table.c.state == "Vermont"),
+            }
+        )
+
+        self.queries = []
+        event.listen(self.oven.engine, "before_cursor_execute", self.count_query)
+
+    def tearDown(self):
+        event.remove(self.oven.engine, "before_cursor_execute", self.count_query)
+        configure_cache_region("test", None)
+        super().tearDown()
+
+    def count_query(self, conn, cursor, statement, *args):
+        self.queries.append(statement)
+
+    def make_recipe(self, dimensions, metrics=("pop2000", "count", "max_pop2000")):
+        return (
+            self.recipe()
+            .dimensions(*dimensions)
+            .metrics(*metrics)
+            .cache_region("test")
+        )
+
+    def test_reaggregate(self):
+        """Coarser recipes are answered from cached results"""
+        self.make_recipe(["state", "sex"]).all()
+        self.queries = []
+
+        recipe = self.make_recipe(["state"]).order_by("-pop2000")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            state,count,max_pop2000,pop2000,state_id
+            Tennessee,172,60206,5685230,Tennessee
+            Vermont,172,7300,609480,Vermont
+            """,
+        )
+        self.assertTrue(recipe.stats.from_cache)
+        self.assertEqual(self.queries, [])
+
+        recipe = self.make_recipe([])
+        self.assertRecipeCSV(
+            recipe,
+            """
+            count,max_pop2000,pop2000
+            344,60206,6294710
+            """,
+        )
+        self.assertEqual(self.queries, [])
+
+        # The results match the database
+        configure_cache_region("test", None)
+        self.assertRecipeCSV(
+            self.make_recipe(["state"]).order_by("-pop2000"),
+            """
+            state,count,max_pop2000,pop2000,state_id
+            Tennessee,172,60206,5685230,Tennessee
+            Vermont,172,7300,609480,Vermont
+            """,
+        )
+
+    def test_reaggregate_filtered(self):
+        """Recipes with the same filters are answered from cached results"""
+        self.make_recipe(["state", "sex"]).filters("vermont").all()
+        self.queries = []
+
+        recipe = self.make_recipe(["state"]).filters("vermont")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            state,count,max_pop2000,pop2000,state_id
+            Vermont,172,7300,609480,Vermont
+            """,
+        )
+        self.assertTrue(recipe.stats.from_cache)
+        self.assertEqual(self.queries, [])
+
+        # Other filters use the database
+        recipe = self.make_recipe(["state"]).filters(
+            self.census_table.c.state == "Tennessee"
+        )
+        recipe.all()
+        self.assertFalse(recipe.stats.from_cache)
+        self.assertEqual(len(self.queries), 1)
+
+    def test_not_reaggregated(self):
+        """Recipes that can't be answered from cached results use the
+        database"""
+        self.make_recipe(["state", "sex"]).all()
+        for recipe in (
+            self.make_recipe(["state"], ["pop2000", "ages"]),
+            self.make_recipe(["state"]).filters("vermont"),
+            self.make_recipe(["state"]).limit(1),
+            # Strings are ordered by the database's collation
+            self.make_recipe(["state"]).order_by("state"),
+            self.make_recipe(["state"]).use_cache(False),
+        ):
+            self.queries = []
+            recipe.all()
+            self.assertFalse(recipe.stats.from_cache)
+            self.assertEqual(len(self.queries), 1)
@@ -0,0 +1,157 @@
+from unittest import TestCase
+
+import pytest
+from tests.test_base import RecipeTestCase
+
+from recipe import BadRecipe
+from recipe.caching import MemoryCache, configure_cache_region
+from recipe.events import RecipeEvent, RecipeEvents, events
+
+
+class RecipeEventsTestCase(TestCase):
+    def test_on_off(self):
+        registry = RecipeEvents()
+        received = []
+        self.assertFalse(registry.listening("query_built"))
+        registry.on("query_built", received.append)
+        self.assertTrue(registry.listening("query_built"))
+
+        event = RecipeEvent("query_built", "abc", None, 0.1, {})
+        registry.emit(event)
+        self.assertEqual(received, [event])
+
+        registry.off("query_built", received.append)
+        self.assertFalse(registry.listening("query_built"))
+        registry.emit(event)
+        self.assertEqual(received, [event])
+
+    def test_decorator(self):
+        registry = RecipeEvents()
+        received = []
+
+        @registry.on("enchanted")
+        def listener(event):
+            received.append(event.name)
+
+        registry.emit(RecipeEvent("enchanted", "abc", None, 0.1, {}))
+        self.assertEqual(received, ["enchanted"])
+
+    def test_parent(self):
+        """Events are also sent to the parent registry"""
+        parent = RecipeEvents()
+        registry = RecipeEvents(parent=parent)
+        received = []
+        parent.on("cache_hit", received.append)
+        self.assertTrue(registry.listening("cache_hit"))
+        registry.emit(RecipeEvent("cache_hit", "abc", None, None, {}))
+        self.assertEqual(len(received), 1)
+
+    def test_unknown_event(self):
+        with pytest.raises(BadRecipe):
+            RecipeEvents().on("nope", print)
+
+
+class RecipeLifecycleTestCase(RecipeTestCase):
+    def listen(self, recipe):
+        received = []
+        for name in (
+            "query_built",
+            "sql_compiled",
+            "before_execute",
+            "after_execute",
+            "rows_fetched",
+            "enchanted",
+            "cache_hit",
+            "cache_miss",
+        ):
+            recipe.events.on(name, received.append)
+        return received
+
+    def test_lifecycle(self):
+        recipe = self.recipe().metrics("age").dimensions("last")
+        received = self.listen(recipe)
+        recipe.all()
+        self.assertEqual(
+            [event.name for event in received],
+            [
+                "query_built",
+                "sql_compiled",
+                "before_execute",
+                "after_execute",
+                "rows_fetched",
+                "enchanted",
+            ],
+        )
+        for event in received:
+            self.assertEqual(event.recipe_id, recipe._id)
+            self.assertEqual(event.fingerprint, received[0].fingerprint)
+        self.assertGreater(received[0].elapsed, 0.0)
+        self.assertEqual(received[-1].info["rows"], 2)
+
+    def test_fingerprint(self):
+        """Recipes with the same structure share a fingerprint"""
+        fingerprints = []
+        for age in (1, 2):
+            recipe = (
+                self.recipe()
+                .metrics("age")
+                .dimensions("last")
+                .filters(self.basic_table.c.age > age)
+            )
+            received = self.listen(recipe)
+            recipe.all()
+            fingerprints.append(received[0].fingerprint)
+        self.assertEqual(fingerprints[0], fingerprints[1])
+
+        recipe = self.recipe().metrics("age").dimensions("first")
+        received = self.listen(recipe)
+        recipe.all()
+        self.assertNotEqual(received[0].fingerprint, fingerprints[0])
+
+    def test_iter(self):
+        recipe = self.recipe().metrics("age").dimensions("last")
+        received = self.listen(recipe)
+        list(recipe.iter(batch_size=1))
+        self.assertEqual(
+            [event.name for event in received],
+            [
+                "query_built",
+                "before_execute",
+                "rows_fetched",
+                "enchanted",
+                "rows_fetched",
+                "enchanted",
+                "after_execute",
+            ],
+        )
+
+    def test_cache_events(self):
+        configure_cache_region("test", MemoryCache())
+        try:
+            names = []
+            for _ in range(2):
+                recipe = (
+                    self.recipe()
+                    .metrics("age")
+                    .dimensions("last")
+                    .cache_region("test")
+                )
+                received = self.listen(recipe)
+                recipe.all()
+                names.append(
+                    [e.name for e in received if e.name.startswith("cache_")]
+                )
+            self.assertEqual(names, [["cache_miss"], ["cache_hit"]])
+        finally:
+            configure_cache_region("test", None)
+
+    def test_global_listeners(self):
+        """Listeners can be attached to every recipe"""
+        received = []
+        events.on("query_built", received.append)
+        try:
+            recipe = self.recipe().metrics("age").dimensions("last")
+            recipe.to_sql()
+        finally:
+            events.off("query_built", received.append)
+        self.assertEqual([event.recipe_id for event in received], [recipe._id])
@@ -1,22 +1,29 @@
 from json import dumps
 from copy import copy
+from unittest import TestCase
 from faker import Faker
-from sqlalchemy import func, and_, or_
+from sqlalchemy import event, func, inspect, and_, or_
 from sureberus.errors import BadType, SureError
 
 from recipe import BadRecipe, Dimension, Metric, Recipe, Shelf
 from recipe.extensions import (
     Anonymize,
+    AutoPaginate,
     AutomaticFilters,
     BlendRecipe,
     CompareRecipe,
     Paginate,
     PaginateInline,
     PaginateCountOver,
+    PaginateKeyset,
     RecipeExtension,
     handle_directives,
+    PaginationCosts,
     is_compound_filter,
+    pagination_costs,
 )
+from recipe.caching import count_cache
+from recipe.search import value_indexes
 from recipe.utils import generate_faker_seed, recipe_arg
 from tests.test_base import RecipeTestCase
 
@@ -219,6 +226,8 @@ class AutomaticFiltersTestCase(RecipeTestCase):
             {"exclude_automatic_filter_keys": []},
             {"apply_automatic_filters": True},
             {"strict_automatic_filters": True},
+            {"automatic_filter_list_threshold": 0},
+            {"automatic_filter_list_threshold": None},
         ]
         for extra_config in valid_configs:
             config = copy(base_config)
@@ -239,6 +248,7 @@ class AutomaticFiltersTestCase(RecipeTestCase):
             {"exclude_automatic_filter_keys": "potato"},
             # Values must be lists of strings
             {"apply_automatic_filters": "TRUE"},
+            {"automatic_filter_list_threshold": -1},
         ]
         for extra_config in invalid_configs:
             config = copy(base_config)
@@ -345,6 +355,185 @@ class AutomaticFiltersTestCase(RecipeTestCase):
             GROUP BY first""",
             )
 
+    def test_large_automatic_filters(self):
+        """Filters on long lists of values use a temporary table"""
+        self.shelf = self.census_shelf
+        states = ["Tennessee", "Vermont"] + [f"State {i}" for i in range(10)]
+        for recipe in self.recipe_list(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["state"],
+                "automatic_filters": {"state": states},
+                "automatic_filter_list_threshold": 10,
+            }
+        ):
+            self.assertRecipeSQLContains(recipe, "FROM recipe_values_")
+            self.assertRecipeSQLNotContains(recipe, "Vermont")
+            self.assertRecipeCSV(
+                recipe,
+                """
+                state,pop2000,state_id
+                Tennessee,5685230,Tennessee
+                Vermont,609480,Vermont
+                """,
+            )
+
+        recipe = self.recipe_from_config(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["state"],
+                "automatic_filters": {"state__notin": states[1:] + [None]},
+                "automatic_filter_list_threshold": 10,
+            }
+        )
+        self.assertRecipeSQLContains(recipe, "FROM recipe_values_")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            state,pop2000,state_id
+            Tennessee,5685230,Tennessee
+            """,
+        )
+
+        # Lists are filtered with IN unless a threshold is set
+        recipe = self.recipe_from_config(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["state"],
+                "automatic_filters": {"state": states},
+            }
+        )
+        self.assertRecipeSQLContains(recipe, "'Vermont'")
+
+    def test_large_automatic_filters_load(self):
+        """Temporary tables are only created while the query runs"""
+        self.shelf = self.census_shelf
+        recipe = self.recipe_from_config(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["state"],
+                "automatic_filters": {"state": [f"State {i}" for i in range(20)]},
+                "automatic_filter_list_threshold": 10,
+            }
+        )
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.session.get_bind()
+        event.listen(engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, engine, "before_cursor_execute", record)
+        self.assertIn("recipe_values_", recipe.to_sql())
+        self.assertEqual(statements, [])
+        self.assertEqual(recipe.all(), [])
+        self.assertEqual(recipe.total_count(), 0)
+        created = [s for s in statements if s.startswith("\nCREATE TEMPORARY")]
+        dropped = [s for s in statements if s.startswith("\nDROP TABLE")]
+        self.assertEqual(len(created), 2)
+        self.assertEqual(len(dropped), 2)
+        tables = inspect(self.session.connection()).get_temp_table_names()
+        self.assertEqual(tables, [])
+
+    def test_compound_row_values(self):
+        """Compound filters compare row values"""
+        self.shelf = self.census_shelf
+        rows = [["Tennessee", "M"], ["Vermont", "F"]]
+        for threshold, sql in ((0, "VALUES"), (1, "FROM recipe_values_")):
+            recipe = self.recipe_from_config(
+                {
+                    "metrics": ["pop2000"],
+                    "dimensions": ["state", "sex"],
+                    "automatic_filters": {"state,sex": rows},
+                    "automatic_filter_list_threshold": threshold,
+                }
+            )
+            self.assertRecipeSQLContains(recipe, sql)
+            self.assertRecipeSQLNotContains(recipe, " OR ")
+            self.assertRecipeCSV(
+                recipe,
+                """
+                sex,state,pop2000,sex_id,state_id
+                F,Vermont,310948,F,Vermont
+                M,Tennessee,2761277,M,Tennessee
+                """,
+            )
+
+        # Rows with other operators are filtered with OR
+        recipe = self.recipe_from_config(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["state", "sex"],
+                "automatic_filters": {"state,sex__like": rows},
+            }
+        )
+        self.assertRecipeSQLContains(recipe, " OR ")
+        self.assertRecipeSQLNotContains(recipe, "VALUES")
+
+    def test_simplified_automatic_filters(self):
+        """Filters on the same numeric dimension are merged and filters that
+        contradict each other don't run a query"""
+        self.shelf = self.census_shelf
+        recipe = self.recipe_from_config(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["age"],
+                "automatic_filters": [{"age": [1, 2]}, {"age": 2}],
+            }
+        )
+        self.assertRecipeSQLContains(recipe, "WHERE census.age = 2")
+        self.assertRecipeSQLNotContains(recipe, "IN")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            age,pop2000,age_id
+            2,81175,2
+            """,
+        )
+
+        # Strings are compared by the database
+        recipe = self.recipe_from_config(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["state"],
+                "automatic_filters": [
+                    {"state": ["Tennessee", "Vermont"]},
+                    {"state": "Vermont"},
+                ],
+            }
+        )
+        self.assertRecipeSQLContains(recipe, "Tennessee")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            state,pop2000,state_id
+            Vermont,609480,Vermont
+            """,
+        )
+
+        for automatic_filters in ([{"age": [1]}, {"age": 2}], {"state": []}):
+            recipe = self.recipe_from_config(
+                {
+                    "metrics": ["pop2000"],
+                    "dimensions": ["state"],
+                    "automatic_filters": automatic_filters,
+                }
+            )
+            executed = []
+            recipe.events.on("before_execute", executed.append)
+            self.assertEqual(recipe.all(), [])
+            self.assertEqual(recipe.total_count(), 0)
+            self.assertEqual(executed, [])
+
+            # An ungrouped aggregate returns one row
+            recipe = self.recipe_from_config(
+                {"metrics": ["pop2000"], "automatic_filters": automatic_filters}
+            )
+            rows = recipe.all()
+            self.assertEqual(len(rows), 1)
+            self.assertIsNone(rows[0].pop2000)
+            self.assertEqual(recipe.total_count(), 1)
+
     def test_multiple_automatic_filters(self):
         """Automatic filters can be passed multiple times and all will apply"""
         for recipe in self.recipe_list(
@@ -558,12 +747,14 @@ class AutomaticFiltersTestCase(RecipeTestCase):
                 {"first,last": [["foo", "moo"]]},
                 "foo.first = 'foo'\n  AND foo.last = 'moo'",
             ),
+            # Compound filters on several rows compare row values
             (
                 {"first,last": [["foo", "moo"], ["chicken", "cluck"]]},
-                """foo.first = 'foo'
-  AND foo.last = 'moo'
-  OR foo.first = 'chicken'
-  AND foo.last = 'cluck'""",
+                """WHERE (foo.first,
+       foo.last) IN (
+                     VALUES ('foo',
+                             'moo'), ('chicken',
+                                      'cluck'))""",
             ),
             # Unbalanced compound filters
             (
@@ -589,10 +780,11 @@ class AutomaticFiltersTestCase(RecipeTestCase):
             # Compound filters, json encoded, multiple items
             (
                 {"first,last": ['["foo", "moo"]', '["chicken", "cluck"]']},
-                """foo.first = 'foo'
-  AND foo.last = 'moo'
-  OR foo.first = 'chicken'
-  AND foo.last = 'cluck'""",
+                """WHERE (foo.first,
+       foo.last) IN (
+                     VALUES ('foo',
+                             'moo'), ('chicken',
+                                      'cluck'))""",
             ),
             (
                 {"first__in,first__notin": ['[["foo"], ["moo","cow"]]']},
@@ -955,6 +1147,15 @@ class PaginateTestCase(RecipeTestCase):
         super().setUp()
         self.shelf = self.census_shelf
 
+    def assertRecipeOffset(self, recipe, offset):
+        """The recipe fetches the page at this offset"""
+        sql = recipe.to_sql()
+        if "recipe_row_number" in sql:
+            # The offset is clamped to the last page in the query
+            self.assertIn(f"THEN {offset}", sql)
+        else:
+            self.assertIn(f"OFFSET {offset}", sql)
+
     def test_from_config(self):
         """Check the internal state of an extension after configuration"""
         for recipe in self.recipe_list(
@@ -1018,6 +1219,11 @@ class PaginateTestCase(RecipeTestCase):
             {"pagination_page_size": 0},
             {"pagination_page": -1},
             {"pagination_page": 100},
+            {"pagination_count_ttl": 60},
+            {"pagination_count_ttl": 60, "pagination_count_refresh": 10},
+            {"pagination_count_mode": "capped", "pagination_count_cap": 5},
+            {"pagination_count_mode": "estimate"},
+            {"pagination_q": "T%", "pagination_search_index": 60},
         ]
         for extra_config in valid_configs:
             config = copy(base_config)
@@ -1041,6 +1247,11 @@ class PaginateTestCase(RecipeTestCase):
             {"pagination_page_size": -5},
             {"pagination_page": ["foo"]},
             {"pagination_page": 900.0},
+            {"pagination_count_ttl": -1},
+            {"pagination_count_refresh": "a"},
+            {"pagination_count_mode": "guess"},
+            {"pagination_count_cap": 0},
+            {"pagination_search_index": -1},
         ]
         for extra_config in invalid_configs:
             config = copy(base_config)
@@ -1061,7 +1272,7 @@ class PaginateTestCase(RecipeTestCase):
             {"metrics": ["pop2000"], "dimensions": ["age"], "pagination_page_size": 10}
         ):
             self.assertRecipeSQLContains(recipe, "LIMIT 10")
-            self.assertRecipeSQLContains(recipe, "OFFSET 0")
+            self.assertRecipeOffset(recipe, 0)
             self.assertEqual(
                 recipe.validated_pagination(),
                 {"page": 1, "pageSize": 10, "requestedPage": 1, "totalItems": 86},
@@ -1070,7 +1281,7 @@ class PaginateTestCase(RecipeTestCase):
             # Let's go to the second page
             recipe = recipe.pagination_page(2)
             self.assertRecipeSQLContains(recipe, "LIMIT 10")
-            self.assertRecipeSQLContains(recipe, "OFFSET 10")
+            self.assertRecipeOffset(recipe, 10)
 
             self.assertEqual(
                 recipe.validated_pagination(),
@@ -1080,7 +1291,7 @@ class PaginateTestCase(RecipeTestCase):
             # Let's go to an impossible page
             recipe = recipe.pagination_page(9)
             self.assertRecipeSQLContains(recipe, "LIMIT 10")
-            self.assertRecipeSQLContains(recipe, "OFFSET 80")
+            self.assertRecipeOffset(recipe, 80)
 
             # page is clamped to the real value
             self.assertEqual(
@@ -1090,7 +1301,7 @@ class PaginateTestCase(RecipeTestCase):
 
             recipe = recipe.pagination_page(-1)
             self.assertRecipeSQLContains(recipe, "LIMIT 10")
-            self.assertRecipeSQLContains(recipe, "OFFSET 0")
+            self.assertRecipeOffset(recipe, 0)
 
             self.assertEqual(
                 recipe.validated_pagination(),
@@ -1109,6 +1320,22 @@ class PaginateTestCase(RecipeTestCase):
                 {"page": 1, "pageSize": 5, "requestedPage": 1, "totalItems": 0},
             )
 
+    def test_past_last_page(self):
+        """Pages past the last page return the last page"""
+        recipe = self.recipe_from_config(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["age"],
+                "pagination_page_size": 10,
+                "pagination_page": 20,
+            }
+        )
+        self.assertEqual(len(recipe.all()), 6)
+        self.assertEqual(
+            recipe.validated_pagination(),
+            {"requestedPage": 20, "page": 9, "pageSize": 10, "totalItems": 86},
+        )
+
     def test_apply_pagination(self):
         for recipe in self.recipe_list(
             {
@@ -1272,6 +1499,250 @@ class PaginateTestCase(RecipeTestCase):
         )
 
 
+class PaginateCountTTLTestCase(RecipeTestCase):
+    """Total counts can be shared between pages"""
+
+    extension_classes = [Paginate]
+
+    def setUp(self):
+        super().setUp()
+        self.shelf = self.census_shelf
+        count_cache.clear()
+        self.counts = []
+        event.listen(self.oven.engine, "before_cursor_execute", self.count_query)
+
+    def tearDown(self):
+        event.remove(self.oven.engine, "before_cursor_execute", self.count_query)
+        super().tearDown()
+
+    def count_query(self, conn, cursor, statement, *args):
+        if "count(*)" in statement:
+            self.counts.append(statement)
+
+    def test_count_ttl(self):
+        config = {
+            "metrics": ["pop2000"],
+            "dimensions": ["age"],
+            "pagination_page_size": 10,
+            "pagination_count_ttl": 60,
+        }
+        for page in (1, 2, 3):
+            recipe = self.recipe_from_config(dict(config, pagination_page=page))
+            self.assertEqual(len(recipe.all()), 10)
+            self.assertEqual(
+                recipe.validated_pagination(),
+                {"requestedPage": page, "page": page, "pageSize": 10, "totalItems": 86},
+            )
+        self.assertEqual(len(self.counts), 1)
+
+        # Without a ttl, every page is counted
+        del config["pagination_count_ttl"]
+        for page in (1, 2):
+            self.recipe_from_config(dict(config, pagination_page=page)).all()
+        self.assertEqual(len(self.counts), 3)
+
+
+class PaginateCountModeTestCase(RecipeTestCase):
+    """Total counts can be approximate"""
+
+    extension_classes = [Paginate]
+
+    def setUp(self):
+        super().setUp()
+        self.shelf = self.census_shelf
+
+    def make_recipe(self, **config):
+        return self.recipe_from_config(
+            dict(
+                {"metrics": ["pop2000"], "dimensions": ["age"]},
+                pagination_page_size=10,
+                **config,
+            )
+        )
+
+    def test_capped(self):
+        """Capped counts count at most the cap"""
+        recipe = self.make_recipe(
+            pagination_count_mode="capped", pagination_count_cap=50, pagination_page=7
+        )
+        self.assertRecipeSQLContains(recipe, "OFFSET 60")
+        self.assertEqual(len(recipe.all()), 10)
+        self.assertEqual(
+            recipe.validated_pagination(),
+            {
+                "requestedPage": 7,
+                "page": 7,
+                "pageSize": 10,
+                "totalItems": 50,
+                "totalItemsApproximate": True,
+            },
+        )
+
+        # Counts under the cap are exact
+        recipe = self.make_recipe(
+            pagination_count_mode="capped", pagination_count_cap=100, pagination_page=10
+        )
+        self.assertEqual(len(recipe.all()), 6)
+        self.assertEqual(
+            recipe.validated_pagination(),
+            {
+                "requestedPage": 10,
+                "page": 9,
+                "pageSize": 10,
+                "totalItems": 86,
+                "totalItemsApproximate": False,
+            },
+        )
+
+    def test_estimate(self):
+        """SQLite can't estimate counts so counts are capped"""
+        recipe = self.make_recipe(pagination_count_mode="estimate")
+        self.assertIsNone(recipe.estimated_count())
+        recipe.all()
+        self.assertEqual(
+            recipe.validated_pagination(),
+            {
+                "requestedPage": 1,
+                "page": 1,
+                "pageSize": 10,
+                "totalItems": 86,
+                "totalItemsApproximate": False,
+            },
+        )
+
+    def test_capped_total_count(self):
+        recipe = self.make_recipe()
+        self.assertEqual(recipe.total_count(cap=20), 21)
+        self.assertEqual(recipe.total_count(cap=100), 86)
+        self.assertEqual(recipe.total_count(), 86)
+
+    def test_keyset(self):
+        """Keyset pagination follows cursors past the cap"""
+        config = {
+            "metrics": ["pop2000"],
+            "dimensions": ["age"],
+            "pagination_page_size": 20,
+            "pagination_count_mode": "capped",
+            "pagination_count_cap": 30,
+        }
+        rows, cursor = [], None
+        while True:
+            recipe = Recipe.from_config(
+                self.shelf,
+                config,
+                session=self.session,
+                extension_classes=[PaginateKeyset],
+            )
+            if cursor is not None:
+                recipe = recipe.pagination_cursor(cursor)
+            rows.extend(recipe.all())
+            cursor = recipe.pagination_next_cursor()
+            if cursor is None:
+                break
+        self.assertEqual(len(rows), 86)
+
+
+class PaginateSearchIndexTestCase(RecipeTestCase):
+    """Searches can be matched against an index of dimension values"""
+
+    extension_classes = [Paginate]
+
+    def setUp(self):
+        super().setUp()
+        self.shelf = self.census_shelf
+        value_indexes.clear()
+        self.statements = []
+        event.listen(self.oven.engine, "before_cursor_execute", self.log_statement)
+
+    def tearDown(self):
+        event.remove(self.oven.engine, "before_cursor_execute", self.log_statement)
+        value_indexes.clear()
+        super().tearDown()
+
+    def log_statement(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def make_recipe(self, **config):
+        return self.recipe_from_config(
+            dict(
+                {
+                    "metrics": ["pop2000"],
+                    "dimensions": ["state"],
+                    "pagination_page_size": 10,
+                    "pagination_search_index": 60,
+                },
+                **config,
+            )
+        )
+
+    def test_search_index(self):
+        recipe = self.make_recipe(pagination_q="T%")
+        self.assertRecipeSQLContains(recipe, "census.state IN ('Tennessee')")
+        self.assertRecipeSQLNotContains(recipe, "LIKE")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            state,pop2000,state_id
+            Tennessee,5685230,Tennessee
+            """,
+        )
+        self.assertEqual(len(value_indexes), 1)
+
+        # The index is loaded once
+        statements = len(self.statements)
+        recipe = self.make_recipe(pagination_q="%ERM%")
+        self.assertRecipeSQLContains(recipe, "census.state IN ('Vermont')")
+        self.assertFalse(
+            any("DISTINCT" in s for s in self.statements[statements:])
+        )
+
+    def test_search_keys(self):
+        """Search keys that can't be indexed are searched in the database"""
+        recipe = self.make_recipe(
+            pagination_q="M", pagination_search_keys=["sex", "state", "age"]
+        )
+        self.assertRecipeSQLContains(recipe, "census.sex IN ('M')")
+        self.assertRecipeSQLContains(recipe, "LIKE lower('M')")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            state,pop2000,state_id
+            Tennessee,2761277,Tennessee
+            Vermont,298532,Vermont
+            """,
+        )
+
+    def test_no_matches(self):
+        """Searches that match nothing don't query the database"""
+        recipe = self.make_recipe(pagination_q="X%")
+        recipe.query()
+        statements = len(self.statements)
+        self.assertEqual(recipe.all(), [])
+        self.assertEqual(
+            recipe.validated_pagination(),
+            {"requestedPage": 1, "page": 1, "pageSize": 10, "totalItems": 0},
+        )
+        self.assertEqual(recipe.total_count(), 0)
+        self.assertEqual(list(recipe.iter()), [])
+        self.assertEqual(len(self.statements), statements)
+
+    def test_ttl(self):
+        """Indexes are reloaded after the ttl"""
+        self.make_recipe(pagination_q="T%").all()
+        distinct = [s for s in self.statements if "DISTINCT" in s]
+        self.assertEqual(len(distinct), 1)
+        self.make_recipe(pagination_q="V%", pagination_search_index=0).all()
+        self.make_recipe(pagination_q="V%").all()
+        distinct = [s for s in self.statements if "DISTINCT" in s]
+        self.assertEqual(len(distinct), 1)
+
+        for index, _ in value_indexes._indexes.values():
+            index.loaded_at -= 61
+        self.make_recipe(pagination_q="V%").all()
+        distinct = [s for s in self.statements if "DISTINCT" in s]
+        self.assertEqual(len(distinct), 2)
+
+
 class PaginateInlineTestCase(PaginateTestCase):
     """Run all the paginate tests with a different paginator
 
@@ -1286,6 +1757,30 @@ class PaginateInlineTestCase(PaginateTestCase):
     ):
         super().assertRecipeCSV(recipe, csv_text, ignore_columns=ignore_columns)
 
+    def test_past_last_page_statements(self):
+        """Pages past the last page are clamped in a single query"""
+        statements = []
+
+        def log_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        recipe = self.recipe_from_config(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["age"],
+                "pagination_page_size": 10,
+                "pagination_page": 20,
+            }
+        )
+        recipe.query()
+        event.listen(self.oven.engine, "before_cursor_execute", log_statement)
+        try:
+            self.assertEqual(recipe.all()[0].age, 80)
+            self.assertEqual(recipe.validated_pagination()["page"], 9)
+        finally:
+            event.remove(self.oven.engine, "before_cursor_execute", log_statement)
+        self.assertEqual(len(statements), 1)
+
     def test_pagination_q_idvalue(self):
         """Pagination queries use the value of an id value dimension"""
         recipe = self.recipe_from_config(
@@ -1368,26 +1863,257 @@ class PaginateCountOverTestCase(PaginateTestCase):
         self.assertRecipeSQL(
             recipe,
             """
-            SELECT census.age AS age,
-                census.sex AS sex,
-                census.state AS state,
-                sum(census.pop2000) AS pop2000,
-                count(*) OVER () AS recipe_total_count
-            FROM census
-            WHERE lower(census.state) LIKE lower('T%')
-            OR lower(census.sex) LIKE lower('T%')
-            GROUP BY age,
-                    sex,
-                    state
-            ORDER BY state,
-                    sex,
-                    age
+            SELECT anon_1.age,
+                anon_1.sex,
+                anon_1.state,
+                anon_1.pop2000,
+                anon_1.recipe_total_count
+            FROM
+            (SELECT anon_2.age AS age,
+                    anon_2.sex AS sex,
+                    anon_2.state AS state,
+                    anon_2.pop2000 AS pop2000,
+                    anon_2.recipe_total_count AS recipe_total_count,
+                    row_number() OVER (
+                                    ORDER BY state, sex, age) AS recipe_row_number
+            FROM
+                (SELECT census.age AS age,
+                        census.sex AS sex,
+                        census.state AS state,
+                        sum(census.pop2000) AS pop2000,
+                        count(*) OVER () AS recipe_total_count
+                FROM census
+                WHERE lower(census.state) LIKE lower('T%')
+                    OR lower(census.sex) LIKE lower('T%')
+                GROUP BY age,
+                        sex,
+                        state) AS anon_2) AS anon_1
+            WHERE anon_1.recipe_row_number > CASE
+                                                WHEN (anon_1.recipe_total_count > 40) THEN 40
+                                                ELSE (anon_1.recipe_total_count - 1) - (anon_1.recipe_total_count - 1) % 10
+                                            END
+            ORDER BY anon_1.recipe_row_number
             LIMIT 10
-            OFFSET 40
+            OFFSET 0
         """,
         )
 
 
+class PaginateKeysetTestCase(PaginateTestCase):
+    """Run all the paginate tests with the keyset paginator"""
+
+    extension_classes = [PaginateKeyset]
+
+    def walk_pages(self, config):
+        """Fetch every page by following cursors. Return the rows and the
+        validated pagination of each page."""
+        rows, paginations, cursor = [], [], None
+        while True:
+            recipe = self.recipe_from_config(config)
+            if cursor is not None:
+                recipe = recipe.pagination_cursor(cursor)
+            rows.extend(recipe.all())
+            paginations.append(recipe.validated_pagination())
+            cursor = recipe.pagination_next_cursor()
+            if cursor is None:
+                return rows, paginations
+
+    def test_keyset_pages(self):
+        """Following cursors returns the same rows as ordering the recipe"""
+        config = {
+            "metrics": ["pop2000"],
+            "dimensions": ["age"],
+            "pagination_page_size": 10,
+        }
+        rows, paginations = self.walk_pages(config)
+        expected = self.recipe().metrics("pop2000").dimensions("age").order_by("age")
+        self.assertEqual(rows, expected.all())
+        self.assertEqual(len(paginations), 9)
+        self.assertEqual(
+            paginations[-1],
+            {"requestedPage": 9, "page": 9, "pageSize": 10, "totalItems": 86},
+        )
+
+        # Deep pages seek instead of using an offset
+        recipe = self.recipe_from_config(config).pagination_page(2)
+        cursor = self.recipe_from_config(config).pagination_next_cursor()
+        self.assertEqual(
+            self.recipe_from_config(dict(config, pagination_cursor=cursor)).all(),
+            recipe.all(),
+        )
+        recipe = self.recipe_from_config(config).pagination_cursor(cursor)
+        self.assertRecipeSQLContains(recipe, "WHERE census.age > 9")
+        self.assertRecipeSQLContains(recipe, "LIMIT 10\nOFFSET 0")
+
+    def test_keyset_row_values(self):
+        """Orderings in one direction compare row values"""
+        config = {
+            "metrics": ["pop2000"],
+            "dimensions": ["state", "sex"],
+            "pagination_page_size": 3,
+        }
+        recipe = self.recipe_from_config(config)
+        recipe = recipe.pagination_cursor(recipe.pagination_next_cursor())
+        self.assertRecipeSQLContains(
+            recipe,
+            """
+            WHERE (census.state,
+                   census.sex) > ('Vermont',
+                                  'F')
+            """,
+        )
+        self.assertRecipeCSV(
+            recipe,
+            """
+            sex,state,pop2000,sex_id,state_id
+            M,Vermont,298532,M,Vermont
+            """,
+        )
+
+    def test_keyset_mixed_ordering(self):
+        """Orderings in different directions are paginated"""
+        config = {
+            "metrics": ["pop2000"],
+            "dimensions": ["state", "sex"],
+            "pagination_page_size": 1,
+            "pagination_order_by": ["-sex"],
+        }
+        rows, _ = self.walk_pages(config)
+        self.assertEqual(
+            [(row.sex, row.state) for row in rows],
+            [("M", "Tennessee"), ("M", "Vermont"), ("F", "Tennessee"), ("F", "Vermont")],
+        )
+
+    def test_keyset_metric_ordering(self):
+        """Orderings on metrics seek using having"""
+        config = {
+            "metrics": ["pop2000"],
+            "dimensions": ["age"],
+            "pagination_page_size": 25,
+            "pagination_order_by": ["-pop2000"],
+        }
+        rows, _ = self.walk_pages(config)
+        expected = (
+            self.recipe().metrics("pop2000").dimensions("age").order_by("-pop2000")
+        )
+        self.assertEqual(len(rows), 86)
+        self.assertEqual(
+            [row.pop2000 for row in rows], [row.pop2000 for row in expected.all()]
+        )
+
+        recipe = self.recipe_from_config(config)
+        recipe = recipe.pagination_cursor(recipe.pagination_next_cursor())
+        self.assertRecipeSQLContains(recipe, "HAVING sum(census.pop2000) <")
+
+    def test_keyset_bad_cursor(self):
+        """Cursors must be valid and match the ordering"""
+        config = {
+            "metrics": ["pop2000"],
+            "dimensions": ["state"],
+            "pagination_page_size": 1,
+        }
+        with self.assertRaises(BadRecipe):
+            self.recipe_from_config(config).pagination_cursor("nope").all()
+
+        cursor = self.recipe_from_config(config).pagination_next_cursor()
+        recipe = self.recipe_from_config(
+            dict(config, dimensions=["sex"], pagination_cursor=cursor)
+        )
+        with self.assertRaises(BadRecipe):
+            recipe.all()
+
+
+class AutoPaginateTestCase(PaginateTestCase):
+    """Run all the paginate tests with the adaptive paginator"""
+
+    extension_classes = [AutoPaginate]
+
+    def assertRecipeCSV(
+        self, recipe: Recipe, csv_text: str, ignore_columns=["recipe_total_count"]
+    ):
+        super().assertRecipeCSV(recipe, csv_text, ignore_columns=ignore_columns)
+
+    def setUp(self):
+        super().setUp()
+        pagination_costs.clear()
+
+    def make_recipe(self, page=1):
+        return self.recipe_from_config(
+            {
+                "metrics": ["pop2000"],
+                "dimensions": ["age"],
+                "pagination_page_size": 10,
+                "pagination_page": page,
+            }
+        )
+
+    def test_strategies(self):
+        """Each strategy is tried, then the cheapest is used"""
+        strategies = []
+        for _ in range(3):
+            recipe = self.make_recipe()
+            self.assertEqual(len(recipe.all()), 10)
+            self.assertEqual(recipe.validated_pagination()["totalItems"], 86)
+            strategies.append(recipe.recipe_extensions[0]._strategy)
+        self.assertEqual(strategies, ["count", "inline", "count_over"])
+
+        key = ("sqlite", ("age",), ("pop2000",), False)
+        self.assertEqual(
+            set(pagination_costs.costs(key)), {"count", "inline", "count_over"}
+        )
+        pagination_costs.record(key, "inline", -100.0)
+        recipe = self.make_recipe()
+        recipe.all()
+        self.assertEqual(recipe.recipe_extensions[0]._strategy, "inline")
+
+    def test_past_last_page(self):
+        """Pages past the last page return the last page with any strategy"""
+        key = ("sqlite", ("age",), ("pop2000",), False)
+        for strategy in ("count", "inline", "count_over"):
+            pagination_costs.clear()
+            pagination_costs.record(key, "count", 1.0)
+            pagination_costs.record(key, "inline", 1.0)
+            pagination_costs.record(key, "count_over", 1.0)
+            pagination_costs.record(key, strategy, -100.0)
+            recipe = self.make_recipe(page=20)
+            self.assertEqual(
+                recipe.validated_pagination(),
+                {"requestedPage": 20, "page": 9, "pageSize": 10, "totalItems": 86},
+            )
+            self.assertEqual(recipe.recipe_extensions[0]._strategy, strategy)
+            self.assertEqual(len(recipe.all()), 6)
+
+    def test_count_mode(self):
+        """Approximate counts use a count query"""
+        for _ in range(3):
+            recipe = self.make_recipe().pagination_count_mode("capped")
+            recipe.all()
+            self.assertEqual(recipe.recipe_extensions[0]._strategy, "count")
+
+
+class PaginationCostsTestCase(TestCase):
+    def test_explore(self):
+        """The least recently observed strategy is retried periodically"""
+        costs = PaginationCosts(explore_every=5)
+        chosen = []
+        for _ in range(10):
+            strategy = costs.choose("a", ["x", "y"])
+            chosen.append(strategy)
+            costs.record("a", strategy, 1.0 if strategy == "x" else 2.0)
+        self.assertEqual(chosen, ["x", "y", "x", "x", "y", "x", "x", "x", "x", "y"])
+        self.assertEqual(costs.costs("a"), {"x": 1.0, "y": 2.0})
+
+
+class PaginateCoreExecutionTestCase(PaginateInlineTestCase):
+    """Run all the paginate tests using the core execution mode"""
+
+    def recipe(self, **kwargs):
+        return super().recipe(**kwargs).execution_mode("core")
+
+    def recipe_from_config(self, config: dict, **kwargs):
+        return super().recipe_from_config(config, **kwargs).execution_mode("core")
+
+
 class CompareRecipeTestCase(RecipeTestCase):
     extension_classes = [CompareRecipe]
 
@@ -1524,6 +2250,13 @@ ORDER BY census.sex""",
             r.all()
 
 
+class CompareCoreExecutionTestCase(CompareRecipeTestCase):
+    """Run all the compare tests using the core execution mode"""
+
+    def recipe(self, **kwargs):
+        return super().recipe(**kwargs).execution_mode("core")
+
+
 class BlendRecipeTestCase(RecipeTestCase):
     extension_classes = [BlendRecipe]
 
@@ -1612,3 +2345,10 @@ ORDER BY census.state""",
             Vermont,609480,VT,VT,Vermont
             """,
         )
+
+
+class BlendCoreExecutionTestCase(BlendRecipeTestCase):
+    """Run all the blend tests using the core execution mode"""
+
+    def recipe(self, **kwargs):
+        return super().recipe(**kwargs).execution_mode("core")
@@ -12,6 +12,7 @@ from recipe import (
     Ingredient,
     LookupDimension,
     Metric,
+    Shelf,
     WtdAvgMetric,
 )
 from recipe.utils import filter_to_string
@@ -77,6 +78,15 @@ class IngredientsTestCase(RecipeTestCase):
         # And the {ingr.id} property will have the formatter applied to it
         self.assertEqual(extras[0][0], "cow")
 
+        # Formatters can be applied to a whole column at once
+        self.assertEqual(
+            cow_ingr._format_column(["a cow", "b cow"]),
+            ["a cow says moo", "b cow says moo"],
+        )
+        extras = list(cow_ingr.cauldron_extra_columns)
+        self.assertEqual(extras[0][0], "cow")
+        self.assertEqual(extras[0][1]({"cow_raw": ["c cow"]}), ["c cow says moo"])
+
     def test_order_by_columns(self):
         multi_column_ingr_with_suffixes = Ingredient(
             id="foo",
@@ -649,6 +659,32 @@ class TestDimension(RecipeTestCase):
         self.assertEqual(extras[0][0], "moo")
         self.assertEqual(extras[1][0], "moo_id")
 
+    def test_overridden_cauldron_extras(self):
+        """Subclasses that override cauldron_extras keep their extra
+        columns when rows are enchanted"""
+
+        class ShoutingDimension(Dimension):
+            @property
+            def cauldron_extras(self):
+                yield from super().cauldron_extras
+                yield f"{self.id}_shout", lambda row: getattr(row, self.id).upper()
+
+        shelf = Shelf(
+            {
+                "first": ShoutingDimension(self.basic_table.c.first),
+                "age": Metric(func.sum(self.basic_table.c.age)),
+            }
+        )
+        recipe = self.recipe(shelf=shelf).dimensions("first").metrics("age")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            first,age,first_id,first_shout
+            hi,15,hi,HI
+            """,
+        )
+        self.assertEqual(recipe.reset().columns()["first_shout"], ["HI"])
+
     def test_dimension_extra_roles(self):
         """Creating a dimension with extra roles"""
         d = Dimension(
@@ -708,6 +744,61 @@ class TestDimension(RecipeTestCase):
         self.assertEqual(len(d.group_by), 1)
         self.assertEqual(len(d.formatters), 2)
 
+    def test_dimension_with_sql_lookup(self):
+        """Lookups can be compiled into a SQL CASE"""
+        with self.assertRaises(BadIngredient):
+            Dimension(self.basic_table.c.first, lookup={}, lookup_strategy="moo")
+
+        d = Dimension(
+            self.basic_table.c.first,
+            lookup={"man": "mouse"},
+            lookup_strategy="sql",
+            id="moo",
+        )
+        self.assertEqual(len(d.columns), 1)
+        self.assertEqual(len(d.formatters), 0)
+        self.assertEqual(d.datatype, "str")
+        self.assertEqual(
+            filter_to_string(d.columns[0]),
+            "CASE foo.first WHEN 'man' THEN 'mouse' ELSE foo.first END",
+        )
+
+        d = Dimension(
+            self.basic_table.c.first,
+            lookup={"man": "mouse", None: "nobody"},
+            lookup_default="cookie",
+            lookup_strategy="sql",
+            id="moo",
+        )
+        self.assertEqual(
+            filter_to_string(d.columns[0]),
+            "CASE WHEN (foo.first = 'man') THEN 'mouse' "
+            "WHEN (foo.first IS NULL) THEN 'nobody' ELSE 'cookie' END",
+        )
+
+        # Unmatched values are cast to the type of the lookup values
+        d = Dimension(
+            self.basic_table.c.age,
+            lookup={5: "five"},
+            lookup_strategy="sql",
+            id="moo",
+        )
+        self.assertEqual(d.datatype, "str")
+        self.assertEqual(
+            filter_to_string(d.columns[0]),
+            "CASE foo.age WHEN 5 THEN 'five' ELSE CAST(foo.age AS VARCHAR) END",
+        )
+
+        # Lookups with values of different types are applied in Python
+        d = Dimension(
+            self.basic_table.c.age,
+            lookup={5: "five", 10: 10},
+            lookup_strategy="sql",
+            id="moo",
+        )
+        self.assertEqual(len(d.formatters), 1)
+        self.assertIs(d.columns[0], self.basic_table.c.age)
+
 
 class IdValueDimensionTestCase(RecipeTestCase):
     def test_init(self):
@@ -1,3 +1,5 @@
+import io
+import json
 from copy import copy
 
 import pytest
@@ -5,6 +7,8 @@ from sqlalchemy import func, join
 from tests.test_base import RecipeTestCase
 
 from recipe import BadRecipe, Dimension, Filter, Having, Metric, Recipe, Shelf
+from recipe.core import _result_bytes
+from recipe.templates import statement_shapes, template_cache
 
 
 class TestRecipeIngredients(RecipeTestCase):
@@ -133,6 +137,51 @@ GROUP BY d_id,
             """,
         )
 
+    def test_dimension_with_sql_lookup(self):
+        """Lookups using the sql strategy are grouped in the database"""
+        d = Dimension(
+            self.basic_table.c.last,
+            lookup={"fred": "people", "there": "people"},
+            lookup_strategy="sql",
+            id="d",
+        )
+        recipe = self.recipe().metrics("age").dimensions(d)
+        self.assertRecipeSQL(
+            recipe,
+            """SELECT CASE foo.last
+                   WHEN 'fred' THEN 'people'
+                   WHEN 'there' THEN 'people'
+                   ELSE foo.last
+               END AS d,
+               sum(foo.age) AS age
+        FROM foo
+        GROUP BY d""",
+        )
+        self.assertRecipeCSV(
+            recipe,
+            """
+            d,age,d_id
+            people,15,people
+            """,
+        )
+
+        # Values that aren't in the lookup are cast to the lookup's type
+        d = Dimension(
+            self.basic_table.c.age,
+            lookup={10: "ten"},
+            lookup_strategy="sql",
+            id="d",
+        )
+        recipe = self.recipe().metrics("age").dimensions(d).order_by("d")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            d,age,d_id
+            5,5,5
+            ten,10,ten
+            """,
+        )
+
     def test_offset(self):
         recipe = self.recipe().metrics("age").dimensions("first").offset(1)
         assert (
@@ -578,6 +627,308 @@ class StatsTestCase(RecipeTestCase):
         self.assertLess(recipe.stats.dbtime, 1.0)
         self.assertLess(recipe.stats.enchanttime, 1.0)
         self.assertFalse(recipe.stats.from_cache)
+        self.assertGreater(recipe.stats.buildtime, 0.0)
+
+    def test_phase_stats(self):
+        """Stats time each phase of building and running a recipe"""
+        recipe = self.recipe().metrics("age").dimensions("last").use_cache(False)
+        recipe.all()
+        stats = recipe.stats
+        phases = (
+            stats.ingredienttime,
+            stats.brewtime,
+            stats.modifytime,
+            stats.postquerytime,
+            stats.hooktime,
+        )
+        for phasetime in phases:
+            self.assertGreaterEqual(phasetime, 0.0)
+        self.assertLessEqual(sum(phases), stats.buildtime)
+        self.assertGreater(stats.dbtime, 0.0)
+        # Cache keys are compiled while fetching rows
+        self.assertLessEqual(stats.cachekeytime, stats.dbtime)
+        self.assertGreater(stats.result_bytes, 0)
+        self.assertEqual(stats.counttime, 0.0)
+
+        self.assertEqual(recipe.total_count(), 2)
+        self.assertGreater(recipe.stats.counttime, 0.0)
+
+        # Rows that have already been fetched cost nothing
+        recipe.all()
+        self.assertEqual(recipe.stats.dbtime, 0.0)
+        self.assertEqual(recipe.stats.enchanttime, 0.0)
+        self.assertTrue(recipe.stats.from_cache)
+
+    def test_iter_result_bytes(self):
+        """Result size accumulates across batches"""
+        recipe = self.recipe().metrics("age").dimensions("last")
+        list(recipe.iter(batch_size=1))
+        iter_bytes = recipe.stats.result_bytes
+        recipe.reset()
+        recipe.all()
+        self.assertEqual(iter_bytes, recipe.stats.result_bytes)
+
+    def test_result_bytes_sample(self):
+        """The size of large results is estimated from a sample"""
+        rows = [("abc", 1)] * 2000
+        self.assertEqual(_result_bytes(rows), _result_bytes(rows[:1]) * 2000)
+
+    def test_statement_shapes(self):
+        """In lists with similar numbers of values share a statement shape"""
+        statement_shapes.clear()
+        for values in (["fred", "there", "x"], ["fred", "there", "x", "y"]):
+            recipe = (
+                self.recipe()
+                .metrics("age")
+                .dimensions("last")
+                .filters(self.basic_table.c.last.in_(values))
+            )
+            recipe.all()
+            self.assertEqual(recipe.stats.statement_shapes, 1)
+
+        recipe = (
+            self.recipe()
+            .metrics("age")
+            .dimensions("last")
+            .filters(self.basic_table.c.last.in_(["fred", "there"]))
+        )
+        self.assertRecipeCSV(
+            recipe,
+            """
+            last,age,last_id
+            fred,10,fred
+            there,5,there
+            """,
+        )
+        self.assertEqual(recipe.stats.statement_shapes, 2)
+
+
+class CoreExecutionTestCase(RecipeTestCase):
+    def test_core_execution(self):
+        """Core execution returns the same results as the ORM"""
+        for execution_mode in ("orm", "core"):
+            recipe = (
+                self.recipe()
+                .metrics("age")
+                .dimensions("last")
+                .order_by("-age")
+                .execution_mode(execution_mode)
+            )
+            self.assertRecipeCSV(
+                recipe,
+                """
+                last,age,last_id
+                fred,10,fred
+                there,5,there
+                """,
+            )
+            self.assertEqual(recipe.total_count(), 2)
+            self.assertEqual(recipe.stats.rows, 2)
+
+    def test_core_execution_with_connection(self):
+        """Core execution can use an explicit connection"""
+        with self.session.get_bind().connect() as connection:
+            recipe = (
+                self.recipe()
+                .metrics("age")
+                .dimensions("last")
+                .filters(self.basic_table.c.age > 7)
+                .execution_mode("core")
+                .connection(connection)
+            )
+            self.assertRecipeCSV(
+                recipe,
+                """
+                last,age,last_id
+                fred,10,fred
+                """,
+            )
+            self.assertEqual(recipe.total_count(), 1)
+
+    def test_bad_execution_mode(self):
+        with self.assertRaises(AssertionError):
+            self.recipe().execution_mode("fast")
+
+
+class IterTestCase(RecipeTestCase):
+    def test_iter(self):
+        """Results can be streamed in batches"""
+        for execution_mode in ("orm", "core"):
+            recipe = (
+                self.recipe()
+                .metrics("age")
+                .dimensions("last")
+                .order_by("last")
+                .execution_mode(execution_mode)
+            )
+            rows = recipe.iter(batch_size=1)
+            row = next(rows)
+            self.assertEqual((row.last, row.age, row.last_id), ("fred", 10, "fred"))
+            self.assertEqual([row.last for row in rows], ["there"])
+            self.assertEqual(recipe.stats.rows, 2)
+            self.assertFalse(recipe.stats.from_cache)
+            # Streaming results does not store them
+            self.assertIsNone(recipe._all)
+
+    def test_iter_after_all(self):
+        """Results from all() are reused"""
+        recipe = self.recipe().metrics("age").dimensions("last").order_by("last")
+        rows = recipe.all()
+        self.assertEqual(list(recipe.iter()), rows)
+        self.assertTrue(recipe.stats.from_cache)
+
+    def test_iter_empty(self):
+        recipe = (
+            self.recipe()
+            .metrics("age")
+            .dimensions("last")
+            .filters(self.basic_table.c.age > 100)
+        )
+        self.assertEqual(list(recipe.iter()), [])
+        self.assertEqual(recipe.stats.rows, 0)
+
+
+class ExportTestCase(RecipeTestCase):
+    def test_export_csv(self):
+        recipe = self.recipe().metrics("age").dimensions("last").order_by("last")
+        fp = io.StringIO()
+        self.assertEqual(recipe.export(fp, batch_size=1), 2)
+        self.assertEqual(
+            fp.getvalue(),
+            "last,age,last_id\nfred,10,fred\nthere,5,there\n",
+        )
+        self.assertEqual(recipe.stats.rows, 2)
+
+    def test_export_jsonl(self):
+        recipe = self.recipe().metrics("age").dimensions("last").order_by("last")
+        fp = io.StringIO()
+        self.assertEqual(recipe.export(fp, format="jsonl"), 2)
+        self.assertEqual(
+            [json.loads(line) for line in fp.getvalue().splitlines()],
+            [
+                {"last": "fred", "age": 10, "last_id": "fred"},
+                {"last": "there", "age": 5, "last_id": "there"},
+            ],
+        )
+
+    def test_export_empty(self):
+        recipe = (
+            self.recipe()
+            .metrics("age")
+            .dimensions("last")
+            .filters(self.basic_table.c.age > 100)
+        )
+        fp = io.StringIO()
+        self.assertEqual(recipe.export(fp), 0)
+        self.assertEqual(fp.getvalue(), "")
+
+    def test_export_bad_format(self):
+        recipe = self.recipe().metrics("age").dimensions("last")
+        with self.assertRaises(BadRecipe):
+            recipe.export(io.StringIO(), format="xlsx")
+
+
+class ColumnsTestCase(RecipeTestCase):
+    def test_columns(self):
+        """Results can be returned column-wise"""
+        for execution_mode in ("orm", "core"):
+            recipe = (
+                self.recipe()
+                .metrics("age")
+                .dimensions("last")
+                .order_by("last")
+                .execution_mode(execution_mode)
+            )
+            self.assertEqual(
+                recipe.columns(),
+                {
+                    "last": ["fred", "there"],
+                    "age": [10, 5],
+                    "last_id": ["fred", "there"],
+                },
+            )
+            self.assertEqual(recipe.stats.rows, 2)
+            self.assertFalse(recipe.stats.from_cache)
+
+    def test_columns_after_all(self):
+        """Results from all() are reused"""
+        recipe = self.recipe().metrics("age").dimensions("last").order_by("last")
+        recipe.all()
+        self.assertEqual(recipe.columns()["age"], [10, 5])
+        self.assertTrue(recipe.stats.from_cache)
+
+    def test_columns_empty(self):
+        recipe = (
+            self.recipe()
+            .metrics("age")
+            .dimensions("last")
+            .filters(self.basic_table.c.age > 100)
+        )
+        self.assertEqual(recipe.columns(), {})
+
+    def test_columns_numpy(self):
+        np = pytest.importorskip("numpy")
+        recipe = self.recipe().metrics("age").dimensions("last").order_by("last")
+        columns = recipe.columns(numpy=True)
+        self.assertEqual(columns["age"].dtype, np.dtype("int64"))
+        self.assertEqual(columns["last"].dtype, np.dtype(object))
+        self.assertEqual(list(columns["last"]), ["fred", "there"])
+
+
+class QueryTemplateTestCase(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        template_cache.clear()
+
+    def test_template_reused(self):
+        """Recipes that only differ in filter values share a query template"""
+        recipe = self.recipe().metrics("age").dimensions("last")
+        recipe.filters(self.basic_table.c.age > 7)
+        self.assertRecipeCSV(
+            recipe,
+            """
+            last,age,last_id
+            fred,10,fred
+            """,
+        )
+        self.assertEqual((template_cache.hits, template_cache.misses), (0, 1))
+
+        recipe = self.recipe().metrics("age").dimensions("last")
+        recipe.filters(self.basic_table.c.age > 2)
+        self.assertRecipeSQL(
+            recipe,
+            """SELECT foo.last AS last,
+                   sum(foo.age) AS age
+            FROM foo
+            WHERE foo.age > 2
+            GROUP BY last""",
+        )
+        self.assertRecipeCSV(
+            recipe,
+            """
+            last,age,last_id
+            fred,10,fred
+            there,5,there
+            """,
+        )
+        self.assertEqual((template_cache.hits, template_cache.misses), (1, 1))
+
+        # A different structure builds a new query
+        recipe = self.recipe().metrics("age").dimensions("last")
+        recipe.filters(self.basic_table.c.age < 2)
+        self.assertRecipeCSV(recipe, "")
+        self.assertEqual((template_cache.hits, template_cache.misses), (1, 2))
+
+    def test_duplicate_filters_not_saved(self):
+        """Templates are not saved if filters were deduplicated"""
+        recipe = self.recipe().metrics("age").dimensions("last")
+        recipe.filters(self.basic_table.c.age > 7, self.basic_table.c.age > 7)
+        self.assertEqual(len(recipe.all()), 1)
+        self.assertEqual(len(template_cache), 0)
+
+        recipe = self.recipe().metrics("age").dimensions("last")
+        recipe.filters(self.basic_table.c.age > 7, self.basic_table.c.age > 12)
+        self.assertEqual(len(recipe.all()), 0)
 
 
 class NestedRecipeTestCase(RecipeTestCase):
@@ -0,0 +1,85 @@
+from unittest import TestCase
+
+from recipe.search import ValueIndex, ValueIndexCache
+
+
+class ValueIndexTestCase(TestCase):
+    def setUp(self):
+        self.index = ValueIndex(["Tennessee", "Texas", "Vermont", "texas", "Utah"])
+
+    def test_exact(self):
+        self.assertEqual(self.index.match("TEXAS"), ["Texas", "texas"])
+        self.assertEqual(self.index.match("Tex"), [])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.match("te%"), ["Tennessee", "Texas", "texas"])
+        self.assertEqual(len(self.index.match("%")), 5)
+        self.assertEqual(self.index.match("x%"), [])
+
+    def test_substring(self):
+        self.assertEqual(self.index.match("%ERM%"), ["Vermont"])
+        self.assertEqual(self.index.match("%a%"), ["Texas", "texas", "Utah"])
+
+    def test_patterns(self):
+        self.assertEqual(self.index.match("%s"), ["Texas", "texas"])
+        self.assertEqual(self.index.match("T_xas"), ["Texas", "texas"])
+        self.assertEqual(self.index.match("u%h"), ["Utah"])
+        self.assertEqual(self.index.match("t.xas"), [])
+        self.assertIsNone(self.index.match("Tex\\%"))
+
+    def test_not_indexed(self):
+        index = ValueIndex(None)
+        self.assertFalse(index.indexed)
+        self.assertIsNone(index.match("T%"))
+
+
+class ValueIndexCacheTestCase(TestCase):
+    def test_get(self):
+        cache = ValueIndexCache(max_values=3)
+        loads = []
+
+        def load(values):
+            def load(limit):
+                loads.append(limit)
+                return values[:limit]
+
+            return load
+
+        index = cache.get("a", load(["Texas", None, "Utah"]), ttl=60)
+        self.assertEqual(index.match("%"), ["Texas", "Utah"])
+        self.assertIs(cache.get("a", load([]), ttl=60), index)
+        self.assertEqual(loads, [4])
+
+        # Expired indexes are reloaded
+        self.assertEqual(cache.get("a", load(["Utah"]), ttl=-1).match("%"), ["Utah"])
+
+        # Too many values
+        self.assertFalse(cache.get("b", load(list("abcde")), ttl=60).indexed)
+        # Values that aren't strings
+        self.assertFalse(cache.get("c", load([1, 2]), ttl=60).indexed)
+        # The expired index for "a" was evicted
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_eviction(self):
+        """The least recently used indexes are evicted"""
+        cache = ValueIndexCache(max_entries=2)
+        loads = []
+
+        def load(limit):
+            loads.append(limit)
+            return ["Texas"]
+
+        cache.get("a", load, ttl=60)
+        cache.get("b", load, ttl=60)
+        cache.get("a", load, ttl=60)
+        cache.get("c", load, ttl=60)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(len(loads), 3)
+
+        # "b" was evicted, "a" was not
+        cache.get("a", load, ttl=60)
+        self.assertEqual(len(loads), 3)
+        cache.get("b", load, ttl=60)
+        self.assertEqual(len(loads), 4)
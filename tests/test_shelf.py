@@ -1,7 +1,7 @@
 from copy import copy
 
 import pytest
-from sqlalchemy import join
+from sqlalchemy import func, join
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.sql.elements import ColumnElement
 from yaml import safe_load
@@ -19,6 +19,7 @@ import recipe
 from recipe.ingredients import Ingredient, InvalidIngredient
 from recipe.shelf import introspect_table
 from recipe.schemas.utils import find_column
+from recipe.utils import vectorized
 
 from .test_base import RecipeTestCase
 
@@ -308,6 +309,60 @@ class ShelfTestCase(RecipeTestCase):
         self.assertEqual(len(self.shelf.filter_ids), 0)
 
 
+class EnchantTestCase(RecipeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+
+        def upper(values):
+            self.calls.append(values)
+            return [v.upper() for v in values]
+
+        self.shelf = Shelf(
+            {
+                "first": Dimension(self.basic_table.c.first),
+                "last": Dimension(
+                    self.basic_table.c.last, formatters=[vectorized(upper)]
+                ),
+                "age": Metric(
+                    func.sum(self.basic_table.c.age), formatters=[lambda v: v * 2]
+                ),
+            }
+        )
+
+    def test_enchant_rows(self):
+        recipe = self.recipe().dimensions("first", "last").metrics("age")
+        self.assertRecipeCSV(
+            recipe,
+            """
+            first,last_raw,age_raw,first_id,last,last_id,age
+            hi,fred,10,hi,FRED,fred,20
+            hi,there,5,hi,THERE,there,10
+            """,
+        )
+        # The vectorized formatter is called once with the whole column
+        self.assertEqual(self.calls, [["fred", "there"]])
+
+    def test_enchant_columnar(self):
+        recipe = self.recipe().dimensions("last").metrics("age")
+        data = recipe.query().all()
+        columns = recipe._cauldron.enchant(data, columnar=True)
+        self.assertEqual(
+            list(columns.keys()), ["last_raw", "age_raw", "last", "last_id", "age"]
+        )
+        self.assertEqual(columns["last"], ["FRED", "THERE"])
+        self.assertEqual(columns["age"], [20, 10])
+        self.assertEqual(recipe._cauldron.enchant([], columnar=True), {})
+
+    def test_field_datatypes(self):
+        recipe = self.recipe().dimensions("last").metrics("age")
+        recipe.query()
+        self.assertEqual(
+            recipe._cauldron.field_datatypes(),
+            {"last_raw": "str", "last_id": "str", "age_raw": "num"},
+        )
+
+
 class ShelfFromYamlTestCase(RecipeTestCase):
     def make_shelf(self, content, table=None):
         if table is None:
@@ -147,6 +147,49 @@ class TestNullHandling(ConfigTestBase):
             """,
         )
 
+    def test_dimension_null_handling_with_sql_lookup(self):
+        """Lookups can be translated in the database"""
+
+        # department_sql_lookup:
+        #     kind: Dimension
+        #     field: department
+        #     lookup:
+        #         sales: Sales
+        #         ops: Operations
+        #     lookup_default: Unknown
+        #     lookup_strategy: sql
+        shelf = self.shelf_from_filename(
+            "scores_with_nulls.yaml", self.scores_with_nulls_table
+        )
+        recipe = (
+            self.recipe(shelf=shelf)
+            .dimensions("department_sql_lookup")
+            .metrics("score")
+            .order_by("department_sql_lookup")
+        )
+        self.assertRecipeSQL(
+            recipe,
+            """SELECT CASE scores_with_nulls.department
+                WHEN 'sales' THEN 'Sales'
+                WHEN 'ops' THEN 'Operations'
+                ELSE 'Unknown'
+            END AS department_sql_lookup,
+                avg(scores_with_nulls.score) AS score
+            FROM scores_with_nulls
+            GROUP BY department_sql_lookup
+            ORDER BY department_sql_lookup""",
+        )
+
+        self.assertRecipeCSV(
+            recipe,
+            """
+            department_sql_lookup,score,department_sql_lookup_id
+            Operations,90.0,Operations
+            Sales,,Sales
+            Unknown,80.0,Unknown
+            """,
+        )
+
     def test_dimension_null_handling_with_default(self):
         """Test different ways of handling nulls in dimensions"""
 
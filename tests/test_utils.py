@@ -1,19 +1,37 @@
 # -*- coding: utf-8 -*-
 from datetime import date
+from decimal import Decimal
 
 import pytest
 from faker import Faker
 from faker.providers import BaseProvider
+from sqlalchemy import and_, column, false, inspect, not_, select
+from sqlalchemy import Date, Integer, Numeric, String
+from sqlalchemy.dialects import mssql, postgresql
 from tests.test_base import RecipeTestCase
+from recipe import Filter
 from recipe.utils import (
     AttrDict,
     FakerAnonymizer,
+    filter_key,
+    prettyprintable_sql,
     FakerFormatter,
     replace_whitespace_with_space,
     generate_faker_seed,
     pad_values,
+    bucket_size,
+    pad_in_lists,
     make_schema,
+    large_in_list,
+    value_table,
+    value_tables,
+    load_value_tables,
+    row_values_in,
+    always_false,
+    simplify_filters,
+    vectorized,
 )
+from recipe.utils.formatting import literal_dialect
 
 uppercase = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
@@ -101,6 +119,209 @@ class PadValuesTestCase(RecipeTestCase):
         ]
 
 
+class PadInListsTestCase(RecipeTestCase):
+    def test_bucket_size(self):
+        self.assertEqual(
+            [bucket_size(n) for n in (0, 1, 2, 3, 4, 5, 9)], [0, 1, 2, 4, 4, 8, 16]
+        )
+        self.assertEqual([bucket_size(n, 11) for n in (1, 3, 11, 12)], [1, 11, 11, 22])
+
+        # Large lists use finer buckets
+        self.assertEqual(
+            [bucket_size(n) for n in (64, 65, 100, 600)], [64, 80, 112, 640]
+        )
+
+        # Lists are not padded past the maximum size
+        self.assertEqual(
+            [bucket_size(n, max_size=1000) for n in (600, 990, 1000, 1500)],
+            [640, 1000, 1000, 1500],
+        )
+        self.assertEqual(bucket_size(995, 11, max_size=1000), 1000)
+
+    def test_pad_in_lists(self):
+        """In lists are padded by repeating the last value"""
+        col = column("x", Integer)
+        condition = pad_in_lists(col.in_([1, 2, 3]))
+        self.assertEqual(list(condition.compile().params.values()), [[1, 2, 3, 3]])
+
+        condition = pad_in_lists(not_(col.in_([1, 2, 3, 4, 5])) | (col == 7), 11)
+        self.assertEqual(
+            list(condition.compile().params.values()), [[1, 2, 3, 4, 5] + [5] * 6, 7]
+        )
+
+    def test_unchanged(self):
+        col = column("x", String)
+        for condition in (col.in_(["a", "b"]), col == "a", col.in_(["a"]), True):
+            self.assertIs(pad_in_lists(condition), condition)
+
+
+class LargeInListTestCase(RecipeTestCase):
+    def test_value_table(self):
+        """Values are loaded into a temporary table while a statement runs"""
+        connection = self.session.connection()
+        dialect = connection.dialect
+        table = value_table(dialect, [("value", Integer)], [(1,), (2,)])
+        self.assertTrue(table.name.startswith("recipe_values_"))
+        self.assertEqual(
+            value_table(dialect, [("value", Integer)], [(1,), (2,)]).name,
+            table.name,
+        )
+        other = value_table(dialect, [("value", Integer)], [(3,)])
+        self.assertNotEqual(other.name, table.name)
+
+        statement = select(table.c.value)
+        self.assertEqual(value_tables(statement), [table])
+        self.assertFalse(inspect(connection).has_table(table.name))
+        with load_value_tables(connection, statement):
+            with load_value_tables(connection, statement):
+                values = connection.execute(statement).scalars()
+                self.assertEqual(sorted(values), [1, 2])
+            self.assertTrue(inspect(connection).has_table(table.name))
+        self.assertFalse(inspect(connection).has_table(table.name))
+
+    def test_large_in_list(self):
+        dialect = self.session.connection().dialect
+        col = column("x", String)
+        condition = col.in_(["a", "b", "c"])
+        self.assertIs(large_in_list(condition, dialect, 3), condition)
+        self.assertIs(large_in_list(condition, dialect, 0), condition)
+        self.assertIs(large_in_list(condition, dialect, None), condition)
+        other = col == "a"
+        self.assertIs(large_in_list(other, dialect, 1), other)
+
+    def test_postgresql(self):
+        """PostgreSQL filters on an array parameter"""
+        dialect = postgresql.dialect()
+        col = column("x", String)
+        for condition, sql in (
+            (col.in_(["a", "b", "c"]), "x = ANY (%(param_1)s::VARCHAR[])"),
+            (not_(col.in_(["a", "b", "c"])), "x != ALL (%(param_1)s::VARCHAR[])"),
+        ):
+            compiled = large_in_list(condition, dialect, 2).compile(dialect=dialect)
+            self.assertIn(sql, str(compiled))
+            self.assertEqual(list(compiled.params.values()), [["a", "b", "c"]])
+
+    def test_row_values_in(self):
+        dialect = postgresql.dialect()
+        columns = [column("x", String), column("y", Integer)]
+        condition = row_values_in(columns, [("a", 1), ("b", 2)], dialect)
+        self.assertEqual(
+            str(condition.compile(dialect=dialect)),
+            "(x, y) IN (__[POSTCOMPILE_param_1])",
+        )
+
+        # SQL Server can't compare row values
+        self.assertIsNone(row_values_in(columns, [("a", 1)], mssql.dialect()))
+
+
+class SimplifyFiltersTestCase(RecipeTestCase):
+    def test_always_false(self):
+        col = column("x", String)
+        for condition in (false(), col.in_([]), and_(col == "a", col.in_([]))):
+            self.assertTrue(always_false(condition))
+        for condition in (col.in_(["a"]), not_(col.in_([])), col == "a", True):
+            self.assertFalse(always_false(condition))
+
+    def test_simplify_filters(self):
+        x, y = column("x", Integer), column("y", String)
+        conditions = [x.in_([1, 2, 3]), y > "b", x.in_([3, 2]), x == 2]
+        simplified = simplify_filters(conditions)
+        self.assertEqual(str(simplified[0]), "x = :x_1")
+        self.assertEqual(simplified[0].right.value, 2)
+        self.assertIs(simplified[1], conditions[1])
+        self.assertEqual(simplified[2:], [None, None])
+
+        simplified = simplify_filters([x.in_([1, 2]), x.in_([2, 1])])
+        self.assertEqual(simplified[0].right.value, [1, 2])
+        self.assertIsNone(simplified[1])
+
+        # No values in common
+        simplified = simplify_filters([x == 1, y == "a", x == 2])
+        self.assertTrue(always_false(simplified[0]))
+        self.assertEqual(simplified[2], None)
+
+        when = column("when", Date)
+        simplified = simplify_filters(
+            [when == date(2020, 1, 1), when.in_([date(2020, 1, 1)])]
+        )
+        self.assertEqual(simplified[0].right.value, date(2020, 1, 1))
+        self.assertIsNone(simplified[1])
+
+    def test_unchanged(self):
+        """Conditions on different expressions, on strings or with values
+        of different types are left for the database"""
+        x, y = column("x", String), column("y", Integer)
+        amount = column("amount", Numeric)
+        for conditions in (
+            [x == "a", y == 1],
+            # Strings may compare differently under the database's collation
+            [x == "A", x == "a"],
+            [x.in_(["a", "b"]), x == "b"],
+            [y == 1, y == "1"],
+            [amount == Decimal("0.1"), amount == 0.1],
+            [x == "a", not_(x.in_(["a"]))],
+            [y.in_([1])],
+        ):
+            simplified = simplify_filters(conditions)
+            self.assertEqual(len(simplified), len(conditions))
+            for s, c in zip(simplified, conditions):
+                self.assertIs(s, c)
+
+
+class FilterKeyTestCase(RecipeTestCase):
+    def test_filter_key(self):
+        """Filters are keyed by their structure and values"""
+        age = self.basic_table.c.age
+        self.assertEqual(filter_key(age > 4), ("foo.age > :age_1", "(4,)"))
+        self.assertEqual(filter_key(age > 4), filter_key(Filter(age > 4)))
+        self.assertNotEqual(filter_key(age > 4), filter_key(age > 5))
+        self.assertNotEqual(filter_key(age > 4), filter_key(age >= 4))
+        self.assertEqual(filter_key(True), ("True", ""))
+
+        # Long lists of values are digested
+        first = self.basic_table.c.first
+        shape, values = filter_key(first.in_([str(i) for i in range(5000)]))
+        self.assertEqual(shape, "foo.first IN (__[POSTCOMPILE_first_1])")
+        self.assertEqual(len(values), 32)
+        self.assertNotEqual(
+            filter_key(first.in_([str(i) for i in range(5001)])), (shape, values)
+        )
+
+
+class PrettyprintableSQLTestCase(RecipeTestCase):
+    def test_prettyprintable_sql(self):
+        """SQL is rendered with bound values inline"""
+        age = self.basic_table.c.age
+        query = self.session.query(self.basic_table.c.first).filter(age > 4)
+        self.assertEqual(
+            prettyprintable_sql(query),
+            "SELECT foo.first\nFROM foo\nWHERE foo.age > 4",
+        )
+        self.assertEqual(
+            prettyprintable_sql(query, reindent=False),
+            "SELECT foo.first \nFROM foo \nWHERE foo.age > 4",
+        )
+
+    def test_memoized(self):
+        """Rendered SQL is memoized by structure and values"""
+        age = self.basic_table.c.age
+        first = prettyprintable_sql(self.session.query(age).filter(age > 4))
+        self.assertIs(
+            prettyprintable_sql(self.session.query(age).filter(age > 4)), first
+        )
+        self.assertEqual(
+            prettyprintable_sql(self.session.query(age).filter(age > 5)),
+            "SELECT foo.age\nFROM foo\nWHERE foo.age > 5",
+        )
+
+    def test_literal_dialect(self):
+        """Literal dialects are reused for each dialect class"""
+        dialect = self.session.get_bind().dialect
+        self.assertIs(literal_dialect(dialect), literal_dialect(dialect))
+        self.assertIsInstance(literal_dialect(dialect), type(dialect))
+        self.assertIsNot(literal_dialect(dialect), literal_dialect())
+
+
 class AttrDictTestCase(RecipeTestCase):
     def test_attr_dict(self):
         d = AttrDict()
@@ -111,6 +332,16 @@ class AttrDictTestCase(RecipeTestCase):
         assert d.bar == 3
 
 
+class VectorizedTestCase(RecipeTestCase):
+    def test_vectorized(self):
+        """Formatters are wrapped, so builtins can be vectorized"""
+        formatter = vectorized(sorted)
+        self.assertTrue(formatter.vectorized)
+        self.assertFalse(hasattr(sorted, "vectorized"))
+        self.assertEqual(formatter.__name__, "sorted")
+        self.assertEqual(formatter(["b", "a"]), ["a", "b"])
+
+
 class FakerFormatterTestCase(RecipeTestCase):
     def test_formatter(self):
         formatter = FakerFormatter()
@@ -301,6 +532,11 @@ class TestMakeSchema(RecipeTestCase):
                     },
                     "apply_automatic_filters": {"type": "boolean"},
                     "strict_automatic_filters": {"type": "boolean"},
+                    "automatic_filter_list_threshold": {
+                        "type": "integer",
+                        "min": 0,
+                        "nullable": True,
+                    },
                 },
                 "type": "dict",
                 "required": True,